@@ -0,0 +1,157 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from factor import compute_factor
+from modules.backtest.backtrader import BackTrader
+from modules.backtest.strategy import TopKStrategy
+from modules.benchmark.suite import (SCALES, BenchmarkSuite, compare_runs,
+                                     latest_run, load_run)
+from modules.benchmark.synthetic import write_stk_daily
+from modules.config import *
+from modules.factor_benchmark.utils import calc_rank_ic
+from modules.factor_composition.regressor import LassoRegressor
+from modules.factor_composition.utils import corr_scorer, train_test_split
+from modules.factor_construction.compute_engine import ComputeEngine
+from modules.factor_construction.data_engine import DataEngine
+from modules.factor_construction.factor_store import FactorStore
+
+BENCHMARK_PATH = f"{FACTOR_PATH}/benchmarks"
+
+# The ComputeEngine operators timed on every scale
+OPERATORS = {
+    "log": lambda ce, de: ce.log(de.close_adj),
+    "divide": lambda ce, de: ce.divide(de.close_adj, de.open_adj),
+    "shift": lambda ce, de: ce.shift(de.close_adj, de.date_col, 1),
+    "ret": lambda ce, de: ce.ret(de.close_adj, de.date_col, 5),
+    "ret_multi": lambda ce, de: ce.ret_multi(de.close_adj, de.date_col,
+                                             [1, 5, 10, 20]),
+    "rolling_sum": lambda ce, de: ce.rolling_sum(de.volume, de.date_col, 20),
+    "rolling_mean": lambda ce, de: ce.rolling_mean(de.volume, de.date_col, 20),
+    "rolling_std": lambda ce, de: ce.rolling_std(de.volume, de.date_col, 20),
+    "rolling_max": lambda ce, de: ce.rolling_max(de.close_adj, de.date_col, 20),
+    "rolling_min": lambda ce, de: ce.rolling_min(de.close_adj, de.date_col, 20),
+    "rolling_corr": lambda ce, de: ce.rolling_corr(de.close_adj, de.volume,
+                                                   de.date_col, 20),
+    "rolling_cov": lambda ce, de: ce.rolling_cov(de.close_adj, de.volume,
+                                                 de.date_col, 20),
+    "rolling_corr_multi": lambda ce, de: ce.rolling_corr_multi(
+        de.close_adj, de.volume, de.date_col, [5, 10, 20]),
+    "rank": lambda ce, de: ce.rank(de.close_adj, de.instrument_col),
+    "scale": lambda ce, de: ce.scale(de.close_adj, de.instrument_col),
+    "zscore": lambda ce, de: ce.zscore(de.close_adj, de.instrument_col),
+    "winsorize": lambda ce, de: ce.winsorize(de.close_adj, de.instrument_col),
+    "mad_clip": lambda ce, de: ce.mad_clip(de.close_adj, de.instrument_col),
+    "neutralize": lambda ce, de: ce.neutralize(
+        de.close_adj, de.instrument_col, [ce.log(de.amount)]),
+}
+
+
+def benchmark_scale(suite: BenchmarkSuite, scale: str, data_path: str,
+                    work_path: str) -> None:
+    """
+    Time every stage of the pipeline on one data file.
+
+    Parameters:
+    - suite (BenchmarkSuite): The suite recording the timings.
+    - scale (str): The scale name.
+    - data_path (str): The synthetic stk_daily file.
+    - work_path (str): A scratch directory for the factor library.
+    """
+    data_engine = suite.time(scale, "DataEngine.load_data", DataEngine,
+                             data_path, DATE_ID, INSTRUMENT_ID)
+    # Compute the adjusted prices outside of the operator timings
+    data_engine.close_adj, data_engine.open_adj
+
+    compute_engine = ComputeEngine()
+    for name, op in OPERATORS.items():
+        # An untimed first call, so the numba kernels are compiled outside
+        # of the timings
+        op(compute_engine, data_engine)
+        suite.time(scale, f"ComputeEngine.{name}", op, compute_engine,
+                   data_engine)
+
+    suite.time(scale, "compute_factor", compute_factor, data_engine,
+               compute_engine, None, work_path)
+    del data_engine
+
+    factors = FactorStore(f"{work_path}/factors").load()
+    returns = FactorStore(f"{work_path}/returns").load()["RETURN"]
+    suite.time(scale, "calc_rank_ic", calc_rank_ic,
+               factors["PAST_RETURN_10"], returns)
+
+    train_dataset, test_dataset = suite.time(
+        scale, "train_test_split", train_test_split, factors, returns,
+        min(252, len(returns[DATE_ID]) // 4))
+    regressor = LassoRegressor(corr_scorer, k=5)
+    suite.time(scale, "LassoRegressor.fit", regressor.fit, train_dataset)
+
+    signals = -factors["PAST_RETURN_10"]
+    backtrader = BackTrader(TopKStrategy(10))
+    suite.time(scale, "BackTrader.backtest", backtrader.backtest, signals,
+               returns)
+    suite.time(scale, "BackTrader.backtest_vectorized",
+               backtrader.backtest_vectorized, signals, returns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales",
+                        nargs="+",
+                        default=["small"],
+                        help="scales to run, from %s, or NxM for N stocks "
+                        "and M days" % ", ".join(SCALES))
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=1,
+                        help="runs of each stage, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output",
+                        default=None,
+                        help="JSON file of the results (default: a new "
+                        "timestamped file in %s)" % BENCHMARK_PATH)
+    parser.add_argument("--compare",
+                        default=None,
+                        nargs="?",
+                        const="latest",
+                        help="run to compare with (default: the latest "
+                        "saved run)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(
+        BENCHMARK_PATH, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    baseline = latest_run(BENCHMARK_PATH, exclude=output
+                          ) if args.compare == "latest" else args.compare
+
+    # The synthetic files are deterministic, so they are generated only once
+    data_dir = os.path.join(BENCHMARK_PATH, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    suite = BenchmarkSuite(args.repeat)
+    scales = {}
+    for scale in args.scales:
+        n_stocks, n_days = SCALES[scale] if scale in SCALES else map(
+            int, scale.split("x"))
+        scales[scale] = (n_stocks, n_days)
+        data_path = os.path.join(
+            data_dir, f"stk_daily_{n_stocks}x{n_days}_{args.seed}.feather")
+        if not os.path.exists(data_path):
+            write_stk_daily(data_path + ".tmp", n_stocks, n_days,
+                            seed=args.seed)
+            os.replace(data_path + ".tmp", data_path)
+
+        work_path = tempfile.mkdtemp()
+        try:
+            benchmark_scale(suite, scale, data_path, work_path)
+        finally:
+            shutil.rmtree(work_path)
+
+    suite.save(output, scales=scales, seed=args.seed, repeat=args.repeat)
+    print(suite.summary().to_string())
+    print(f"Saved to {output}")
+
+    if baseline is not None:
+        meta, summary = load_run(baseline)
+        print(f"\nCompared with {baseline} ({meta['commit']}, {meta['time']})")
+        print(compare_runs(summary, suite.summary()).to_string())
@@ -1,66 +1,256 @@
-import joblib
+import argparse
+import warnings
 from typing import Dict
 
+import numpy as np
 import xarray as xr
 
 from modules.config import *
 from modules.factor_construction.data_engine import DataEngine
 from modules.factor_construction.compute_engine import ComputeEngine
+from modules.factor_construction.expression import ExpressionGraph
+from modules.factor_construction.factor_cache import FactorCache
+from modules.factor_construction.factor_store import FactorStore
+from modules.factor_construction.registry import FactorRegistry
+from modules.profiling import enable, traced
 
+# The factor functions, with the factors they build and the fields they read
+registry = FactorRegistry()
 
+
+@registry.register(["PAST_RETURN_" + str(i) for i in [1, 2, 3, 5, 10, 15]],
+                   fields=["close_adj"])
 def factor_past_return(data_engine: DataEngine, compute_engine: ComputeEngine,
                        factors: Dict[str, xr.DataArray]) -> None:
-    for i in [1, 2, 3, 5, 10, 15]:
+    shifts = [1, 2, 3, 5, 10, 15]
+    # Every lookback shares one log of the prices
+    past_returns = compute_engine.ret_multi(data_engine.close_adj,
+                                            data_engine.date_col, shifts)
+    for i in shifts:
         factors["PAST_RETURN_" + str(i)] = compute_engine.shift(
-            compute_engine.ret(data_engine.close_adj, data_engine.date_col, i),
-            data_engine.date_col, 1)
+            compute_engine.sel_window(past_returns, i), data_engine.date_col,
+            1)
     return factors
 
 
+@registry.register(
+    ["PAST_RETURN_VOL_CORR" + str(i) for i in [5, 10, 15, 20]],
+    fields=["close_adj", "volume"])
 def factor_past_return_corr(data_engine: DataEngine,
                             compute_engine: ComputeEngine,
                             factors: Dict[str, xr.DataArray]) -> None:
-    for i in [5, 10, 15, 20]:
+    windows = [5, 10, 15, 20]
+    # The return over each window is correlated with the volume over the same
+    # window, every window in one pass over the dates
+    corrs = compute_engine.rolling_corr_multi(
+        compute_engine.ret_multi(data_engine.close_adj, data_engine.date_col,
+                                 windows), data_engine.volume,
+        data_engine.date_col, windows)
+    for i in windows:
         factors["PAST_RETURN_VOL_CORR" + str(i)] = compute_engine.shift(
-            compute_engine.rolling_corr(
-                compute_engine.ret(data_engine.close_adj, data_engine.date_col,
-                                   i), data_engine.volume,
-                data_engine.date_col, i), data_engine.date_col, 1)
+            compute_engine.sel_window(corrs, i), data_engine.date_col, 1)
     return factors
 
 
-def compute_factor(data_engine: DataEngine,
-                   compute_engine: ComputeEngine) -> None:
+def build_factors(data_engine: DataEngine, compute_engine: ComputeEngine):
     """
-    Compute the specified factor and save it to disk.
+    Build the lazy expressions of the factors and the returns.
 
     Parameters:
     - data_engine (DataEngine): The data engine.
     - compute_engine (ComputeEngine): The compute engine.
+
+    Returns:
+    - tuple: The ExpressionGraph and its output nodes by name, the returns
+    under "RETURN".
     """
+    # Build the factors lazily, so that shared subexpressions are computed once
+    graph = ExpressionGraph(data_engine, compute_engine)
+    data_engine, compute_engine = graph.data_engine, graph.compute_engine
+
     # Compute the returns using the compute_engine.ret() method
     returns = compute_engine.ret(data_engine.close_adj, data_engine.date_col,
                                  1)
 
-    # Initialize an empty dictionary to store the factors
-    factors = {}
+    # Build every registered factor
+    factors = registry.build(data_engine, compute_engine)
+
+    return graph, {**factors, "RETURN": returns}
+
+
+@traced()
+def compute_factor(data_engine: DataEngine,
+                   compute_engine: ComputeEngine,
+                   cache: FactorCache = None,
+                   factor_path: str = None,
+                   n_jobs: int = 1,
+                   memory_budget: int = None) -> None:
+    """
+    Compute the specified factor and save it to disk.
+
+    Independent factors are computed concurrently by n_jobs threads, and each
+    factor is written to a new factor library as soon as it is computed, so
+    only the intermediates still needed are held in memory. The library then
+    lists the factors in registry order, whatever order they finished in, and
+    replaces the previous one, which a failed run leaves untouched.
 
-    # Compute the factors for different time periods
-    factors = factor_past_return(data_engine, compute_engine, factors)
-    factors = factor_past_return_corr(data_engine, compute_engine, factors)
+    Parameters:
+    - data_engine (DataEngine): The data engine.
+    - compute_engine (ComputeEngine): The compute engine.
+    - cache (FactorCache, optional): The cache of computed factors; only the
+    factors missing from it are computed.
+    - factor_path (str, optional): The directory of the factor library. Default is FACTOR_PATH.
+    - n_jobs (int): The number of threads, None for the CPU count. Default is 1.
+    - memory_budget (int, optional): The bytes of intermediates held at once. Default is None (no limit).
+    """
+    factor_path = FACTOR_PATH if factor_path is None else factor_path
+    graph, outputs = build_factors(data_engine, compute_engine)
 
-    # Convert the factors dictionary into an xarray Dataset
-    factors = xr.Dataset(factors)
+    # Write into new stores next to the factor library and returns, which
+    # replace them only once complete
+    factor_store = FactorStore(f"{factor_path}/factors.tmp")
+    return_store = FactorStore(f"{factor_path}/returns.tmp")
+    try:
+        factor_store.clear()
+        return_store.clear()
+        if data_engine.chunks is not None:
+            # Lazy (dask) factors are computed together, chunk by chunk, on
+            # write
+            factors = graph.evaluate(outputs, cache)
+            returns = factors.pop("RETURN")
+            factor_store.write(xr.Dataset(factors))
+            return_store.write(xr.Dataset({"RETURN": returns}))
+        else:
 
-    # Save the factors to disk using the joblib.dump() method
-    joblib.dump(factors, f"{FACTOR_PATH}/factors.joblib")
+            def save(name, value):
+                store = return_store if name == "RETURN" else factor_store
+                store.write(xr.Dataset({name: value}))
 
-    # Save the returns to disk using the joblib.dump() method
-    joblib.dump(returns, f"{FACTOR_PATH}/returns.joblib")
+            graph.stream(outputs, save, cache, n_jobs, memory_budget)
+            factor_store.reorder(list(outputs))
+    except BaseException:
+        factor_store.clear()
+        return_store.clear()
+        raise
+    factor_store.replace(f"{factor_path}/factors")
+    return_store.replace(f"{factor_path}/returns")
+
+
+@traced()
+def update_factor(data_path: str, compute_engine: ComputeEngine) -> None:
+    """
+    Compute the factors and returns of the dates not yet saved and append them.
+
+    Only the rows needed to warm up the operators are loaded, and the appended
+    values are identical to those of a full compute_factor run. Without a
+    saved factor library, every date is computed with compute_factor.
+
+    Parameters:
+    - data_path (str): The path to the data file.
+    - compute_engine (ComputeEngine): The compute engine.
+    """
+    factor_store = FactorStore(f"{FACTOR_PATH}/factors")
+    return_store = FactorStore(f"{FACTOR_PATH}/returns")
+    stored_dates = return_store.dates
+    if not (factor_store.exists() and return_store.exists()) or len(
+            stored_dates) == 0:
+        data_engine = DataEngine(data_path,
+                                 DATE_ID,
+                                 INSTRUMENT_ID,
+                                 columns=registry.fields() + ["close_adj"])
+        compute_factor(data_engine, compute_engine)
+        return
+
+    # Load the last saved date only to build the expressions and their warm-up
+    data_engine = DataEngine(data_path, DATE_ID, INSTRUMENT_ID,
+                             stored_dates[-1])
+    graph, outputs = build_factors(data_engine, compute_engine)
+    warmup, windows = graph.warmup(outputs)
+
+    # Start on a multiple of every rolling window, so the blocks of the
+    # rolling kernels line up with those of the full computation
+    period = int(np.lcm.reduce(windows)) if windows else 1
+    start = max(len(stored_dates) - warmup, 0) // period * period
+    if start == 0 and len(stored_dates) > warmup:
+        warnings.warn(
+            "The rolling windows %s only line up every %d dates, so the "
+            "update recomputes the whole history" % (windows, period))
+
+    data_engine = DataEngine(data_path,
+                             DATE_ID,
+                             INSTRUMENT_ID,
+                             stored_dates[start],
+                             columns=graph.fields())
+    n_history = len(stored_dates) - start
+    if not np.array_equal(data_engine.dates[:n_history],
+                          stored_dates[start:]):
+        raise ValueError("The data dates do not match the saved dates")
+    new_dates = data_engine.dates[n_history:]
+    if len(new_dates) == 0:
+        return
+
+    graph, outputs = build_factors(data_engine, compute_engine)
+    factors = {
+        name: value.sel({DATE_ID: new_dates})
+        for name, value in graph.evaluate(outputs).items()
+    }
+    returns = factors.pop("RETURN")
+
+    factor_store.append(xr.Dataset(factors))
+    return_store.append(xr.Dataset({"RETURN": returns}))
 
 
 if __name__ == "__main__":
-    data_engine = DataEngine(DATA_PATH, DATE_ID, INSTRUMENT_ID)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--update",
+                        action="store_true",
+                        help="only compute and append the new dates")
+    parser.add_argument("--no-cache",
+                        action="store_true",
+                        help="recompute every factor")
+    parser.add_argument("--chunks",
+                        type=int,
+                        default=None,
+                        help="compute out of core with dask, with this many "
+                        "instruments per chunk (implies --no-cache)")
+    parser.add_argument("--profile",
+                        default=None,
+                        metavar="PATH",
+                        help="trace the time and memory of every stage and "
+                        "factor, and save the Chrome trace to PATH")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=None,
+                        help="threads computing independent factors "
+                        "(default: the CPU count)")
+    parser.add_argument("--memory-budget",
+                        type=float,
+                        default=None,
+                        help="GiB of intermediate results held at once "
+                        "(default: no limit)")
+    args = parser.parse_args()
+
+    tracer = enable() if args.profile else None
     compute_engine = ComputeEngine()
 
-    compute_factor(data_engine, compute_engine)
+    if args.update:
+        update_factor(DATA_PATH, compute_engine)
+    else:
+        # Only load the fields of the registered factors and the returns
+        data_engine = DataEngine(DATA_PATH,
+                                 DATE_ID,
+                                 INSTRUMENT_ID,
+                                 columns=registry.fields() + ["close_adj"],
+                                 chunks=args.chunks)
+        cache = None if args.no_cache or args.chunks else FactorCache(
+            CACHE_PATH, CACHE_SIZE)
+        memory_budget = None if args.memory_budget is None else int(
+            args.memory_budget * 1024**3)
+        compute_factor(data_engine, compute_engine, cache, None, args.jobs,
+                       memory_budget)
+        if cache is not None:
+            print(cache.stats)
+
+    if tracer is not None:
+        tracer.to_chrome_trace(args.profile)
+        print(tracer.summary().to_string())
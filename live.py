@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+
+import joblib
+
+from factor import build_factors
+from modules.backtest.strategy import TopKStrategy
+from modules.config import *
+from modules.factor_construction.data_engine import DataEngine
+from modules.live.service import FileFeed, LiveSignalEngine, LiveSignalService
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model",
+                        required=True,
+                        help="joblib file of a dict with the fitted "
+                        "regressor and its features")
+    parser.add_argument("--feed",
+                        default=None,
+                        help="directory where the bars of each day are dropped")
+    parser.add_argument("--k",
+                        type=int,
+                        default=5,
+                        help="percentage of stocks to hold")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval",
+                        type=float,
+                        default=1.0,
+                        help="polling interval of the feed, in seconds")
+    args = parser.parse_args()
+
+    model = joblib.load(args.model)
+    data_engine = DataEngine(DATA_PATH, DATE_ID, INSTRUMENT_ID)
+    engine = LiveSignalEngine(data_engine.data, build_factors,
+                              model["regressor"], model["features"],
+                              TopKStrategy(args.k))
+    del data_engine
+
+    feed = None if args.feed is None else FileFeed(args.feed)
+    service = LiveSignalService(engine, feed, args.interval)
+    asyncio.run(service.serve(args.host, args.port))
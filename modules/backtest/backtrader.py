@@ -1,56 +1,206 @@
-from ..config import INSTRUMENT_ID
+from ..config import DATE_ID, INSTRUMENT_ID
+from ..profiling import traced
+from .cost_model import FlatCostModel
+from .strategy import BaseStrategy
 
 import numpy as np
+import xarray as xr
 
 
 class BackTrader(object):
     """
     BackTrader class is used to perform backtesting operations.
 
+    The positions given by the strategy are targets: on rebalance dates the
+    portfolio trades towards them, on other dates it keeps its holdings. With
+    drift, the holdings move with the stock returns between trades, so the
+    next trade starts from the drifted weights rather than the last targets.
+
     Args:
         strategy (object): Backtesting strategy object.
-        fee (float, optional): Transaction fee, default is 0.001.
+        fee (float, optional): Transaction fee, default is 0.0008. Used when no cost_model is given.
+        cost_model (BaseCostModel, optional): The execution cost model, default is FlatCostModel(fee).
+        drift (bool, optional): Drift the holdings by the stock returns between trades, default is False.
+        rebalance_every (int, optional): Trade on every n-th date with signal only, default is 1.
+        band (float, optional): Skip the trades of stocks whose weight is within band of its target, default is 0.
 
     Attributes:
         strategy (object): Backtesting strategy object.
         fee (float): Transaction fee.
+        cost_model (BaseCostModel): The execution cost model.
+        turnover (list): The traded weight of each date in the last backtest.
 
     Methods:
-        backtest(signals, returns): Perform backtesting operation and return portfolio returns.
+        backtest(signals, returns, vectorized): Perform backtesting operation and return portfolio returns.
+        backtest_positions(positions, returns): Backtest given target positions.
 
     """
 
-    def __init__(self, strategy, fee=0.0008):
+    def __init__(self,
+                 strategy,
+                 fee=0.0008,
+                 cost_model=None,
+                 drift=False,
+                 rebalance_every=1,
+                 band=0.0):
+        assert rebalance_every >= 1 and band >= 0
         self.strategy = strategy
         self.fee = fee
+        self.cost_model = FlatCostModel(fee) if cost_model is None else cost_model
+        self.drift = drift
+        self.rebalance_every = rebalance_every
+        self.band = band
+        self.turnover = None
 
-    def backtest(self, signals, returns):
+    @traced(category="backtest")
+    def backtest(self, signals, returns, vectorized=False):
         """
             Perform backtesting operation and return portfolio returns.
 
             Args:
-                signals (pandas.DataFrame): Trading signal data.
-                returns (pandas.DataFrame): Stock returns data.
+                signals (xarray.DataArray): Trading signal data.
+                returns (xarray.DataArray): Stock returns data.
+                vectorized (bool, optional): Use the strategy's batched
+                    get_positions instead of calling get_position on each
+                    date, default is False.
+
+            Returns:
+                list: List of portfolio returns, NaN on dates without signal.
+
+            """
+        if vectorized:
+            return self.backtest_vectorized(signals, returns)
+
+        signals, returns = xr.align(signals, returns, join="left")
+        positions = BaseStrategy.get_positions(self.strategy, signals)
+        return self.backtest_positions(self._mask(positions, signals), returns)
+
+    @traced(category="backtest")
+    def backtest_vectorized(self, signals, returns):
+        """
+            Perform backtesting operation on the whole panel at once.
+
+            Gives the same portfolio returns as the per-date loop, using the
+            strategy's batched get_positions.
+
+            Args:
+                signals (xarray.DataArray): Trading signal data.
+                returns (xarray.DataArray): Stock returns data.
+
+            Returns:
+                list: List of portfolio returns, NaN on dates without signal.
+
+            """
+        signals, returns = xr.align(signals, returns, join="left")
+        positions = self.strategy.get_positions(signals)
+        return self.backtest_positions(self._mask(positions, signals), returns)
+
+    @traced(category="backtest")
+    def backtest_positions(self, positions, returns):
+        """
+            Trade towards given target positions and charge the execution costs.
+
+            Dates where every position is NaN are skipped: they neither trade
+            nor drift the holdings, and their portfolio return is NaN.
+
+            Args:
+                positions (xarray.DataArray): The target position panel.
+                returns (xarray.DataArray): Stock returns data.
 
             Returns:
                 list: List of portfolio returns.
 
             """
-        portfolio_returns = []
-        last_position = np.zeros(len(signals.stk_id))
-        for date in signals.date:
-            signal = signals.sel(date=date)
-            if signal.isnull().all():
-                portfolio_returns.append(np.nan)
-                continue
-            position = self.strategy.get_position(signal)
-            _return = returns.sel(date=date)
-
-            portfolio_return = float(
-                (position * _return).sum(dim=INSTRUMENT_ID))
-            additional_fee = np.abs(position - last_position).sum() * self.fee
-
-            portfolio_returns.append(float(portfolio_return - additional_fee))
-            last_position = position
-
-        return portfolio_returns
+        positions, returns = xr.align(positions, returns, join="left")
+        positions = positions.transpose(DATE_ID, INSTRUMENT_ID)
+        traded = positions.notnull().any(dim=INSTRUMENT_ID).values
+        targets = np.nan_to_num(positions.values[traded])
+        _returns = returns.transpose(DATE_ID, INSTRUMENT_ID).values[traded]
+
+        held, pre_trade = self._hold(targets, np.nan_to_num(_returns))
+        trades = positions.isel({DATE_ID: traded}).copy(data=held - pre_trade)
+        costs = self.cost_model.costs(trades).sum(dim=INSTRUMENT_ID)
+
+        portfolio_return = np.nansum(held * _returns, axis=1)
+        portfolio_returns = np.full(len(traded), np.nan)
+        portfolio_returns[traded] = portfolio_return - costs.values
+        self.turnover = np.full(len(traded), np.nan)
+        self.turnover[traded] = np.abs(trades.values).sum(axis=1)
+        self.turnover = self.turnover.tolist()
+        return portfolio_returns.tolist()
+
+    @staticmethod
+    def _mask(positions, signals):
+        """
+            Set the positions of the dates without any signal to NaN.
+
+            """
+        traded = signals.notnull().any(dim=INSTRUMENT_ID)
+        return positions.where(traded)
+
+    def _hold(self, targets, returns):
+        """
+            Get the holdings after trading on each date and the holdings
+            just before trading.
+
+            Without a band, the holdings of the k-th date after a rebalance
+            only depend on the rebalance targets, so they are computed for all
+            rebalance periods at once, in rebalance_every steps. A band makes
+            every trade depend on the holdings before it, so the rebalance
+            dates are processed in order: one Python step per rebalance date,
+            vectorized over the stocks, with the drift of the dates in between
+            computed at once from the cumulative returns. With the default
+            rebalance_every of 1, that is one step per date.
+
+            """
+        n_dates = len(targets)
+        held = np.zeros(targets.shape)
+        pre_trade = np.zeros(targets.shape)
+        if self.band == 0:
+            starts = np.arange(0, n_dates, self.rebalance_every)
+            held[starts] = targets[starts]
+            for offset in range(1, self.rebalance_every):
+                rows = starts[starts + offset < n_dates] + offset
+                held[rows] = self._drift(held[rows - 1], returns[rows - 1])
+            pre_trade[1:] = self._drift(held[:-1], returns[:-1])
+            return held, pre_trade
+
+        drifted = np.zeros(targets.shape[1])
+        for start in range(0, n_dates, self.rebalance_every):
+            stop = min(start + self.rebalance_every, n_dates)
+            pre_trade[start] = drifted
+            trade = targets[start] - drifted
+            trade[np.abs(trade) <= self.band] = 0
+            held[start] = drifted + trade
+            # The holdings after each date's returns until the next rebalance
+            path = self._drift_path(held[start], returns[start:stop])
+            held[start + 1:stop] = pre_trade[start + 1:stop] = path[:-1]
+            drifted = path[-1]
+        return held, pre_trade
+
+    def _drift(self, held, returns):
+        """
+            Move the weights of the holdings with one date of returns.
+
+            The returns are log returns (see ComputeEngine.ret), and the part
+            of the portfolio not invested in stocks earns nothing.
+
+            """
+        if not self.drift:
+            return held
+        simple = np.expm1(returns)
+        growth = 1 + (held * simple).sum(axis=-1, keepdims=True)
+        return held * (1 + simple) / growth
+
+    def _drift_path(self, held, returns):
+        """
+            Move the weights of the holdings with each of several dates of
+            returns, from the cumulative growth of every stock; row i is the
+            same as applying _drift i + 1 times.
+
+            """
+        if not self.drift:
+            return np.broadcast_to(held, returns.shape)
+        growth = np.exp(np.cumsum(returns, axis=0))
+        return held * growth / (1 + (held * (growth - 1)).sum(
+            axis=-1, keepdims=True))
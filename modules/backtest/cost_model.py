@@ -0,0 +1,93 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import xarray as xr
+
+
+class BaseCostModel(ABC):
+
+    @abstractmethod
+    def costs(self, trades):
+        """
+        Calculates the execution cost of every trade.
+
+        Parameters:
+        - trades (xarray.DataArray): The (date, stk_id) changes of the
+        position weights, 0 for stocks that are not traded.
+
+        Returns:
+        - xarray.DataArray: The (date, stk_id) costs, as a fraction of the
+        portfolio value.
+        """
+        pass
+
+
+class FlatCostModel(BaseCostModel):
+    """
+    A cost model charging a flat fee on the traded weight.
+
+    Parameters:
+    - fee (float): The fee per unit of traded weight, default is 0.0008.
+    """
+
+    def __init__(self, fee=0.0008):
+        self.fee = fee
+
+    def costs(self, trades):
+        return np.abs(trades) * self.fee
+
+
+class SpreadImpactCostModel(BaseCostModel):
+    """
+    A cost model with a fee, half the bid-ask spread and a market impact
+    growing with the traded value relative to the stock's traded value.
+
+    The cost rate of a trade is
+
+        fee + spread / 2 + impact * (|trade| * capital / volume) ** exponent
+
+    which is the square root law of market impact with the default exponent.
+    Every parameter given as a DataArray is aligned with the trades by its
+    date and stk_id coordinates.
+
+    Parameters:
+    - volume (xarray.DataArray): The traded value of every stock and date, in the currency of capital.
+    - capital (float): The portfolio value, default is 1e8.
+    - fee (float): The commission and tax rate, default is 0.0008.
+    - spread (float or xarray.DataArray): The relative bid-ask spread, default is 0.001. Missing spreads are treated as zero.
+    - impact (float or xarray.DataArray): The impact coefficient, about the daily volatility of the stock. Default is 0.02.
+    - exponent (float): The exponent of the participation rate, default is 0.5.
+    - max_participation (float): The cap of the participation rate, also used for stocks without volume. Default is 1.0.
+    """
+
+    def __init__(self,
+                 volume,
+                 capital=1e8,
+                 fee=0.0008,
+                 spread=0.001,
+                 impact=0.02,
+                 exponent=0.5,
+                 max_participation=1.0):
+        self.volume = volume
+        self.capital = capital
+        self.fee = fee
+        self.spread = spread
+        self.impact = impact
+        self.exponent = exponent
+        self.max_participation = max_participation
+
+    def costs(self, trades):
+        traded = np.abs(trades)
+        volume = self.volume.reindex_like(trades)
+        # NaN and zero volumes give NaN and inf, both capped by fmin
+        participation = np.fmin(traded * self.capital / volume,
+                                self.max_participation)
+
+        spread, impact = self.spread, self.impact
+        if isinstance(spread, xr.DataArray):
+            spread = spread.reindex_like(trades).fillna(0)
+        if isinstance(impact, xr.DataArray):
+            impact = impact.reindex_like(trades)
+
+        rate = self.fee + spread / 2 + impact * participation**self.exponent
+        return (traded * rate).where(traded > 0, 0)
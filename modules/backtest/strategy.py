@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
-from ..config import INSTRUMENT_ID
+from ..config import DATE_ID, INSTRUMENT_ID
+
 import numpy as np
+import xarray as xr
 
 
 class BaseStrategy(ABC):
@@ -13,36 +15,179 @@ class BaseStrategy(ABC):
     def get_position(self, date, signal):
         pass
 
+    def get_positions(self, signals):
+        """
+        Calculates the positions for every date of a signal panel.
+
+        The default implementation calls get_position once per date; strategies
+        should override it with a batched version when possible.
+
+        Parameters:
+        - signals (xarray.DataArray): The (date, stk_id) signal panel.
+
+        Returns:
+        - xarray.DataArray: The position panel, NaN on dates without signal.
+        """
+        positions = []
+        for date in signals[DATE_ID]:
+            signal = signals.sel({DATE_ID: date})
+            if signal.isnull().all():
+                positions.append(xr.full_like(signal, np.nan, dtype=float))
+            else:
+                positions.append(self.get_position(signal))
+        return xr.concat(positions, dim=DATE_ID).transpose(*signals.dims)
+
+
+def quantile_count(k, n_valid):
+    """
+    Number of stocks in the top k percent of the valid stocks.
+
+    It is the number of ranks 1..n at or above their (100 - k)th percentile,
+    as computed by np.percentile, which is how TopKStrategy has always sized
+    its holdings; the count only depends on n, so the percentile is computed
+    once per distinct number of valid stocks.
+
+    Parameters:
+    - k (float): The percentage of stocks, e.g. 5 for the top 5%.
+    - n_valid (numpy.ndarray): The number of valid stocks of each date.
+
+    Returns:
+    - numpy.ndarray: The number of stocks to select on each date.
+    """
+    n_valid = np.asarray(n_valid)
+    counts = np.zeros(n_valid.shape, dtype=int)
+    for n in np.unique(n_valid[n_valid > 0]):
+        threshold = np.percentile(np.arange(1, n + 1), 100 - k)
+        counts[n_valid == n] = n - int(np.ceil(threshold)) + 1
+    return counts
+
+
+def select_top(values, k=None, quantile=None, largest=True):
+    """
+    Selects the top (or bottom) stocks of every date at once.
+
+    The cutoff of each date is found with np.partition, the value form of
+    np.argpartition, in O(stocks) per date. Stocks tied at the cutoff are
+    taken in stock order, so each date holds exactly the requested number of
+    stocks and the selection is deterministic.
+
+    Parameters:
+    - values (numpy.ndarray): The (date, stk_id) signal array, NaN for missing signals.
+    - k (int or numpy.ndarray, optional): The number of stocks to select on each date, or an array of one number per date.
+    - quantile (float, optional): The fraction of the valid stocks to select on each date, counted by quantile_count. Exactly one of k and quantile must be given.
+    - largest (bool): Select the largest values if True, the smallest otherwise.
+
+    Returns:
+    - numpy.ndarray: The (date, stk_id) boolean mask of the selected stocks.
+    """
+    if (k is None) == (quantile is None):
+        raise ValueError("Exactly one of k and quantile must be given")
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    n_valid = valid.sum(axis=1)
+    if k is not None:
+        counts = np.minimum(k, n_valid)
+    else:
+        counts = quantile_count(100 * quantile, n_valid)
+
+    key = np.where(valid, values if largest else -values, -np.inf)
+    mask = np.zeros(values.shape, dtype=bool)
+    rows = np.flatnonzero(counts > 0)
+    if len(rows) == 0:
+        return mask
+
+    # Partition at every distinct count, then read each row's own cutoff
+    key, counts = key[rows], counts[rows]
+    part = np.partition(-key, np.unique(counts) - 1, axis=1)
+    cutoff = -np.take_along_axis(part, counts[:, None] - 1, axis=1)
+    above = key > cutoff
+    at = key == cutoff
+    n_at = counts - above.sum(axis=1)
+    mask[rows] = above | (at & (np.cumsum(at, axis=1) <= n_at[:, None]))
+    return mask
+
 
 class TopKStrategy(BaseStrategy):
     """
     A strategy that selects the top K stocks based on a given signal.
 
+    Holdings are selected for all dates at once with select_top, with the
+    same number of stocks on every date with enough signals: ties at the
+    cutoff are taken in stock order.
+
     Parameters:
-    - k (int): The number of top stocks to select.
+    - k (int): The percentage of stocks to select, e.g. 5 for the top 5%.
+    - n_stocks (int, optional): The number of stocks to select instead of a percentage.
+    - long_short (bool): Also short the bottom stocks, default is False. The
+    long leg sums to 1 and the short leg to -1; each leg has at most half of
+    the valid stocks.
 
     Methods:
     - get_position(signal): Calculates the position for each stock based on the signal.
+    - get_positions(signals): Calculates the positions for all dates at once.
 
     """
 
-    def __init__(self, k=10):
+    def __init__(self, k=10, n_stocks=None, long_short=False):
         assert k >= 1 and k <= 99
+        assert n_stocks is None or n_stocks >= 1
         self.k = k
+        self.n_stocks = n_stocks
+        self.long_short = long_short
 
     def get_position(self, signal):
         """
         Calculates the position for each stock based on the signal.
 
         Parameters:
-        - signal (pandas.DataFrame): The signal data for each stock.
+        - signal (xarray.DataArray): The signal data for each stock.
+
+        Returns:
+        - xarray.DataArray: The position data for each stock.
+
+        """
+        return signal.copy(data=self._positions(signal.values[None])[0])
+
+    def get_positions(self, signals):
+        """
+        Calculates the positions for every date of a signal panel at once.
+
+        Gives the same result as calling get_position on each date.
+
+        Parameters:
+        - signals (xarray.DataArray): The (date, stk_id) signal panel.
 
         Returns:
-        - pandas.DataFrame: The position data for each stock.
+        - xarray.DataArray: The position panel, NaN on dates without signal.
+        """
+        signals = signals.transpose(DATE_ID, INSTRUMENT_ID)
+        positions = self._positions(signals.values)
+        return signals.copy(data=positions).transpose(*signals.dims)
 
+    def _positions(self, values):
+        """
+        Equal-weight positions of a (date, stk_id) signal array.
         """
-        signal_rank = signal.rank(dim=INSTRUMENT_ID)
-        signal_rank_thresh = np.percentile(
-            signal_rank.dropna(dim=INSTRUMENT_ID), 100 - self.k)
-        selected_stocks = (signal_rank >= signal_rank_thresh).astype(int)
-        return selected_stocks / selected_stocks.sum(dim=INSTRUMENT_ID)
+        n_valid = (~np.isnan(values)).sum(axis=1)
+        if self.n_stocks is not None:
+            counts = np.minimum(self.n_stocks, n_valid)
+        else:
+            counts = quantile_count(self.k, n_valid)
+
+        if not self.long_short:
+            legs = [select_top(values, counts)]
+        else:
+            # Keep the legs disjoint on dates with few signals
+            counts = np.minimum(counts, n_valid // 2)
+            legs = [
+                select_top(values, counts),
+                -select_top(values, counts, largest=False).astype(int)
+            ]
+
+        positions = np.zeros(values.shape)
+        for leg in legs:
+            size = np.maximum(np.abs(leg).sum(axis=1, keepdims=True), 1)
+            positions += leg / size
+        # Dates without any signal have no position
+        positions[n_valid == 0] = np.nan
+        return positions
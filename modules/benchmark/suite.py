@@ -0,0 +1,198 @@
+import glob
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ..profiling import Tracer
+
+# (n_stocks, n_days) of each benchmark scale, "large" is 20 years of the A-share market
+SCALES = {
+    "small": (500, 500),
+    "medium": (2000, 1260),
+    "large": (5000, 5040),
+}
+
+
+class BenchmarkSuite(object):
+    """
+    Times the stages of the pipeline and stores the results of a run.
+
+    Each stage is run repeat times, and its wall time, CPU time and peak RSS
+    growth are recorded with a profiling.Tracer. The stages only record their
+    own span, tracing inside them stays disabled. The peak RSS of a process
+    never decreases, so the peak growth of a stage only shows the memory it
+    needed beyond the earlier stages; run the scales in increasing order.
+
+    Parameters:
+    - repeat (int): The number of runs of each stage. Default is 1.
+
+    Methods:
+    - time(scale, stage, func, *args, **kwargs): Time a stage and return its last result.
+    - summary(): The best run of each stage.
+    - save(path): Save the results with the machine and code versions.
+    """
+
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.tracer = Tracer()
+        self.results = []
+
+    def time(self, scale, stage, func, *args, **kwargs):
+        """
+        Time a stage at a scale.
+
+        Parameters:
+        - scale (str): The scale name, e.g. "small".
+        - stage (str): The stage name, e.g. "DataEngine.load_data".
+        - func (callable): The stage, called with args and kwargs.
+
+        Returns:
+        - The result of the last run.
+        """
+        for run in range(self.repeat):
+            with self.tracer.span(stage, "benchmark", scale=scale):
+                result = func(*args, **kwargs)
+            event = self.tracer.events[-1]
+            self.results.append({
+                "scale": scale,
+                "stage": stage,
+                "run": run,
+                "wall_s": event["wall_s"],
+                "cpu_s": event["cpu_s"],
+                "rss_mb": event["rss_mb"],
+                "peak_rss_growth_mb": event["peak_rss_growth_mb"],
+            })
+        return result
+
+    def summary(self):
+        """
+        Get the best run of each stage.
+
+        Returns:
+        - pandas.DataFrame: The minimum wall and CPU time, maximum RSS and
+        peak RSS growth of each stage, indexed by (scale, stage) in run order.
+        """
+        return _summarize(self.results)
+
+    def save(self, path, **meta):
+        """
+        Save the results of the run as JSON.
+
+        Parameters:
+        - path (str): The JSON file to write.
+        - meta: Extra values to record, e.g. the generator parameters.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({
+                "meta": {
+                    **environment(),
+                    **meta
+                },
+                "results": self.results
+            },
+                      f,
+                      indent=1,
+                      default=str)
+
+
+def environment():
+    """
+    Get the machine and code versions of a run.
+
+    Returns:
+    - dict: The time, git commit, host, CPU count and library versions.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "xarray": xr.__version__,
+    }
+
+
+def load_run(path):
+    """
+    Load the results of a saved run.
+
+    Parameters:
+    - path (str): The JSON file of the run.
+
+    Returns:
+    - tuple: The meta dict and the summary DataFrame of the run.
+    """
+    with open(path) as f:
+        run = json.load(f)
+    return run["meta"], _summarize(run["results"])
+
+
+def latest_run(directory, exclude=None):
+    """
+    Get the path of the most recent run saved in a directory.
+
+    Parameters:
+    - directory (str): The directory of the runs.
+    - exclude (str, optional): A run to skip, e.g. the current one.
+
+    Returns:
+    - str: The path of the run, or None if there is none.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "*.json")))
+    if exclude is not None:
+        paths = [
+            path for path in paths
+            if os.path.abspath(path) != os.path.abspath(exclude)
+        ]
+    return paths[-1] if paths else None
+
+
+def compare_runs(baseline, current):
+    """
+    Compare the best wall time of every stage between two runs.
+
+    Parameters:
+    - baseline (pandas.DataFrame): The summary of the earlier run.
+    - current (pandas.DataFrame): The summary of the later run.
+
+    Returns:
+    - pandas.DataFrame: The wall times of both runs and the speedup of the
+    current one, indexed by (scale, stage). Stages missing from a run have NaN.
+    """
+    table = pd.concat(
+        {
+            "baseline_s": baseline["wall_s"],
+            "current_s": current["wall_s"]
+        },
+        axis=1)
+    table["speedup"] = table["baseline_s"] / table["current_s"]
+    return table
+
+
+def _summarize(results):
+    if not results:
+        return pd.DataFrame(
+            columns=["wall_s", "cpu_s", "max_rss_mb", "peak_rss_growth_mb"])
+    results = pd.DataFrame(results)
+    return results.groupby(["scale", "stage"], sort=False).agg(
+        wall_s=("wall_s", "min"),
+        cpu_s=("cpu_s", "min"),
+        max_rss_mb=("rss_mb", "max"),
+        peak_rss_growth_mb=("peak_rss_growth_mb", "max"))
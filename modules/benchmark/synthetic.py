@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from ..config import DATE_ID, INSTRUMENT_ID
+
+
+def make_stk_daily(n_stocks=500,
+                   n_days=500,
+                   start="2004-01-02",
+                   listing=0.3,
+                   delisting=0.05,
+                   suspension_rate=0.002,
+                   suspension_length=5,
+                   nan_rate=0.001,
+                   adj_rate=1.0,
+                   seed=0):
+    """
+    Generate synthetic daily bars shaped like stk_daily.
+
+    The adjusted prices follow a one-factor model: a common market return
+    plus an idiosyncratic return with a small mean reversion, so reversal
+    factors have a small positive IC. Every stock has its own random
+    generator, so the bars of a stock only depend on the seed, the dates and
+    its index, and not on the number of stocks.
+
+    Parameters:
+    - n_stocks (int): The number of stocks. Default is 500.
+    - n_days (int): The number of business days. Default is 500.
+    - start (str): The first date. Default is "2004-01-02".
+    - listing (float): The fraction of stocks listed after the first date, at a uniform date. Default is 0.3.
+    - delisting (float): The fraction of stocks delisted before the last date, at a uniform date. Default is 0.05.
+    - suspension_rate (float): The daily probability of a suspension starting. Suspended days have no row. Default is 0.002.
+    - suspension_length (float): The mean length of a suspension, in days. Default is 5.
+    - nan_rate (float): The probability of each price or volume value being NaN. Default is 0.001.
+    - adj_rate (float): The mean number of cumadj jumps (dividends and splits) per stock and year. Default is 1.
+    - seed (int): The random seed. Default is 0.
+
+    Returns:
+    - pandas.DataFrame: The stk_id, date, open, high, low, close, volume, amount and cumadj columns, sorted by stock then date.
+    """
+    dates = pd.bdate_range(start, periods=n_days)
+    market = np.random.default_rng(seed).normal(0.0003, 0.012, n_days)
+    return pd.concat([
+        _stock_bars(i, dates, market, listing, delisting, suspension_rate,
+                    suspension_length, nan_rate, adj_rate, seed)
+        for i in range(n_stocks)
+    ],
+                     ignore_index=True)
+
+
+def write_stk_daily(path, n_stocks=500, n_days=500, batch_size=100, **kwargs):
+    """
+    Write synthetic bars to a feather file, batch_size stocks at a time, so the
+    whole panel is never in memory. The file is the same as
+    make_stk_daily(n_stocks, n_days, **kwargs).to_feather(path).
+
+    Parameters:
+    - path (str): The feather file to write.
+    - n_stocks (int): The number of stocks. Default is 500.
+    - n_days (int): The number of business days. Default is 500.
+    - batch_size (int): The number of stocks generated at a time. Default is 100.
+    - kwargs: The other arguments of make_stk_daily.
+    """
+    start = kwargs.pop("start", "2004-01-02")
+    seed = kwargs.get("seed", 0)
+    dates = pd.bdate_range(start, periods=n_days)
+    market = np.random.default_rng(seed).normal(0.0003, 0.012, n_days)
+
+    writer = None
+    try:
+        for lo in range(0, n_stocks, batch_size):
+            bars = pd.concat([
+                _stock_bars(i, dates, market, **kwargs)
+                for i in range(lo, min(lo + batch_size, n_stocks))
+            ],
+                             ignore_index=True)
+            table = pa.Table.from_pandas(bars, preserve_index=False)
+            if writer is None:
+                writer = pa.ipc.new_file(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _stock_bars(i,
+                dates,
+                market,
+                listing=0.3,
+                delisting=0.05,
+                suspension_rate=0.002,
+                suspension_length=5,
+                nan_rate=0.001,
+                adj_rate=1.0,
+                seed=0):
+    """
+    Generate the bars of the i-th stock.
+    """
+    rng = np.random.default_rng([seed, i + 1])
+    n_days = len(dates)
+
+    beta = rng.uniform(0.5, 1.5)
+    noise = rng.normal(0, rng.uniform(0.01, 0.03), n_days)
+    # Mean-reverting idiosyncratic returns
+    idio = noise - 0.05 * np.concatenate([[0], noise[:-1]])
+    returns = beta * market + idio
+    close_adj = rng.uniform(5, 50) * np.exp(np.cumsum(returns))
+
+    # Dividends and splits raise cumadj and lower the raw price by the same ratio
+    jumps = rng.random(n_days) < adj_rate / 252
+    jumps[0] = False
+    ratios = np.where(jumps, 1 + rng.choice([0.02, 0.1, 0.5, 1.0], n_days), 1)
+    cumadj = np.cumprod(ratios)
+    close = close_adj / cumadj
+
+    spread = np.abs(rng.normal(0, 0.01, (3, n_days)))
+    open_ = close * np.exp(rng.normal(0, 0.005, n_days))
+    high = np.maximum(open_, close) * (1 + spread[0])
+    low = np.minimum(open_, close) * (1 - spread[1])
+    volume = np.round(rng.lognormal(13, 1, n_days) * (1 + 20 * np.abs(idio)))
+    amount = volume * (open_ + close) / 2
+
+    keep = np.ones(n_days, dtype=bool)
+    if rng.random() < listing:
+        keep[:rng.integers(1, n_days)] = False
+    if rng.random() < delisting:
+        keep[rng.integers(1, n_days):] = False
+    for day in np.flatnonzero(rng.random(n_days) < suspension_rate):
+        keep[day:day + rng.geometric(1 / suspension_length)] = False
+
+    values = np.stack([open_, high, low, close, volume])
+    values[rng.random(values.shape) < nan_rate] = np.nan
+    open_, high, low, close, volume = values
+
+    return pd.DataFrame({
+        INSTRUMENT_ID: "%06d" % i,
+        DATE_ID: dates,
+        "open": open_,
+        "high": high,
+        "low": low,
+        "close": close,
+        "volume": volume,
+        "amount": amount,
+        "cumadj": cumadj,
+    })[keep]
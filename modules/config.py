@@ -3,3 +3,6 @@ DATE_ID = "date"
 INSTRUMENT_ID = "stk_id"
 
 FACTOR_PATH = "./newdata"
+
+CACHE_PATH = "./newdata/cache"
+CACHE_SIZE = 10 * 1024**3
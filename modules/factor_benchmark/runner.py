@@ -0,0 +1,144 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ..backtest.backtrader import BackTrader
+from ..backtest.strategy import TopKStrategy
+from ..config import DATE_ID, INSTRUMENT_ID
+from ..utils import attach_array, share_array
+from .utils import batched_corr, calc_summary, rank_transform
+
+# Per-process state set up by _init_worker
+_worker_state = {}
+
+
+def _init_worker(arrays, coords, market_return, strategy, fee, test_samples):
+    """
+    Set up the shared returns and ranked returns of a benchmark worker.
+
+    Parameters:
+    arrays (dict): The returns and ranked returns, either as arrays or as
+    shared memory specs.
+    coords (dict): The date and stk_id coordinates of the arrays.
+    market_return (numpy.ndarray): The market returns.
+    strategy (BaseStrategy): The backtest strategy.
+    fee (float): The transaction fee of the fee backtest.
+    test_samples (int): The number of most recent dates to evaluate.
+    """
+    for key, array in arrays.items():
+        if isinstance(array, tuple):
+            shm, array = attach_array(array)
+            # Keep the block open for as long as the view is used
+            _worker_state[key + "_shm"] = shm
+        _worker_state[key] = xr.DataArray(array,
+                                          coords=coords,
+                                          dims=(DATE_ID, INSTRUMENT_ID))
+
+    _worker_state.update(market_return=market_return,
+                         backtrader_nofee=BackTrader(strategy, 0),
+                         backtrader=BackTrader(strategy, fee),
+                         test_samples=test_samples)
+
+
+def _benchmark_factor(name, values):
+    """
+    Compute the IC series, backtests and summary metrics of one factor.
+
+    Parameters:
+    name (str): The factor name.
+    values (numpy.ndarray): The (date, stk_id) factor values.
+
+    Returns:
+    dict: The summary metrics of the factor.
+    """
+    returns = _worker_state["returns"]
+    signals = returns.copy(data=values)
+
+    rank_ic = batched_corr(
+        rank_transform(signals).values, _worker_state["returns_rank"].values)
+    pearson_corr = batched_corr(values, returns.values)
+
+    portfolio_return_nofee = np.asarray(
+        _worker_state["backtrader_nofee"].backtest_vectorized(
+            signals, returns))
+    portfolio_return = np.asarray(
+        _worker_state["backtrader"].backtest_vectorized(signals, returns))
+
+    summary = calc_summary(portfolio_return_nofee, portfolio_return,
+                           _worker_state["market_return"], rank_ic,
+                           pearson_corr, _worker_state["test_samples"])
+    return {"factor": name, **summary}
+
+
+def benchmark_factors(factors,
+                      returns,
+                      strategy=None,
+                      fee=0.0006,
+                      test_samples=252,
+                      n_jobs=None):
+    """
+    Benchmark every factor of a Dataset in a process pool.
+
+    The returns and ranked returns are placed in shared memory once, so they are
+    not pickled for every worker or task. Each factor is used as the signal as
+    is; negate it beforehand for reversal factors.
+
+    Parameters:
+    factors (xarray.Dataset): The factors data.
+    returns (xarray.DataArray): The returns data.
+    strategy (BaseStrategy): The backtest strategy, default is TopKStrategy(k=5).
+    fee (float): The transaction fee of the fee backtest, default is 0.0006.
+    test_samples (int): The number of most recent dates to evaluate.
+    n_jobs (int): The number of worker processes, default is the CPU count.
+    1 runs everything in the current process.
+
+    Returns:
+    pandas.DataFrame: The calc_summary metrics of each factor, indexed by factor.
+    """
+    strategy = TopKStrategy(k=5) if strategy is None else strategy
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+
+    returns = returns.transpose(DATE_ID, INSTRUMENT_ID)
+    factors = factors.reindex_like(returns).transpose(DATE_ID, INSTRUMENT_ID)
+
+    arrays = {
+        "returns": np.ascontiguousarray(returns.values),
+        "returns_rank": np.ascontiguousarray(rank_transform(returns).values),
+    }
+    coords = {
+        DATE_ID: returns[DATE_ID].values,
+        INSTRUMENT_ID: returns[INSTRUMENT_ID].values
+    }
+    market_return = returns.mean(dim=INSTRUMENT_ID).values
+    initargs = (market_return, strategy, fee, test_samples)
+
+    if n_jobs == 1:
+        _init_worker(arrays, coords, *initargs)
+        results = [
+            _benchmark_factor(name, factors[name].values)
+            for name in factors.data_vars
+        ]
+        return pd.DataFrame(results).set_index("factor")
+
+    shms, specs = {}, {}
+    for key, array in arrays.items():
+        shms[key], specs[key] = share_array(array)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(specs, coords,
+                                           *initargs)) as executor:
+            futures = [
+                executor.submit(_benchmark_factor, name, factors[name].values)
+                for name in factors.data_vars
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    return pd.DataFrame(results).set_index("factor")
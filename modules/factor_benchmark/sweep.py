@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+from ..backtest.backtrader import BackTrader
+from ..backtest.strategy import quantile_count
+from ..config import DATE_ID, INSTRUMENT_ID
+from .utils import batched_corr, calc_summary, rank_transform
+
+
+def sweep_topk(signals,
+               returns,
+               ks=(5, 10, 20),
+               fees=(0.0006, ),
+               rebalance_every=(1, ),
+               drift=False,
+               test_samples=252):
+    """
+    Backtest a TopKStrategy over a grid of k, fee and rebalance frequency.
+
+    The stocks of each date are sorted by signal once, and the holdings of
+    every k are read from that order, so they are the same as
+    TopKStrategy(k).get_positions. The flat fee only scales the turnover, so
+    the holdings of each (k, rebalance_every) are simulated once for all fees.
+
+    Parameters:
+    signals (xarray.DataArray): The signal data.
+    returns (xarray.DataArray): The returns data.
+    ks (list): The percentages of stocks to hold.
+    fees (list): The transaction fees.
+    rebalance_every (list): The rebalance frequencies, in dates with signal.
+    drift (bool): Drift the holdings by the stock returns between trades, default is False.
+    test_samples (int): The number of most recent dates to evaluate.
+
+    Returns:
+    pandas.DataFrame: The calc_summary metrics of each grid point, indexed by
+    (k, fee, rebalance_every). The metrics without fee are those of the same
+    k and rebalance frequency.
+    """
+    returns = returns.transpose(DATE_ID, INSTRUMENT_ID)
+    signals = signals.reindex_like(returns).transpose(DATE_ID, INSTRUMENT_ID)
+    values = signals.values
+    valid = ~np.isnan(values)
+    n_valid = valid.sum(axis=1)
+
+    # Place of every stock in the descending order of its date, ties in stock order
+    order = np.argsort(np.where(valid, -values, np.inf), axis=1, kind="stable")
+    place = np.empty_like(order)
+    np.put_along_axis(place,
+                      order,
+                      np.arange(values.shape[1])[None, :],
+                      axis=1)
+    del order
+
+    rank_ic = batched_corr(
+        rank_transform(signals).values,
+        rank_transform(returns).values)
+    pearson_corr = batched_corr(values, returns.values)
+    market_return = returns.mean(dim=INSTRUMENT_ID).values
+
+    results = []
+    for k in ks:
+        counts = quantile_count(k, n_valid)[:, None]
+        positions = signals.copy(data=np.where(
+            n_valid[:, None] > 0, (place < counts) / np.maximum(counts, 1),
+            np.nan))
+        for every in rebalance_every:
+            backtrader = BackTrader(None, 0, drift=drift, rebalance_every=every)
+            portfolio_return_nofee = np.asarray(
+                backtrader.backtest_positions(positions, returns))
+            turnover = np.asarray(backtrader.turnover)
+            for fee in fees:
+                summary = calc_summary(portfolio_return_nofee,
+                                       portfolio_return_nofee - fee * turnover,
+                                       market_return, rank_ic, pearson_corr,
+                                       test_samples)
+                results.append({
+                    "k": k,
+                    "fee": fee,
+                    "rebalance_every": every,
+                    **summary
+                })
+
+    return pd.DataFrame(results).set_index(["k", "fee", "rebalance_every"])
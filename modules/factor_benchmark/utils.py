@@ -3,8 +3,11 @@ import pandas as pd
 import xarray as xr
 from IPython.core.display import display
 
+from ..config import DATE_ID, INSTRUMENT_ID
+from ..factor_construction.compute_engine import ComputeEngine
+
 # Function to transform the factor by ranking the values
-rank_transform = lambda feature: feature.rank('stk_id')
+rank_transform = lambda feature: ComputeEngine.rank(feature, INSTRUMENT_ID)
 
 # Function to transform the returns by keeping the same values
 id_transform = lambda x: x
@@ -47,6 +50,70 @@ def calc_relationship(factor, returns, transform_factor, transform_returns,
     return result
 
 
+def batched_corr(x, y):
+    """
+    Calculate the NaN-aware Pearson correlation between every row of two 2-D arrays.
+
+    Parameters:
+    x (numpy.ndarray): The (date, stk_id) array of the first variable.
+    y (numpy.ndarray): The (date, stk_id) array of the second variable.
+
+    Returns:
+    numpy.ndarray: The correlation of each row, NaN where fewer than two pairs are valid.
+    """
+    mask = ~(np.isnan(x) | np.isnan(y))
+    count = mask.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(mask, x, 0).sum(axis=1) / count
+        y_mean = np.where(mask, y, 0).sum(axis=1) / count
+        x_dev = np.where(mask, x - x_mean[:, None], 0)
+        y_dev = np.where(mask, y - y_mean[:, None], 0)
+        corr = (x_dev * y_dev).sum(axis=1) / np.sqrt(
+            (x_dev**2).sum(axis=1) * (y_dev**2).sum(axis=1))
+
+    corr[count < 2] = np.nan
+    return corr
+
+
+def calc_ic(factors, returns, method='spearman'):
+    """
+    Calculate the IC series between factors and returns for all dates in one pass.
+
+    Gives the same values as calc_rank_ic / calc_pearson_corr. When a Dataset is
+    passed, the returns are transformed only once and shared by all factors.
+
+    Parameters:
+    factors (xarray.DataArray or xarray.Dataset): The factor data.
+    returns (xarray.DataArray): The returns data.
+    method (str): 'spearman' for rank IC or 'pearson' for Pearson correlation.
+
+    Returns:
+    list or pandas.DataFrame: The IC values of a single factor, or a (date, factor)
+    table of IC values when factors is a Dataset.
+    """
+    if method == 'spearman':
+        transform = rank_transform
+    elif method == 'pearson':
+        transform = id_transform
+    else:
+        raise ValueError(f"Unknown correlation method: {method}")
+
+    return_feat = transform(returns).transpose(DATE_ID, INSTRUMENT_ID)
+
+    def _calc(factor):
+        factor_feat = transform(factor).reindex_like(return_feat).transpose(
+            DATE_ID, INSTRUMENT_ID)
+        return batched_corr(factor_feat.values, return_feat.values)
+
+    if isinstance(factors, xr.DataArray):
+        return _calc(factors).tolist()
+
+    return pd.DataFrame({name: _calc(factors[name])
+                         for name in factors.data_vars},
+                        index=returns[DATE_ID].values)
+
+
 def calc_rank_ic(factor, returns):
     """
     Calculate the rank IC (Information Coefficient) between a factor and returns.
@@ -58,8 +125,7 @@ def calc_rank_ic(factor, returns):
     Returns:
     list: The list of calculated rank IC values.
     """
-    return calc_relationship(factor, returns, rank_transform, rank_transform,
-                             corr_score)
+    return calc_ic(factor, returns, 'spearman')
 
 
 def calc_pearson_corr(factor, returns):
@@ -73,8 +139,54 @@ def calc_pearson_corr(factor, returns):
     Returns:
     list: The list of calculated Pearson correlation values.
     """
-    return calc_relationship(factor, returns, id_transform, id_transform,
-                             corr_score)
+    return calc_ic(factor, returns, 'pearson')
+
+
+def calc_summary(portfolio_return_nofee,
+                 portfolio_return,
+                 market_return,
+                 rank_ic,
+                 pearson_corr,
+                 test_samples=252):
+    """
+    Calculate the summary metrics of a backtest without displaying them.
+
+    Parameters:
+    portfolio_return_nofee (list): The portfolio returns without fee.
+    portfolio_return (list): The portfolio returns with fee.
+    market_return (xarray.DataArray): The market returns.
+    rank_ic (list): The list of calculated rank IC values.
+    pearson_corr (list): The list of calculated Pearson correlation values.
+    test_samples (int): The number of most recent dates to evaluate.
+
+    Returns:
+    dict: The metrics shown by make_summary, portfolio metrics suffixed with
+    the fee setting, e.g. '年化收益率 (有手续费)'.
+    """
+    summary = {
+        '平均 Pearson 相关系数': np.nanmean(pearson_corr[-test_samples:]),
+        '平均 Spearman 秩相关系数': np.nanmean(rank_ic[-test_samples:]),
+    }
+
+    market_mean = np.nanmean(market_return[-test_samples:])
+    for label, _return in [('无手续费', portfolio_return_nofee),
+                           ('有手续费', portfolio_return)]:
+        _return = _return[-test_samples:]
+        portfolio = np.cumsum(_return)
+        summary.update({
+            '年化收益率 (%s)' % label:
+            np.nanmean(_return) * 252,
+            '年化波动率 (%s)' % label:
+            np.nanstd(_return) * np.sqrt(252),
+            '年化夏普比率 (%s)' % label:
+            np.nanmean(_return) / np.nanstd(_return) * np.sqrt(252),
+            '测试期年化超额收益 (%s)' % label:
+            (np.nanmean(_return) - market_mean) * 252,
+            '测试期最大回撤 (%s)' % label:
+            np.min(portfolio - np.maximum.accumulate(portfolio)),
+        })
+
+    return summary
 
 
 def make_summary(portfolio_return_nofee,
@@ -93,46 +205,28 @@ def make_summary(portfolio_return_nofee,
     Returns:
     pandas.DataFrame: The summary of the rank IC and Pearson correlation.
     """
+    summary = calc_summary(portfolio_return_nofee, portfolio_return,
+                           market_return, rank_ic, pearson_corr, test_samples)
+
     display(
         pd.DataFrame(
             {
-                '平均 Pearson 相关系数': np.nanmean(pearson_corr[-test_samples:]),
-                '平均 Spearman 秩相关系数': np.nanmean(rank_ic[-test_samples:]),
+                '平均 Pearson 相关系数': summary['平均 Pearson 相关系数'],
+                '平均 Spearman 秩相关系数': summary['平均 Spearman 秩相关系数'],
             },
             index=["统计量 (test samples = %d)" % test_samples]))
 
-    portfolio_nofee = np.cumsum(portfolio_return_nofee[-test_samples:])
-    portfolio = np.cumsum(portfolio_return[-test_samples:])
-
     display(
         pd.DataFrame(
             {
-                '年化收益率': [
-                    np.nanmean(portfolio_return_nofee[-test_samples:]) * 252,
-                    np.nanmean(portfolio_return[-test_samples:]) * 252
-                ],
-                '年化波动率': [
-                    np.nanstd(portfolio_return_nofee[-test_samples:]) *
-                    np.sqrt(252),
-                    np.nanstd(portfolio_return[-test_samples:]) * np.sqrt(252)
-                ],
-                '年化夏普比率': [
-                    np.nanmean(portfolio_return_nofee[-test_samples:]) /
-                    np.nanstd(portfolio_return_nofee[-test_samples:]) *
-                    np.sqrt(252),
-                    np.nanmean(portfolio_return[-test_samples:]) /
-                    np.nanstd(portfolio_return[-test_samples:]) * np.sqrt(252)
-                ],
-                '测试期年化超额收益':
-                [(np.nanmean(portfolio_return_nofee[-test_samples:]) -
-                  np.nanmean(market_return[-test_samples:])) * 252,
-                 (np.nanmean(portfolio_return[-test_samples:]) -
-                  np.nanmean(market_return[-test_samples:])) * 252],
-                '测试期最大回撤': [
-                    np.min(portfolio_nofee -
-                           np.maximum.accumulate(portfolio_nofee)),
-                    np.min(portfolio - np.maximum.accumulate(portfolio))
-                ],
+                metric: [
+                    summary['%s (无手续费)' % metric],
+                    summary['%s (有手续费)' % metric]
+                ]
+                for metric in [
+                    '年化收益率', '年化波动率', '年化夏普比率', '测试期年化超额收益',
+                    '测试期最大回撤'
+                ]
             },
             index=[
                 "无手续费 (test samples = %d)" % test_samples,
@@ -0,0 +1,247 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.linear_model import lasso_path
+from sklearn.preprocessing import StandardScaler
+
+from ..utils import attach_array, share_array
+from ..profiling import traced
+
+# Per-process state set up by _init_worker
+_worker_state = {}
+
+
+class PurgedDateKFold(object):
+    """
+    K-fold cross-validation over contiguous blocks of dates.
+
+    All the rows of a date are in the same fold, and the `purge` dates before
+    and after each test block are left out of its training set, so features
+    and returns spanning several dates do not leak between them. It follows
+    the scikit-learn splitter interface, with the date of each row as groups.
+
+    Parameters:
+    - n_splits: The number of folds.
+    - purge: The number of dates dropped from training on each side of a test block.
+    """
+
+    def __init__(self, n_splits=5, purge=1):
+        self.n_splits = n_splits
+        self.purge = purge
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits
+
+    def date_folds(self, n_dates):
+        """
+        Get the date ranges of every fold.
+
+        Parameters:
+        - n_dates: The number of dates.
+
+        Returns:
+        - list: The (test, train) ranges of each fold, where test is a
+        (start, stop) range of date positions and train a list of them.
+        """
+        if n_dates < self.n_splits:
+            raise ValueError(
+                "Cannot split %d dates into %d folds" % (n_dates, self.n_splits))
+        bounds = np.linspace(0, n_dates, self.n_splits + 1).astype(int)
+        folds = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            train = [(0, max(start - self.purge, 0)),
+                     (min(stop + self.purge, n_dates), n_dates)]
+            folds.append(((start, stop),
+                          [(lo, hi) for lo, hi in train if lo < hi]))
+        return folds
+
+    def split(self, X, y=None, groups=None):
+        """
+        Generate the train and test row indices of every fold.
+
+        Parameters:
+        - X: The features.
+        - y: Ignored.
+        - groups: The date of each row.
+
+        Yields:
+        - tuple: The train and test row indices.
+        """
+        if groups is None:
+            raise ValueError("PurgedDateKFold needs the date of each row as groups")
+        _, codes = np.unique(groups, return_inverse=True)
+        for (start, stop), train in self.date_folds(codes.max() + 1):
+            test_rows = (codes >= start) & (codes < stop)
+            train_rows = np.zeros(len(codes), dtype=bool)
+            for lo, hi in train:
+                train_rows |= (codes >= lo) & (codes < hi)
+            yield np.flatnonzero(train_rows), np.flatnonzero(test_rows)
+
+
+class _PathModel(RegressorMixin, BaseEstimator):
+    """
+    A linear model of standardized features, from one point of a Lasso path,
+    scored on features that are already standardized.
+
+    Parameters:
+    - coef: The coefficients.
+    - intercept: The intercept.
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef = coef
+        self.intercept = intercept
+
+    def predict(self, X):
+        return X @ self.coef + self.intercept
+
+
+def _alpha_grid(X, y, n_alphas, eps=1e-3):
+    """
+    Get the Lasso alphas of standardized features, from the smallest alpha with
+    all-zero coefficients down to eps times it, as in LassoCV.
+    """
+    std = X.std(axis=0, dtype=np.float64)
+    std[std == 0] = 1.0
+    alpha_max = np.abs(X.T @ (y - y.mean()).astype(X.dtype) / std).max() / len(y)
+    return np.logspace(np.log10(alpha_max), np.log10(alpha_max * eps),
+                       n_alphas)
+
+
+def _init_worker(arrays):
+    """
+    Set up the shared design matrix of a cross-validation worker.
+
+    Parameters:
+    arrays (dict): The features and target, sorted by date, either as arrays
+    or as shared memory specs.
+    """
+    for key, array in arrays.items():
+        if isinstance(array, tuple):
+            shm, array = attach_array(array)
+            # Keep the block open for as long as the view is used
+            _worker_state[key + "_shm"] = shm
+        _worker_state[key] = array
+
+
+def _score_alphas(test, train, alphas, scorer, tol):
+    """
+    Fit a standardized Lasso on the training rows along the alpha path, with
+    warm starts from one alpha to the next, and score each fit on the test rows.
+
+    Parameters:
+    test (tuple): The (start, stop) range of test rows.
+    train (list): The (start, stop) ranges of training rows.
+    alphas (numpy.ndarray): The decreasing alphas.
+    scorer: The scoring function, called as scorer(estimator, X, y).
+    tol (float): The tolerance of the Lasso.
+
+    Returns:
+    list: The test score of each alpha.
+    """
+    X, y = _worker_state["X"], _worker_state["y"]
+    X_train = np.concatenate([X[lo:hi] for lo, hi in train], dtype=np.float64)
+    y_train = np.concatenate([y[lo:hi] for lo, hi in train], dtype=np.float64)
+
+    scaler = StandardScaler().fit(X_train)
+    X_train = np.asfortranarray(scaler.transform(X_train))
+    y_mean = y_train.mean()
+    y_train = y_train - y_mean
+
+    # Solve the whole path at once on the Gram matrix shared by every alpha
+    _, coefs, _ = lasso_path(X_train,
+                             y_train,
+                             alphas=alphas,
+                             precompute=X_train.T @ X_train,
+                             Xy=X_train.T @ y_train,
+                             copy_X=False,
+                             tol=tol)
+
+    # Standardize the test rows once, and predict with each alpha's coefficients
+    X_test = scaler.transform(np.asarray(X[test[0]:test[1]], dtype=np.float64))
+    y_test = y[test[0]:test[1]]
+    return [
+        scorer(_PathModel(coef, y_mean), X_test, y_test) for coef in coefs.T
+    ]
+
+
+@traced(category="fit")
+def cross_validate_alpha(X,
+                         y,
+                         dates,
+                         scorer,
+                         cv=None,
+                         n_alphas=100,
+                         tol=1e-4,
+                         n_jobs=None):
+    """
+    Choose the alpha of a standardized Lasso by cross-validation over dates.
+
+    The design matrix is sorted by date if needed and placed in shared memory
+    once, in its own dtype, so each fold is a range of rows, and the folds x
+    alpha grid is run in a process pool: every task fits a chunk of the alpha
+    path of one fold in float64.
+
+    Parameters:
+    X (numpy.ndarray): The features.
+    y (numpy.ndarray): The target.
+    dates (numpy.ndarray): The date of each row.
+    scorer: The scoring function, called as scorer(estimator, X, y); greater is better.
+    cv (PurgedDateKFold): The date folds. Default is PurgedDateKFold(5).
+    n_alphas (int): The number of alphas. Default is 100.
+    tol (float): The tolerance of the Lasso. Default is 1e-4.
+    n_jobs (int): The number of worker processes, default is the CPU count.
+    1 runs everything in the current process.
+
+    Returns:
+    tuple: The best alpha, and the scores of each alpha (rows) and fold (columns).
+    """
+    cv = PurgedDateKFold() if cv is None else cv
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+
+    X, y, dates = np.asarray(X), np.asarray(y), np.asarray(dates)
+    if (dates[1:] < dates[:-1]).any():
+        order = np.argsort(dates, kind="stable")
+        X, y, dates = X[order], y[order], dates[order]
+    _, codes = np.unique(dates, return_inverse=True)
+    arrays = {"X": np.ascontiguousarray(X), "y": np.ascontiguousarray(y)}
+    alphas = _alpha_grid(arrays["X"], arrays["y"], n_alphas)
+
+    # Split each fold's alpha path so that there are about n_jobs tasks
+    n_chunks = -(-n_jobs // cv.get_n_splits())
+    tasks = []
+    for (start, stop), train in cv.date_folds(codes.max() + 1):
+        test_rows = tuple(np.searchsorted(codes, (start, stop)))
+        train_rows = [tuple(np.searchsorted(codes, bounds)) for bounds in train]
+        for chunk in np.array_split(np.arange(n_alphas), n_chunks):
+            if len(chunk):
+                tasks.append((test_rows, train_rows, alphas[chunk]))
+
+    if n_jobs == 1:
+        _init_worker(arrays)
+        results = [_score_alphas(*task, scorer, tol) for task in tasks]
+    else:
+        shms, specs = {}, {}
+        for key, array in arrays.items():
+            shms[key], specs[key] = share_array(array)
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_worker,
+                                     initargs=(specs, )) as executor:
+                futures = [
+                    executor.submit(_score_alphas, *task, scorer, tol)
+                    for task in tasks
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            for shm in shms.values():
+                shm.close()
+                shm.unlink()
+
+    scores = np.concatenate(results).reshape(cv.get_n_splits(), n_alphas).T
+    scores = pd.DataFrame(scores, index=pd.Index(alphas, name="alpha"))
+    return scores.index[np.argmax(scores.mean(axis=1))], scores
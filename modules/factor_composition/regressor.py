@@ -1,9 +1,67 @@
 from abc import ABC, abstractmethod
-from sklearn.linear_model import LassoCV
+
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.linear_model import Lasso
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import GridSearchCV
 
+from ..profiling import traced
+from .cv import PurgedDateKFold, cross_validate_alpha
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _descend(gram, xy, alpha, coef, eps, max_iter):
+    """
+    Lasso coordinate descent on standardized features; gram has a unit
+    diagonal, so each update is a soft thresholding.
+    """
+    residual = xy - gram @ coef
+    for _ in range(max_iter):
+        delta = 0.0
+        for j in range(len(coef)):
+            rho = residual[j] + coef[j]
+            new = np.sign(rho) * max(abs(rho) - alpha, 0.0)
+            if new != coef[j]:
+                residual -= gram[:, j] * (new - coef[j])
+                delta = max(delta, abs(new - coef[j]))
+                coef[j] = new
+        if delta < eps:
+            break
+    return coef
+
+
+if numba is not None:
+    _descend = numba.njit(cache=True)(_descend)
+
+
+def _standardize(stats):
+    """
+    Get the correlation matrix of the features, their correlation with
+    the target, and the means and standard deviations of both.
+    """
+    n = max(stats["n"], 1)
+    mean_x, mean_y = stats["sx"] / n, stats["sy"] / n
+    cov = stats["sxx"] / n - np.outer(mean_x, mean_x)
+    cov_xy = stats["sxy"] / n - mean_x * mean_y
+    std_x = np.sqrt(np.maximum(np.diag(cov), 0))
+    std_y = np.sqrt(max(stats["syy"] / n - mean_y**2, 0)) or 1.0
+
+    # Constant features get a zero column and are never selected
+    constant = std_x == 0
+    std_x[constant] = 1.0
+    gram = cov / np.outer(std_x, std_x)
+    gram[constant] = 0
+    gram[:, constant] = 0
+    gram[np.diag_indices_from(gram)] = 1.0
+    xy = np.where(constant, 0, cov_xy / std_x / std_y)
+    return gram, xy, (mean_x, mean_y), (std_x, std_y)
+
 
 class BaseRegressor(ABC):
 
@@ -23,10 +81,13 @@ class LassoRegressor(BaseRegressor):
     Parameters:
     - scorer: The scoring function used for model evaluation.
     - k: The number of folds for cross-validation.
+    - purge: The number of dates dropped from training around each validation fold.
+    - n_jobs: The number of processes for cross-validation, default is the CPU count.
 
     Attributes:
     - eps: A small value used for numerical stability.
     - estimator: The fitted Lasso regression model.
+    - cv_scores: The cross-validation scores of each alpha and fold.
 
     Methods:
     - fit(train_dataset): Fit the Lasso regression model to the training dataset.
@@ -35,12 +96,16 @@ class LassoRegressor(BaseRegressor):
 
     eps = 1e-6
 
-    def __init__(self, scorer, k):
+    def __init__(self, scorer, k, purge=1, n_jobs=None):
         # Initialize the LassoRegressor object
         self.scorer = scorer
         self.k = k
+        self.purge = purge
+        self.n_jobs = n_jobs
         self.estimator = None
+        self.cv_scores = None
 
+    @traced(category="fit")
     def fit(self, train_dataset):
         """
         Fit the Lasso regression model to the training dataset.
@@ -51,14 +116,23 @@ class LassoRegressor(BaseRegressor):
         Returns:
         None
         """
+        X, y = train_dataset.X, train_dataset.y
+
+        # Choose alpha by cross-validation over blocks of dates
+        alpha, self.cv_scores = cross_validate_alpha(
+            X,
+            y,
+            train_dataset.row_dates,
+            self.scorer,
+            PurgedDateKFold(self.k, self.purge),
+            tol=self.eps,
+            n_jobs=self.n_jobs)
+
         # Create a pipeline with feature scaling and Lasso regression model
         pipe = Pipeline([('scaler', StandardScaler()),
-                         ('model', LassoCV(tol=self.eps, n_jobs=-1,
-                                           cv=self.k))])
-
-        # Perform grid search with cross-validation
-        pipe.fit(train_dataset.drop(columns=['RETURN']),
-                 train_dataset['RETURN'])
+                         ('model', Lasso(alpha=alpha, tol=self.eps))])
+        # Fit in float64, the tolerance is below float32 precision
+        pipe.fit(X.astype(np.float64), y)
 
         # Save the fitted model
         self.estimator = pipe
@@ -73,4 +147,412 @@ class LassoRegressor(BaseRegressor):
         Returns:
         - predictions: The predicted target variable values.
         """
-        return self.estimator.predict(test_dataset.drop(columns=['RETURN']))
+        return self.estimator.predict(test_dataset.X)
+
+
+class WalkForwardLassoRegressor(BaseRegressor):
+    """
+    WalkForwardLassoRegressor is a Lasso regression model that is cheap to
+    retrain as the training window moves forward.
+
+    The model is fitted from the sufficient statistics (counts, sums, X'X and
+    X'y) of each training date instead of the rows, so moving the window only
+    adds the statistics of the new dates and drops those of the oldest ones.
+    The alpha is chosen by K-fold cross-validation over contiguous blocks of
+    dates, computed from the same statistics, and every refit starts from the
+    coefficients of the previous fit on the previous alpha path.
+
+    Parameters:
+    - k: The number of date-blocked folds for cross-validation.
+    - n_alphas: The number of alphas on the regularization path.
+    - alpha_ratio: The ratio of the smallest to the largest alpha.
+    - max_iter: The maximum number of coordinate descent sweeps per alpha.
+
+    Attributes:
+    - eps: The tolerance on the coefficient updates (of standardized features).
+    - alphas: The regularization path, reused while it covers the data.
+    - alpha_: The alpha selected by cross-validation.
+    - coef_, intercept_: The fitted model on the original feature scale.
+
+    Methods:
+    - fit(train_dataset): Fit the model to a training DesignMatrix.
+    - update(X, y): Add training dates, as (date, stk_id, feature) and (date, stk_id) arrays.
+    - drop(n_dates): Remove the oldest training dates.
+    - refit(): Refit the model on the current training dates.
+    - predict(test_dataset): Make predictions on a test DesignMatrix.
+    - predict_array(X): Make predictions on a (date, stk_id, feature) array.
+    """
+
+    eps = 1e-6
+
+    def __init__(self, k=5, n_alphas=100, alpha_ratio=1e-3, max_iter=1000):
+        self.k = k
+        self.n_alphas = n_alphas
+        self.alpha_ratio = alpha_ratio
+        self.max_iter = max_iter
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the training dates and the warm starts.
+        """
+        self.stats = None
+        self.ref = None
+        self.alphas = None
+        self.path = None
+        self.fold_paths = [None] * self.k
+        self.alpha_ = None
+        self.coef_ = None
+        self.intercept_ = None
+
+    @traced(category="fit")
+    def fit(self, train_dataset):
+        """
+        Fit the model to the training dataset.
+
+        Parameters:
+        - train_dataset: The training DesignMatrix.
+
+        Returns:
+        None
+        """
+        self.reset()
+        # Rows are ordered by date
+        bounds = np.flatnonzero(np.diff(train_dataset.date_idx)) + 1
+        for X, y in zip(np.split(train_dataset.X, bounds),
+                        np.split(train_dataset.y, bounds)):
+            self.update(X[None], y[None])
+        self.refit()
+
+    def update(self, X, y):
+        """
+        Add the statistics of new training dates.
+
+        Parameters:
+        - X: The (date, stk_id, feature) array of the features.
+        - y: The (date, stk_id) array of the target.
+        """
+        valid = ~(np.isnan(X).any(axis=-1) | np.isnan(y))
+        if self.ref is None:
+            # Center the sums on the first dates to avoid cancellation
+            self.ref = (np.nan_to_num(X[valid].mean(axis=0)),
+                        np.nan_to_num(y[valid].mean()))
+        X = np.where(valid[..., None], X - self.ref[0], 0)
+        y = np.where(valid, y - self.ref[1], 0)
+        stats = {
+            "n": valid.sum(axis=1),
+            "sx": X.sum(axis=1),
+            "sy": y.sum(axis=1),
+            "sxx": np.einsum("tsp,tsq->tpq", X, X),
+            "sxy": np.einsum("tsp,ts->tp", X, y),
+            "syy": (y**2).sum(axis=1),
+        }
+        if self.stats is None:
+            self.stats = stats
+        else:
+            self.stats = {
+                key: np.concatenate([self.stats[key], value])
+                for key, value in stats.items()
+            }
+
+    def drop(self, n_dates):
+        """
+        Remove the statistics of the oldest training dates.
+
+        Parameters:
+        - n_dates: The number of dates to remove.
+        """
+        self.stats = {key: value[n_dates:] for key, value in self.stats.items()}
+
+    @traced(category="fit")
+    def refit(self):
+        """
+        Refit the model on the current training dates, warm-started from the
+        previous fit.
+
+        Returns:
+        None
+        """
+        n_dates = len(self.stats["n"])
+        total = {key: value.sum(axis=0) for key, value in self.stats.items()}
+        gram, xy, mean, scale = _standardize(total)
+
+        alpha_max = np.abs(xy).max()
+        if self.alphas is None or alpha_max > self.alphas[0]:
+            self.alphas = alpha_max * np.logspace(
+                0, np.log10(self.alpha_ratio), self.n_alphas)
+            self.path = None
+            self.fold_paths = [None] * self.k
+
+        # Cross-validate on contiguous blocks of dates
+        errors = np.zeros(self.n_alphas)
+        bounds = np.linspace(0, n_dates, self.k + 1).astype(int)
+        for i in range(self.k):
+            fold = {
+                key: value[bounds[i]:bounds[i + 1]].sum(axis=0)
+                for key, value in self.stats.items()
+            }
+            train = {key: total[key] - fold[key] for key in total}
+            fold_gram, fold_xy, fold_mean, fold_scale = _standardize(
+                train)
+            self.fold_paths[i] = self._path(fold_gram, fold_xy,
+                                            self.fold_paths[i])
+            errors += self._squared_errors(fold, self.fold_paths[i],
+                                           fold_mean, fold_scale)
+
+        self.path = self._path(gram, xy, self.path)
+        best = np.argmin(errors)
+        self.alpha_ = self.alphas[best]
+        coef = self.path[best] * scale[1] / scale[0]
+        self.coef_ = coef
+        self.intercept_ = (mean[1] + self.ref[1] -
+                           (mean[0] + self.ref[0]) @ coef)
+
+    def predict(self, test_dataset):
+        """
+        Make predictions on the test dataset.
+
+        Parameters:
+        - test_dataset: The test DesignMatrix.
+
+        Returns:
+        - predictions: The predicted target variable values.
+        """
+        return test_dataset.X @ self.coef_ + self.intercept_
+
+    def predict_array(self, X):
+        """
+        Make predictions on a (date, stk_id, feature) array.
+
+        Parameters:
+        - X: The features.
+
+        Returns:
+        - predictions: The (date, stk_id) predictions, NaN where a feature is missing.
+        """
+        return X @ self.coef_ + self.intercept_
+
+    def _path(self, gram, xy, init):
+        """
+        Solve the Lasso for every alpha by coordinate descent, starting from
+        the previous path if any, else from the solution of the previous alpha.
+        """
+        path = np.empty((self.n_alphas, len(xy)))
+        coef = np.zeros(len(xy))
+        for i, alpha in enumerate(self.alphas):
+            if init is not None:
+                coef = init[i].copy()
+            path[i] = coef = _descend(gram, xy, alpha, coef, self.eps,
+                                      self.max_iter)
+        return path
+
+    @staticmethod
+    def _squared_errors(stats, path, mean, scale):
+        """
+        Sum of squared errors on held-out dates of every coefficient vector of
+        a standardized path, from the statistics of those dates.
+        """
+        coef = path * scale[1] / scale[0]
+        intercept = mean[1] - coef @ mean[0]
+        return (stats["syy"] - 2 * intercept * stats["sy"] -
+                2 * coef @ stats["sxy"] + stats["n"] * intercept**2 +
+                2 * intercept * (coef @ stats["sx"]) +
+                np.einsum("ap,pq,aq->a", coef, stats["sxx"], coef))
+
+
+class HistGBRegressor(BaseRegressor):
+    """
+    HistGBRegressor is a histogram gradient-boosting model for non-linear signals.
+
+    The model is trained on the float32 arrays of the design matrix, binned to
+    one byte per value, and the most recent training dates, rather than random
+    rows, are held out for early stopping.
+
+    Parameters:
+    - max_iter: The maximum number of boosting iterations.
+    - learning_rate: The shrinkage of each tree.
+    - max_leaf_nodes: The maximum number of leaves of each tree.
+    - min_samples_leaf: The minimum number of rows of each leaf.
+    - validation_size: The fraction of the training dates held out for early stopping; 0 disables it.
+
+    Attributes:
+    - estimator: The fitted HistGradientBoostingRegressor.
+
+    Methods:
+    - fit(train_dataset): Fit the model to a training DesignMatrix.
+    - predict(test_dataset): Make predictions on a test DesignMatrix.
+    """
+
+    def __init__(self,
+                 max_iter=200,
+                 learning_rate=0.05,
+                 max_leaf_nodes=31,
+                 min_samples_leaf=1000,
+                 validation_size=0.2):
+        self.max_iter = max_iter
+        self.learning_rate = learning_rate
+        self.max_leaf_nodes = max_leaf_nodes
+        self.min_samples_leaf = min_samples_leaf
+        self.validation_size = validation_size
+        self.estimator = None
+
+    @traced(category="fit")
+    def fit(self, train_dataset):
+        """
+        Fit the gradient-boosting model to the training dataset.
+
+        Parameters:
+        - train_dataset: The training DesignMatrix.
+
+        Returns:
+        None
+        """
+        X, y = train_dataset.X, train_dataset.y
+
+        # Rows are ordered by date, so the validation dates are the last rows
+        n_train_dates = len(train_dataset.dates) - int(
+            len(train_dataset.dates) * self.validation_size)
+        split = np.searchsorted(train_dataset.date_idx, n_train_dates)
+        early_stopping = split < len(y)
+
+        self.estimator = HistGradientBoostingRegressor(
+            max_iter=self.max_iter,
+            learning_rate=self.learning_rate,
+            max_leaf_nodes=self.max_leaf_nodes,
+            min_samples_leaf=self.min_samples_leaf,
+            early_stopping=early_stopping,
+            random_state=0)
+        if early_stopping:
+            self.estimator.fit(X[:split],
+                               y[:split],
+                               X_val=X[split:],
+                               y_val=y[split:])
+        else:
+            self.estimator.fit(X, y)
+
+    def predict(self, test_dataset):
+        """
+        Make predictions on the test dataset.
+
+        Parameters:
+        - test_dataset: The test DesignMatrix.
+
+        Returns:
+        - predictions: The predicted target variable values.
+        """
+        return self.estimator.predict(test_dataset.X)
+
+
+class IncrementalRidgeRegressor(BaseRegressor):
+    """
+    IncrementalRidgeRegressor is an online linear model: a ridge regression on
+    exponentially weighted sufficient statistics.
+
+    It keeps exponentially weighted sums of the rows (counts, sums, X'X, X'y),
+    decayed by `forgetting` at every new date, so partial_fit on a new trading
+    day costs O(rows x features^2) whatever the length of the history, and
+    the coefficients are re-solved from the sums in O(features^3). They are
+    those of a ridge regression on standardized features with the dates
+    weighted towards the most recent ones.
+
+    The penalty applies to the correlation matrix of the features, whose
+    diagonal is 1, so alpha is a fraction of each feature's variance, i.e. a
+    ridge penalty of alpha times the weighted number of rows; the default
+    only stabilizes nearly collinear factors.
+
+    Parameters:
+    - forgetting: The weight decay per date; 1 weighs every date equally.
+    - alpha: The ridge penalty relative to the unit variance of the standardized features.
+
+    Attributes:
+    - stats: The exponentially weighted sums.
+    - coef_, intercept_: The fitted model on the original feature scale.
+
+    Methods:
+    - fit(train_dataset): Fit the model to a training DesignMatrix from scratch.
+    - partial_fit(dataset): Update the model with the dates of a DesignMatrix.
+    - predict(test_dataset): Make predictions on a test DesignMatrix.
+    """
+
+    def __init__(self, forgetting=0.99, alpha=1e-3):
+        self.forgetting = forgetting
+        self.alpha = alpha
+        self.stats = None
+        self.ref = None
+        self.coef_ = None
+        self.intercept_ = None
+
+    @traced(category="fit")
+    def fit(self, train_dataset):
+        """
+        Fit the model to the training dataset from scratch.
+
+        Parameters:
+        - train_dataset: The training DesignMatrix.
+
+        Returns:
+        None
+        """
+        self.stats = None
+        self.ref = None
+        self.partial_fit(train_dataset)
+
+    def partial_fit(self, dataset):
+        """
+        Update the model with new dates, one date at a time.
+
+        Parameters:
+        - dataset: The DesignMatrix of dates after those already seen.
+
+        Returns:
+        None
+        """
+        if len(dataset) == 0:
+            return
+        if self.ref is None:
+            # Center the sums on the first dates to avoid cancellation
+            self.ref = (dataset.X.mean(axis=0, dtype=np.float64),
+                        dataset.y.mean())
+            p = dataset.X.shape[1]
+            self.stats = {
+                "n": 0.0,
+                "sx": np.zeros(p),
+                "sy": 0.0,
+                "sxx": np.zeros((p, p)),
+                "sxy": np.zeros(p),
+                "syy": 0.0,
+            }
+
+        # Rows are ordered by date
+        bounds = np.flatnonzero(np.diff(dataset.date_idx)) + 1
+        for X, y in zip(np.split(dataset.X, bounds),
+                        np.split(dataset.y, bounds)):
+            X = X - self.ref[0]
+            y = y - self.ref[1]
+            stats = self.stats
+            for key in stats:
+                stats[key] *= self.forgetting
+            stats["n"] += len(y)
+            stats["sx"] += X.sum(axis=0)
+            stats["sy"] += y.sum()
+            stats["sxx"] += X.T @ X
+            stats["sxy"] += X.T @ y
+            stats["syy"] += y @ y
+
+        gram, xy, mean, scale = _standardize(self.stats)
+        beta = np.linalg.solve(gram + self.alpha * np.eye(len(xy)), xy)
+        self.coef_ = beta * scale[1] / scale[0]
+        self.intercept_ = (mean[1] + self.ref[1] -
+                           (mean[0] + self.ref[0]) @ self.coef_)
+
+    def predict(self, test_dataset):
+        """
+        Make predictions on the test dataset.
+
+        Parameters:
+        - test_dataset: The test DesignMatrix.
+
+        Returns:
+        - predictions: The predicted target variable values.
+        """
+        return test_dataset.X @ self.coef_ + self.intercept_
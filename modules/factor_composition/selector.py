@@ -1,12 +1,19 @@
 from abc import ABC, abstractmethod
 
 import numpy as np
+import pandas as pd
 
-from sklearn.linear_model import LassoCV
+from sklearn.linear_model import Lasso
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 from sklearn.model_selection import GridSearchCV
 
+from ..config import DATE_ID
+from ..factor_construction import cross_section
+from ..profiling import traced
+from .cv import PurgedDateKFold, cross_validate_alpha
+from .utils import DesignMatrix
+
 
 class BaseSelector(ABC):
     """
@@ -29,18 +36,24 @@ class LassoSelector(BaseSelector):
 
     eps = 1e-8
 
-    def __init__(self, scorer, k):
+    def __init__(self, scorer, k, purge=1, n_jobs=None):
         """
         Initialize the LassoSelector.
 
         Args:
             scorer: Scoring function used for feature selection.
             k: Number of folds for cross-validation.
+            purge: Number of dates dropped from training around each validation fold.
+            n_jobs: Number of processes for cross-validation, default is the CPU count.
         """
         self.scorer = scorer
         self.k = k
+        self.purge = purge
+        self.n_jobs = n_jobs
         self.fitted_result = None
+        self.cv_scores = None
 
+    @traced(category="fit")
     def select(self, train_dataset):
         """
         Select features using Lasso regression.
@@ -51,13 +64,248 @@ class LassoSelector(BaseSelector):
         Returns:
             Boolean array indicating selected features.
         """
+        X, y = train_dataset.X, train_dataset.y
+
+        alpha, self.cv_scores = cross_validate_alpha(
+            X,
+            y,
+            train_dataset.row_dates,
+            self.scorer,
+            PurgedDateKFold(self.k, self.purge),
+            tol=self.eps,
+            n_jobs=self.n_jobs)
+
         pipe = Pipeline([('scaler', StandardScaler()),
-                         ('model', LassoCV(tol=self.eps, n_jobs=-1,
-                                           cv=self.k))])
+                         ('model', Lasso(alpha=alpha, tol=self.eps))])
 
-        pipe.fit(train_dataset.drop(columns=['RETURN']),
-                 train_dataset['RETURN'])
+        # Fit in float64, the tolerance is below float32 precision
+        pipe.fit(X.astype(np.float64), y)
 
         self.fitted_result = pipe
 
         return np.abs(pipe.get_params()["model"].coef_) > self.eps
+
+
+class CorrelationSelector(BaseSelector):
+    """
+    Feature selector keeping the factors with the largest IC that are not
+    redundant with the factors already kept.
+
+    The IC of each factor is the mean over dates of its cross-sectional
+    correlation with the returns, and the redundancy of two factors is their
+    correlation over every (date, stock) pair. Both come from sufficient
+    statistics updated one block of dates at a time: the per-date sums of
+    every date, and the merged means and co-moments of the whole sample.
+    Nothing larger than a block of the design matrix is ever held.
+
+    The IC costs one pass over the rows per factor, while the correlation
+    matrix costs one pass per pair of factors, so with thousands of factors
+    the correlations can be estimated on a random sample of the rows.
+
+    The factors are then picked greedily: each step keeps the candidate with
+    the largest |IC| - redundancy * (its largest |correlation| with the kept
+    factors), among the candidates whose |IC| is at least min_ic and whose
+    correlations with the kept factors are all below max_corr.
+
+    Parameters:
+    - n_features (int, optional): The number of factors to keep. Default is None (every factor that qualifies).
+    - max_corr (float): The largest absolute correlation with a kept factor. Default is 0.7.
+    - min_ic (float): The smallest absolute IC. Default is 0.
+    - redundancy (float): The weight of the redundancy penalty. Default is 0 (pick by IC only).
+    - rank (bool): Use the per-date ranks of the factors and returns, i.e. the rank IC and rank correlations. Default is False.
+    - corr_sample (float): The fraction of the rows used for the correlation matrix. Default is 1 (every row).
+    - random_state (int): The seed of the row sample. Default is 0.
+
+    Attributes:
+    - features: The factor names.
+    - ic_, icir_: The mean IC of each factor and its mean over its standard deviation.
+    - corr_: The factor-factor correlation matrix.
+    - order_: The positions of the kept factors, in the order they were picked.
+    """
+
+    def __init__(self,
+                 n_features=None,
+                 max_corr=0.7,
+                 min_ic=0.0,
+                 redundancy=0.0,
+                 rank=False,
+                 corr_sample=1.0,
+                 random_state=0):
+        self.n_features = n_features
+        self.max_corr = max_corr
+        self.min_ic = min_ic
+        self.redundancy = redundancy
+        self.rank = rank
+        self.corr_sample = corr_sample
+        self.random_state = random_state
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the statistics of every date.
+        """
+        self.features = None
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+        self.ic_sum = None
+        self.ic_sum2 = None
+        self.ic_count = None
+        self.ic_ = None
+        self.icir_ = None
+        self.corr_ = None
+        self.order_ = None
+        self._rng = np.random.default_rng(self.random_state)
+
+    @traced(category="fit")
+    def select(self, train_dataset):
+        """
+        Select the factors of a training dataset.
+
+        Args:
+            train_dataset: Training dataset (DesignMatrix).
+
+        Returns:
+            Boolean array indicating selected features.
+        """
+        self.reset()
+        self.partial_fit(train_dataset)
+        return self.prune()
+
+    @traced(category="fit")
+    def select_dataset(self, factors, returns, block_size=21):
+        """
+        Select factors straight from the factor panel, building the design
+        matrix of block_size dates at a time.
+
+        Args:
+            factors: Dataset of the factors.
+            returns: DataArray of the returns.
+            block_size: Number of dates per block.
+
+        Returns:
+            Boolean array indicating selected features, in the order of factors.data_vars.
+        """
+        self.reset()
+        for start in range(0, len(factors[DATE_ID]), block_size):
+            block = {DATE_ID: slice(start, start + block_size)}
+            self.partial_fit(
+                DesignMatrix.from_dataset(factors.isel(block),
+                                          returns.isel(block)))
+        return self.prune()
+
+    def partial_fit(self, dataset):
+        """
+        Add the statistics of new dates. A date must not be split across calls.
+
+        Args:
+            dataset: DesignMatrix of the new dates.
+        """
+        if self.features is None:
+            self.features = list(dataset.features)
+            n_features = len(self.features)
+            self.mean = np.zeros(n_features + 1)
+            self.comoment = np.zeros((n_features + 1, n_features + 1))
+            self.ic_sum = np.zeros(n_features)
+            self.ic_sum2 = np.zeros(n_features)
+            self.ic_count = np.zeros(n_features, dtype=np.int64)
+        elif list(dataset.features) != self.features:
+            raise ValueError("The dataset features differ from the fitted ones")
+        if len(dataset) == 0:
+            return
+
+        # The returns are the last column
+        values = np.column_stack([dataset.X, dataset.y]).astype(np.float64)
+        if self.rank:
+            values = self._rank(values, dataset)
+
+        # Per-date correlations with the returns; the rows are sorted by date
+        starts = np.flatnonzero(np.diff(dataset.date_idx, prepend=-1))
+        counts = np.diff(np.append(starts, len(values)))
+        means = np.add.reduceat(values, starts) / counts[:, None]
+        deviations = values - np.repeat(means, counts, axis=0)
+        squares = np.add.reduceat(deviations**2, starts)
+        products = np.add.reduceat(deviations[:, :-1] * deviations[:, -1:],
+                                   starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ic = products / np.sqrt(squares[:, :-1] * squares[:, -1:])
+        valid = np.isfinite(ic)
+        self.ic_sum += np.where(valid, ic, 0).sum(axis=0)
+        self.ic_sum2 += np.where(valid, ic**2, 0).sum(axis=0)
+        self.ic_count += valid.sum(axis=0)
+
+        # Merge the means and co-moments of the block into the totals
+        if self.corr_sample < 1:
+            values = values[self._rng.random(len(values)) < self.corr_sample]
+            if len(values) == 0:
+                return
+        n_block = len(values)
+        mean_block = values.mean(axis=0)
+        centered = values - mean_block
+        delta = mean_block - self.mean
+        total = self.n + n_block
+        self.comoment += centered.T @ centered + np.outer(
+            delta, delta) * self.n * n_block / total
+        self.mean += delta * n_block / total
+        self.n = total
+
+    def prune(self):
+        """
+        Pick the factors from the statistics of the dates seen so far.
+
+        Returns:
+            Boolean array indicating selected features.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.ic_ = self.ic_sum / self.ic_count
+            self.icir_ = self.ic_ / np.sqrt(self.ic_sum2 / self.ic_count -
+                                            self.ic_**2)
+            scale = np.sqrt(np.diag(self.comoment))[:-1]
+            self.corr_ = self.comoment[:-1, :-1] / np.outer(scale, scale)
+
+        strength = np.nan_to_num(np.abs(self.ic_))
+        overlap = np.abs(np.nan_to_num(self.corr_))
+        candidate = strength >= self.min_ic
+        candidate &= np.isfinite(self.ic_)
+        worst = np.zeros(len(strength))
+        n_features = len(strength) if self.n_features is None else self.n_features
+
+        self.order_ = []
+        while candidate.any() and len(self.order_) < n_features:
+            score = np.where(candidate, strength - self.redundancy * worst,
+                             -np.inf)
+            best = int(np.argmax(score))
+            self.order_.append(best)
+            worst = np.maximum(worst, overlap[best])
+            candidate[best] = False
+            candidate &= worst < self.max_corr
+
+        selected = np.zeros(len(strength), dtype=bool)
+        selected[self.order_] = True
+        return selected
+
+    def correlation(self):
+        """
+        Get the factor-factor correlation matrix, e.g. for generate_heatmap.
+
+        Returns:
+            DataFrame of the correlations, indexed by factor name on both axes.
+        """
+        if self.corr_ is None:
+            self.prune()
+        return pd.DataFrame(self.corr_,
+                            index=self.features,
+                            columns=self.features)
+
+    @staticmethod
+    def _rank(values, dataset):
+        """
+        Rank every column within each date.
+        """
+        grid = np.full((len(dataset.dates), len(dataset.instruments)), np.nan)
+        ranked = np.empty_like(values)
+        for j in range(values.shape[1]):
+            grid[dataset.date_idx, dataset.stk_idx] = values[:, j]
+            ranked[:, j] = cross_section.rank(grid)[dataset.date_idx,
+                                                    dataset.stk_idx]
+        return ranked
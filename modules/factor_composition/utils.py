@@ -4,23 +4,147 @@ import xarray as xr
 
 from sklearn.metrics import make_scorer
 
-corr_scorer = make_scorer(
-    lambda x, y: np.mean(x * y) / np.sqrt(np.mean(x**2) * np.mean(y**2)),
-    greater_is_better=True)
+from ..config import DATE_ID, INSTRUMENT_ID
+from ..profiling import traced
 
 
+def corr_score(x, y):
+    return np.mean(x * y) / np.sqrt(np.mean(x**2) * np.mean(y**2))
+
+
+# A named function, so that the scorer can be sent to worker processes
+corr_scorer = make_scorer(corr_score, greater_is_better=True)
+
+
+class DesignMatrix(object):
+    """
+    A compact design matrix of the (date, stk_id) pairs where every factor and
+    the return are known.
+
+    The features are a contiguous float32 (row, feature) matrix, and each row
+    keeps the integer position of its date and instrument, so predictions are
+    scattered back into the (date, stk_id) grid without building or sorting a
+    MultiIndex. Rows are ordered by date, then instrument.
+
+    Attributes:
+    - X: The (row, feature) float32 features.
+    - y: The returns of each row.
+    - date_idx, stk_idx: The positions of each row in dates and instruments.
+    - dates, instruments: The coordinates of the grid.
+    - features: The feature names.
+
+    Methods:
+    - from_dataset(factors, returns): Build the design matrix of a Dataset.
+    - row_dates: The date of each row.
+    - to_grid(values): Scatter row values into a (stk_id, date) DataArray.
+    - to_dataframe(): Convert to the DataFrame of the pandas path.
+    """
+
+    def __init__(self, X, y, date_idx, stk_idx, dates, instruments, features):
+        self.X = X
+        self.y = y
+        self.date_idx = date_idx
+        self.stk_idx = stk_idx
+        self.dates = dates
+        self.instruments = instruments
+        self.features = features
+
+    @classmethod
+    def from_dataset(cls, factors, returns=None):
+        """
+        Build the design matrix of the pairs with no missing value.
+
+        Parameters:
+        factors (xarray.Dataset): Dataset containing the factors data.
+        returns (xarray.DataArray): DataArray containing the returns data.
+        None keeps every pair with known factors, e.g. to predict dates
+        whose returns are not known yet, and y is NaN.
+
+        Returns:
+        DesignMatrix: The design matrix.
+        """
+        features = list(factors.data_vars)
+        known_returns = returns is not None
+        if not known_returns:
+            returns = xr.full_like(factors[features[0]], np.nan, dtype=float)
+        returns = returns.reindex_like(factors).transpose(
+            DATE_ID, INSTRUMENT_ID)
+
+        def grid(data):
+            return data.transpose(DATE_ID, INSTRUMENT_ID).values
+
+        valid = np.ones(returns.shape, dtype=bool)
+        if known_returns:
+            valid &= ~np.isnan(returns.values)
+        for name in features:
+            valid &= ~np.isnan(grid(factors[name]))
+        date_idx, stk_idx = np.nonzero(valid)
+
+        # Fill one feature at a time, never holding a second full copy
+        X = np.empty((len(date_idx), len(features)), dtype=np.float32)
+        for j, name in enumerate(features):
+            X[:, j] = grid(factors[name])[date_idx, stk_idx]
+
+        return cls(X, returns.values[date_idx, stk_idx],
+                   date_idx.astype(np.int32), stk_idx.astype(np.int32),
+                   returns[DATE_ID].values, returns[INSTRUMENT_ID].values,
+                   features)
+
+    def __len__(self):
+        return len(self.y)
+
+    @property
+    def row_dates(self):
+        return self.dates[self.date_idx]
+
+    def to_grid(self, values, name=None):
+        """
+        Scatter row values into the (date, stk_id) grid.
+
+        Parameters:
+        values (numpy.ndarray): One value per row.
+        name (str): The name of the DataArray.
+
+        Returns:
+        xarray.DataArray: The (stk_id, date) values, NaN on the missing pairs.
+        """
+        grid = np.full((len(self.dates), len(self.instruments)), np.nan)
+        grid[self.date_idx, self.stk_idx] = values
+        return xr.DataArray(grid,
+                            coords={
+                                DATE_ID: self.dates,
+                                INSTRUMENT_ID: self.instruments
+                            },
+                            dims=(DATE_ID, INSTRUMENT_ID),
+                            name=name).transpose(INSTRUMENT_ID, DATE_ID)
+
+    def to_dataframe(self):
+        """
+        Convert to a DataFrame indexed by (stk_id, date) with the features and RETURN.
+
+        Returns:
+        pandas.DataFrame: The dataset.
+        """
+        index = pd.MultiIndex.from_arrays(
+            [self.instruments[self.stk_idx], self.row_dates],
+            names=[INSTRUMENT_ID, DATE_ID])
+        return pd.DataFrame(self.X, index=index, columns=self.features).assign(
+            RETURN=self.y).sort_index()
+
+
+@traced()
 def train_test_split(factors, returns, test_size=252):
     """
     Split the factors and returns data into training and testing datasets.
 
     Parameters:
     factors (xarray.Dataset): Dataset containing the factors data.
-    returns (xarray.Dataset): Dataset containing the returns data.
+    returns (xarray.DataArray): DataArray containing the returns data.
     test_size (int): Number of data points to be included in the testing dataset. Default is 252.
 
     Returns:
-    train_dataset (pandas.DataFrame): Training dataset containing the factors and returns data.
-    test_dataset (pandas.DataFrame): Testing dataset containing the factors and returns data.
+    train_dataset (DesignMatrix): Training dataset containing the factors and returns data.
+    test_dataset (DesignMatrix): Testing dataset containing the factors and returns data.
     """
 
     # Calculate the total number of data points
@@ -37,27 +161,95 @@ def train_test_split(factors, returns, test_size=252):
         returns.isel(date=slice(train_end, None)),
     )
 
-    # Convert the training datasets to pandas DataFrame and drop any rows with missing values
-    train_dataset = factors_train.assign(
-        RETURN=returns_train).to_dataframe().dropna()
-
-    # Convert the testing datasets to pandas DataFrame and drop any rows with missing values
-    test_dataset = factors_test.assign(
-        RETURN=returns_test).to_dataframe().dropna()
+    # Keep the rows with no missing values in compact design matrices
+    train_dataset = DesignMatrix.from_dataset(factors_train, returns_train)
+    test_dataset = DesignMatrix.from_dataset(factors_test, returns_test)
 
     return train_dataset, test_dataset
 
 
 def unpack_signals(regressor, train_dataset, test_dataset, returns):
-    fitted = regressor.predict(train_dataset)
-    pred = regressor.predict(test_dataset)
+    """
+    Predict the training and testing datasets and put the predictions back
+    onto the grid of the returns.
+
+    Parameters:
+    regressor (BaseRegressor): The fitted regressor.
+    train_dataset (DesignMatrix): Training dataset.
+    test_dataset (DesignMatrix): Testing dataset.
+    returns (xarray.DataArray): DataArray containing the returns data.
 
-    train_dataset["PRED"] = fitted
-    test_dataset["PRED"] = pred
+    Returns:
+    signals (xarray.DataArray): The (stk_id, date) predictions, NaN where a factor or the return is missing.
+    """
+    returns = returns.transpose(INSTRUMENT_ID, DATE_ID)
+    signals = np.full(returns.shape, np.nan)
+    dates = pd.Index(returns[DATE_ID].values)
+    instruments = pd.Index(returns[INSTRUMENT_ID].values)
+
+    for dataset in (train_dataset, test_dataset):
+        rows = instruments.get_indexer(dataset.instruments)[dataset.stk_idx]
+        cols = dates.get_indexer(dataset.dates)[dataset.date_idx]
+        signals[rows, cols] = regressor.predict(dataset)
 
-    signals = pd.concat([train_dataset["PRED"],
-                         test_dataset["PRED"]]).sort_index().to_xarray()
+    return returns.copy(data=signals).rename("signals")
+
+
+def walk_forward(factors,
+                 returns,
+                 regressor,
+                 step=21,
+                 train_size=None,
+                 min_train_size=252):
+    """
+    Generate out-of-sample signals by retraining the regressor every `step`
+    dates and predicting the following `step` dates.
 
-    dataset = xr.Dataset({"returns": returns, "signals": signals})
+    Only the dates entering and leaving the training window are converted to
+    arrays at each step, and the regressor is updated incrementally.
 
-    return dataset["signals"]
+    Parameters:
+    factors (xarray.Dataset): Dataset containing the factors data.
+    returns (xarray.DataArray): DataArray containing the returns data.
+    regressor (WalkForwardLassoRegressor): The regressor, with update, drop, refit and predict_array methods.
+    step (int): Number of dates between two retrainings. Default is 21.
+    train_size (int): Number of dates of the rolling training window. Default is None (expanding window).
+    min_train_size (int): Number of dates of the first training window. Default is 252.
+
+    Returns:
+    signals (xarray.DataArray): The (stk_id, date) out-of-sample predictions, NaN before the first test date.
+    """
+    returns = returns.reindex_like(factors)
+    n_dates = factors.sizes[DATE_ID]
+    signals = np.full((n_dates, factors.sizes[INSTRUMENT_ID]), np.nan)
+
+    def date_block(start, stop):
+        block = factors.isel({DATE_ID: slice(start, stop)})
+        X = block.to_array("factor").transpose(DATE_ID, INSTRUMENT_ID,
+                                                "factor").values
+        y = returns.isel({
+            DATE_ID: slice(start, stop)
+        }).transpose(DATE_ID, INSTRUMENT_ID).values
+        return X, y
+
+    regressor.reset()
+    train_start = train_stop = 0
+    for test_start in range(min_train_size, n_dates, step):
+        regressor.update(*date_block(train_stop, test_start))
+        train_stop = test_start
+        if train_size is not None and train_stop - train_start > train_size:
+            regressor.drop(train_stop - train_size - train_start)
+            train_start = train_stop - train_size
+        regressor.refit()
+
+        test_stop = min(test_start + step, n_dates)
+        X, _ = date_block(test_start, test_stop)
+        signals[test_start:test_stop] = regressor.predict_array(X)
+
+    return xr.DataArray(signals,
+                        coords={
+                            DATE_ID: factors[DATE_ID],
+                            INSTRUMENT_ID: factors[INSTRUMENT_ID]
+                        },
+                        dims=(DATE_ID, INSTRUMENT_ID)).transpose(
+                            INSTRUMENT_ID, DATE_ID)
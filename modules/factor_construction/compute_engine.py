@@ -1,12 +1,25 @@
+import hashlib
+import inspect
+
 import numpy as np
+import pandas as pd
 import xarray as xr
 
+from . import cross_section, rolling
+
 
 class ComputeEngine:
 
     def __init__(self):
         pass
 
+    # Changes to the operators or the kernels invalidate cached factors
+    @classmethod
+    def fingerprint(cls):
+        source = inspect.getsource(inspect.getmodule(cls)) + inspect.getsource(
+            rolling) + inspect.getsource(cross_section)
+        return hashlib.sha256(source.encode()).hexdigest()
+
     # Element-wise operations
     @staticmethod
     def abs(x):
@@ -77,29 +90,71 @@ class ComputeEngine:
 
     @staticmethod
     def rolling_max(x, roll_col, roll_window):
-        return x.rolling({roll_col: roll_window}).max()
+        return ComputeEngine._apply_rolling(rolling.rolling_max, roll_col,
+                                            roll_window, x)
 
     @staticmethod
     def rolling_min(x, roll_col, roll_window):
-        return x.rolling({roll_col: roll_window}).min()
+        return ComputeEngine._apply_rolling(rolling.rolling_min, roll_col,
+                                            roll_window, x)
 
     @staticmethod
     def rolling_mean(x, roll_col, roll_window):
-        return x.rolling({roll_col: roll_window}).mean()
+        return ComputeEngine._apply_rolling(rolling.rolling_mean, roll_col,
+                                            roll_window, x)
 
     @staticmethod
     def rolling_std(x, roll_col, roll_window):
-        return x.rolling({roll_col: roll_window}).std()
+        return ComputeEngine._apply_rolling(rolling.rolling_std, roll_col,
+                                            roll_window, x)
+
+    @staticmethod
+    def rolling_sum(x, roll_col, roll_window):
+        return ComputeEngine._apply_rolling(rolling.rolling_sum, roll_col,
+                                            roll_window, x)
 
     # Group operations
     @staticmethod
     def rank(x, rank_col):
-        return x.rank(rank_col)
+        return ComputeEngine._apply_cross_section(cross_section.rank, rank_col,
+                                                  x)
 
     @staticmethod
     def scale(x, scale_col):
         return x / x.sum(scale_col)
 
+    @staticmethod
+    def zscore(x, zscore_col):
+        return ComputeEngine._apply_cross_section(cross_section.zscore,
+                                                  zscore_col, x)
+
+    @staticmethod
+    def winsorize(x, winsorize_col, lower=0.01, upper=0.99):
+        return ComputeEngine._apply_cross_section(cross_section.winsorize,
+                                                  winsorize_col,
+                                                  x,
+                                                  lower=lower,
+                                                  upper=upper)
+
+    @staticmethod
+    def mad_clip(x, clip_col, n_mad=3.0):
+        return ComputeEngine._apply_cross_section(cross_section.mad_clip,
+                                                  clip_col,
+                                                  x,
+                                                  n_mad=n_mad)
+
+    # Residuals of a regression on the exposures (e.g. log market value) and
+    # the dummies of the groups (e.g. industry codes) along neutralize_col
+    @staticmethod
+    def neutralize(x, neutralize_col, exposures=(), groups=None):
+        if groups is None:
+            return ComputeEngine._apply_cross_section(cross_section.neutralize,
+                                                      neutralize_col, x,
+                                                      *exposures)
+        return ComputeEngine._apply_cross_section(
+            lambda y, *xs: cross_section.neutralize(y, *xs[:-1], groups=xs[-1]),
+            neutralize_col, x, *exposures, groups)
+
     # Complex operations
     @classmethod
     def ret(cls, x, shift_col, shift_num):
@@ -107,6 +162,113 @@ class ComputeEngine:
 
     @classmethod
     def rolling_corr(cls, x, y, roll_col, roll_window):
-        x = x.rolling({roll_col: roll_window}).construct("window_dim")
-        y = y.rolling({roll_col: roll_window}).construct("window_dim")
-        return xr.corr(x, y, "window_dim")
+        return cls._apply_rolling(rolling.rolling_corr, roll_col, roll_window,
+                                  x, y)
+
+    @classmethod
+    def rolling_cov(cls, x, y, roll_col, roll_window):
+        return cls._apply_rolling(rolling.rolling_cov, roll_col, roll_window,
+                                  x, y)
+
+    # Multi-window operations, stacked along a "window" dimension
+    @staticmethod
+    def ret_multi(x, shift_col, shift_nums):
+        log_x = np.log(x)
+        return xr.concat(
+            [log_x - log_x.shift({shift_col: i}) for i in shift_nums],
+            dim=pd.Index(list(shift_nums), name="window"))
+
+    @staticmethod
+    def rolling_sum_multi(x, roll_col, roll_windows):
+        return ComputeEngine._apply_rolling_multi(rolling.rolling_sum_multi,
+                                                  roll_col, roll_windows, x)
+
+    @staticmethod
+    def rolling_mean_multi(x, roll_col, roll_windows):
+        return ComputeEngine._apply_rolling_multi(rolling.rolling_mean_multi,
+                                                  roll_col, roll_windows, x)
+
+    @staticmethod
+    def rolling_std_multi(x, roll_col, roll_windows):
+        return ComputeEngine._apply_rolling_multi(rolling.rolling_std_multi,
+                                                  roll_col, roll_windows, x)
+
+    @staticmethod
+    def rolling_corr_multi(x, y, roll_col, roll_windows):
+        return ComputeEngine._apply_rolling_multi(rolling.rolling_corr_multi,
+                                                  roll_col, roll_windows, x, y)
+
+    @staticmethod
+    def rolling_cov_multi(x, y, roll_col, roll_windows):
+        return ComputeEngine._apply_rolling_multi(rolling.rolling_cov_multi,
+                                                  roll_col, roll_windows, x, y)
+
+    @staticmethod
+    def sel_window(x, window):
+        return x.sel(window=window, drop=True)
+
+    # Streaming kernels run along the last axis, so move roll_col there
+    @staticmethod
+    def _apply_rolling(kernel, roll_col, roll_window, *xs):
+        xs = [ComputeEngine._single_chunk(x, roll_col) for x in xs]
+        dtype = np.result_type(np.float32, *[x.dtype for x in xs])
+        return xr.apply_ufunc(kernel,
+                              *xs,
+                              input_core_dims=[[roll_col]] * len(xs),
+                              output_core_dims=[[roll_col]],
+                              kwargs={"window": roll_window},
+                              dask="parallelized",
+                              output_dtypes=[dtype])
+
+    # Cross-sectional kernels run along the last axis, so move the group
+    # dimension there and back
+    @staticmethod
+    def _apply_cross_section(kernel, col, *xs, **kwargs):
+        xs = [ComputeEngine._single_chunk(x, col) for x in xs]
+        out = xr.apply_ufunc(kernel,
+                             *xs,
+                             input_core_dims=[[col]] * len(xs),
+                             output_core_dims=[[col]],
+                             kwargs=kwargs,
+                             dask="parallelized",
+                             output_dtypes=[np.float64])
+        return out.transpose(*xs[0].dims)
+
+    # Inputs with a window dimension give one row per window, the others are
+    # shared by every window; each input gets its own core dimension name, so
+    # that their lengths (one row per window or 1) need not match
+    @staticmethod
+    def _apply_rolling_multi(kernel, roll_col, roll_windows, *xs):
+        roll_windows = list(roll_windows)
+        xs = [ComputeEngine._single_chunk(x, roll_col) for x in xs]
+        dtype = np.result_type(np.float32, *[x.dtype for x in xs])
+        xs = [
+            x.sel(window=roll_windows).rename(window=f"window_{i}")
+            if "window" in x.dims else x.expand_dims(f"window_{i}")
+            for i, x in enumerate(xs)
+        ]
+        xs = [
+            x if x.chunks is None else x.chunk({f"window_{i}": -1})
+            for i, x in enumerate(xs)
+        ]
+        out = xr.apply_ufunc(
+            kernel,
+            *xs,
+            input_core_dims=[[f"window_{i}", roll_col]
+                             for i in range(len(xs))],
+            output_core_dims=[["window", roll_col]],
+            kwargs={"windows": roll_windows},
+            dask="parallelized",
+            output_dtypes=[dtype],
+            dask_gufunc_kwargs={"output_sizes": {
+                "window": len(roll_windows)
+            }})
+        return out.assign_coords(window=roll_windows)
+
+    # Chunked (dask) arrays are re-chunked so that an operator runs on whole
+    # rows of its dimension, with the other dimensions split to bound memory
+    @staticmethod
+    def _single_chunk(x, dim):
+        if x.chunks is None or len(x.chunksizes[dim]) == 1:
+            return x
+        return x.chunk({d: -1 if d == dim else "auto" for d in x.dims})
@@ -0,0 +1,191 @@
+"""
+Cross-sectional kernels along the last axis of an array.
+
+Every kernel treats each row (e.g. the stocks of one date) independently and
+handles the whole array at once, without a Python loop over the rows. NaNs
+are ignored: a NaN stays NaN and does not count in the statistics of its row,
+and a row without valid values gives NaN.
+
+Quantiles and medians come from one sort of each row, with the NaNs sorted
+last. Ranks use bottleneck's nanrankdata when it is installed, like xarray's
+rank, and an argsort of each row otherwise. Neutralization demeans every
+group (e.g. industry) of each row with bincount, which absorbs the intercept
+and the group dummies, then regresses on the demeaned exposures with batched
+normal equations.
+"""
+import numpy as np
+import pandas as pd
+
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
+
+# Scales the median absolute deviation to the standard deviation of a normal
+MAD_SCALE = 1.4826
+
+
+def _sorted(x):
+    """
+    Sort every row with the NaNs last, and count the valid values of each row.
+    """
+    return np.sort(x, axis=-1), np.count_nonzero(~np.isnan(x), axis=-1)
+
+
+def _quantile(values, count, q):
+    """
+    The q-quantile of every sorted row with count valid values, interpolated
+    linearly like numpy.nanquantile.
+    """
+    position = q * (count - 1)
+    lo = np.floor(position).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(count - 1, 0))
+    lo = np.maximum(lo, 0)
+    below = np.take_along_axis(values, lo[..., None], axis=-1)[..., 0]
+    above = np.take_along_axis(values, hi[..., None], axis=-1)[..., 0]
+    with np.errstate(invalid="ignore"):
+        value = below + (above - below) * (position - lo)
+    return np.where(count > 0, value, np.nan)
+
+
+def rank(x):
+    """
+    Ranks from 1 of every row, with ties given their average rank, like
+    xarray's rank and scipy.stats.rankdata.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if bn is not None:
+        return bn.nanrankdata(x, axis=-1)
+
+    order = np.argsort(x, axis=-1, kind="stable")
+    values = np.take_along_axis(x, order, axis=-1)
+    length = x.shape[-1]
+    position = np.arange(length)
+
+    # Runs of equal values share the average of their first and last positions
+    first = np.ones(values.shape, dtype=bool)
+    first[..., 1:] = values[..., 1:] != values[..., :-1]
+    last = np.ones(values.shape, dtype=bool)
+    last[..., :-1] = first[..., 1:]
+    start = np.maximum.accumulate(np.where(first, position, 0), axis=-1)
+    stop = np.minimum.accumulate(np.where(last, position, length)[..., ::-1],
+                                 axis=-1)[..., ::-1]
+    ranks = np.where(np.isnan(values), np.nan, (start + stop) / 2 + 1)
+
+    out = np.empty_like(ranks)
+    np.put_along_axis(out, order, ranks, axis=-1)
+    return out
+
+
+def zscore(x, ddof=0):
+    """
+    Standardize every row to zero mean and unit standard deviation. Rows with
+    a zero standard deviation give NaN.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = np.count_nonzero(~np.isnan(x), axis=-1)[..., None]
+        mean = np.nansum(x, axis=-1, keepdims=True) / count
+        deviation = x - mean
+        std = np.sqrt(
+            np.nansum(deviation**2, axis=-1, keepdims=True) / (count - ddof))
+        return np.where(std > 0, deviation / std, np.nan)
+
+
+def winsorize(x, lower=0.01, upper=0.99):
+    """
+    Clip every row to its lower and upper quantiles.
+    """
+    values, count = _sorted(x)
+    low = _quantile(values, count, lower)[..., None]
+    high = _quantile(values, count, upper)[..., None]
+    return np.clip(x, low, high)
+
+
+def mad_clip(x, n_mad=3.0):
+    """
+    Clip every row to its median plus or minus n_mad scaled median absolute
+    deviations.
+    """
+    values, count = _sorted(x)
+    median = _quantile(values, count, 0.5)[..., None]
+    deviation = np.abs(x - median)
+    values, count = _sorted(deviation)
+    mad = MAD_SCALE * _quantile(values, count, 0.5)[..., None]
+    return np.clip(x, median - n_mad * mad, median + n_mad * mad)
+
+
+def _group_codes(groups, shape):
+    """
+    Codes from 0 of the group labels of every value, -1 for missing labels
+    (NaN or None, e.g. in the object arrays of string industries).
+    """
+    groups = np.asarray(groups)
+    valid = ~pd.isna(groups)
+    codes = np.full(groups.shape, -1, dtype=np.int64)
+    codes[valid] = np.unique(groups[valid], return_inverse=True)[1].ravel()
+    # Labels shared by every row (e.g. static industries) are coded once
+    return np.broadcast_to(codes, shape)
+
+
+def _demean(x, codes, n_groups, mask):
+    """
+    Subtract the mean of every group of every row, over the masked values.
+    """
+    rows = x.reshape(-1, x.shape[-1])
+    keys = (np.arange(len(rows))[:, None] * n_groups +
+            codes.reshape(rows.shape))[mask.reshape(rows.shape)]
+    values = rows[mask.reshape(rows.shape)]
+    sums = np.bincount(keys, weights=values, minlength=len(rows) * n_groups)
+    counts = np.bincount(keys, minlength=len(rows) * n_groups)
+    means = sums / np.maximum(counts, 1)
+
+    out = np.zeros(rows.shape)
+    out[mask.reshape(rows.shape)] = values - means[keys]
+    return out.reshape(x.shape)
+
+
+def neutralize(y, *exposures, groups=None):
+    """
+    The residuals of a least-squares regression of every row of y on the
+    exposures, an intercept and dummies of the groups.
+
+    Parameters:
+    - y (numpy.ndarray): The values to neutralize.
+    - exposures (numpy.ndarray): The exposures, e.g. the log market value, broadcast to y.
+    - groups (numpy.ndarray, optional): The group label of each value, e.g. the industry, broadcast to y. NaN or None labels are missing. Default is None (no groups).
+
+    Returns:
+    - numpy.ndarray: The residuals, NaN where y, an exposure or the group is missing.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    exposures = [
+        np.broadcast_to(np.asarray(exposure, dtype=np.float64), y.shape)
+        for exposure in exposures
+    ]
+    if groups is None:
+        codes = np.zeros(y.shape, dtype=np.int64)
+    else:
+        codes = _group_codes(groups, y.shape)
+    n_groups = int(codes.max()) + 1 if codes.size else 1
+
+    mask = ~np.isnan(y) & (codes >= 0)
+    for exposure in exposures:
+        mask &= ~np.isnan(exposure)
+
+    # Demeaning within groups is the same as regressing on the group dummies
+    residual = _demean(y, codes, n_groups, mask)
+    if exposures:
+        design = [
+            _demean(exposure, codes, n_groups, mask) for exposure in exposures
+        ]
+        gram = np.empty(y.shape[:-1] + (len(design), len(design)))
+        moment = np.empty(y.shape[:-1] + (len(design), ))
+        for i, x in enumerate(design):
+            moment[..., i] = (x * residual).sum(axis=-1)
+            for j in range(i + 1):
+                gram[..., i, j] = gram[..., j, i] = (x * design[j]).sum(axis=-1)
+        # The pseudo-inverse handles collinear exposures and rows with too few values
+        beta = (np.linalg.pinv(gram) @ moment[..., None])[..., 0]
+        for i, x in enumerate(design):
+            residual -= beta[..., i, None] * x
+    return np.where(mask, residual, np.nan)
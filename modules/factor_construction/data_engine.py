@@ -1,6 +1,21 @@
+import os
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import xarray as xr
+from pyarrow import feather
+
+from ..profiling import traced
+
+try:
+    import dask
+    import dask.array as da
+except ImportError:
+    dask = None
 
-from typing import List
+from typing import List, Optional
 from numpy import ndarray
 from xarray import Dataset
 
@@ -9,37 +24,187 @@ class DataEngine(object):
     """
     A class for loading and processing financial data.
 
+    The (stk_id, date) arrays are filled directly from the integer codes of the
+    instrument and date columns, one column at a time, and the adjusted price
+    features (e.g. close_adj) are only computed on first access.
+
     Parameters:
     - data_path (str): The path to the data file.
     - date_col (str): The name of the column containing the date information. Default is "date".
     - instrument_col (str): The name of the column containing the instrument information. Default is "stk_id".
+    - start_date (optional): Only load the rows on or after this date. Default is None (all rows).
+    - columns (list, optional): The features to load, e.g. ["close_adj", "volume"]; adjusted features load their raw and cumadj columns. Default is None (all columns).
+    - dtype (optional): The float dtype of the numeric features, e.g. numpy.float32; other columns (e.g. strings) are object arrays. Default is None (float64).
+    - chunks (int, optional): Load the features as dask arrays of this many instruments per chunk, which are only read from the memory-mapped file when computed. Requires dask. Default is None (in-memory arrays).
     """
 
-    def __init__(self, data_path: str, date_col: str,
-                 instrument_col: str) -> None:
+    adj_cols = ["open", "high", "low", "close"]
+
+    def __init__(self,
+                 data_path: str,
+                 date_col: str,
+                 instrument_col: str,
+                 start_date=None,
+                 columns: Optional[List[str]] = None,
+                 dtype=None,
+                 chunks: Optional[int] = None) -> None:
+        if chunks is not None and dask is None:
+            raise ImportError("Chunked loading requires dask")
         self.data_path = data_path
         self.date_col = date_col
         self.instrument_col = instrument_col
+        self.start_date = start_date
+        self.columns = columns
+        self.dtype = np.dtype(np.float64 if dtype is None else dtype)
+        self.chunks = chunks
 
-        self.data = self.load_data(self.data_path)
+        self.data = self.load_data(self.data_path, self.start_date)
         self.install_features()
 
-    def load_data(self, path: str) -> Dataset:
+    @classmethod
+    def from_dataset(cls, data: Dataset, date_col: str,
+                     instrument_col: str) -> "DataEngine":
+        """
+        Create a DataEngine on an in-memory (stk_id, date) Dataset of raw
+        columns instead of a data file, e.g. for bars received live.
+
+        Parameters:
+        - data (xarray.Dataset): The raw columns.
+        - date_col (str): The name of the date dimension.
+        - instrument_col (str): The name of the instrument dimension.
+
+        Returns:
+        - DataEngine: The data engine. It has no fingerprint, as there is no data file.
+        """
+        engine = cls.__new__(cls)
+        engine.data_path = None
+        engine.date_col = date_col
+        engine.instrument_col = instrument_col
+        engine.start_date = None
+        engine.columns = list(data.data_vars)
+        engine.dtype = np.dtype(np.float64)
+        engine.chunks = None
+        # Adjusted features are added to the data on access, so copy the Dataset
+        engine.data = data.copy()
+        engine.install_features()
+        return engine
+
+    @traced(category="io")
+    def load_data(self, path: str, start_date=None) -> Dataset:
         """
         Load the data from the specified path and preprocess it.
 
         Parameters:
         - path (str): The path to the data file.
+        - start_date (optional): Only load the rows on or after this date.
 
         Returns:
         - xarray.Dataset: The preprocessed data in xarray format.
         """
-        df = pd.read_feather(path)
-        df = df.set_index([self.instrument_col, self.date_col])
-        df = df.sort_index()
-        for adj_col in ["open", "high", "low", "close"]:
-            df[f"{adj_col}_adj"] = df[adj_col] * df["cumadj"]
-        return df.to_xarray()
+        table = feather.read_table(path,
+                                   columns=self._load_columns(path),
+                                   memory_map=True)
+        if start_date is not None:
+            start = pa.scalar(pd.Timestamp(start_date),
+                              type=table.schema.field(self.date_col).type)
+            table = table.filter(
+                pc.greater_equal(table[self.date_col], start))
+
+        instrument_codes, instruments = self._factorize(
+            table[self.instrument_col])
+        date_codes, dates = self._factorize(table[self.date_col])
+        if np.issubdtype(dates.dtype, np.datetime64):
+            # Like pandas, whatever the unit of the file
+            dates = dates.astype("datetime64[ns]")
+
+        shape = (len(instruments), len(dates))
+        data = {}
+        for col in table.column_names:
+            if col in (self.instrument_col, self.date_col):
+                continue
+            column = table[col]
+            if pa.types.is_dictionary(column.type):
+                # Categoricals are loaded as their values
+                column = column.cast(column.type.value_type)
+            dtype = self._column_dtype(column.type)
+            if self.chunks is None:
+                values = np.full(shape, np.nan, dtype=dtype)
+                values[instrument_codes, date_codes] = column.to_numpy(
+                    zero_copy_only=False)
+            else:
+                values = self._chunked_array(column, instrument_codes,
+                                             date_codes, shape, dtype)
+            data[col] = ((self.instrument_col, self.date_col), values)
+
+        return xr.Dataset(data,
+                          coords={
+                              self.instrument_col: instruments,
+                              self.date_col: dates
+                          })
+
+    def _column_dtype(self, type: pa.DataType) -> np.dtype:
+        """
+        Get the dtype of the array of a column: the feature dtype for numeric
+        columns, and object for the others (e.g. string industries), with NaN
+        for the missing rows like pandas' to_xarray.
+        """
+        if pa.types.is_floating(type) or pa.types.is_integer(type):
+            return self.dtype
+        return np.dtype(object)
+
+    def _chunked_array(self, column: pa.ChunkedArray, instrument_codes: ndarray,
+                       date_codes: ndarray, shape, dtype) -> "da.Array":
+        """
+        Build a dask array of a column, chunked along the instruments. Each
+        chunk is filled from its own rows of the column when it is computed.
+        """
+        order = np.argsort(instrument_codes, kind="stable")
+        bounds = np.searchsorted(instrument_codes[order],
+                                 np.arange(0, shape[0] + self.chunks,
+                                           self.chunks).clip(max=shape[0]))
+
+        def load_chunk(lo, hi, rows):
+            values = np.full((hi - lo, shape[1]), np.nan, dtype=dtype)
+            values[instrument_codes[rows] - lo,
+                   date_codes[rows]] = column.take(rows).to_numpy(
+                       zero_copy_only=False)
+            return values
+
+        blocks = []
+        for i, lo in enumerate(range(0, shape[0], self.chunks)):
+            hi = min(lo + self.chunks, shape[0])
+            rows = order[bounds[i]:bounds[i + 1]]
+            blocks.append(
+                da.from_delayed(dask.delayed(load_chunk)(lo, hi, rows),
+                                shape=(hi - lo, shape[1]),
+                                dtype=dtype))
+        if not blocks:
+            return da.empty(shape, dtype=dtype)
+        return da.concatenate(blocks, axis=0)
+
+    @staticmethod
+    def _factorize(column: pa.ChunkedArray):
+        """
+        Get the integer codes of a column and its sorted unique values.
+        """
+        uniques = pc.unique(column)
+        uniques = uniques.take(pc.array_sort_indices(uniques))
+        codes = pc.index_in(column, value_set=uniques).to_numpy()
+        return codes, uniques.to_numpy(zero_copy_only=False)
+
+    def _load_columns(self, path: str) -> Optional[List[str]]:
+        """
+        Get the raw columns to read for the requested features.
+        """
+        if self.columns is None:
+            return None
+        columns = [self.instrument_col, self.date_col]
+        for col in self.columns:
+            if col.endswith("_adj") and col[:-4] in self.adj_cols:
+                columns += [col[:-4], "cumadj"]
+            else:
+                columns.append(col)
+        return list(dict.fromkeys(columns))
 
     @property
     def instruments(self) -> ndarray:
@@ -61,19 +226,54 @@ class DataEngine(object):
         """
         return self.data[self.date_col].values
 
+    def fingerprint(self) -> str:
+        """
+        Get a fingerprint of the loaded data, from the data file's path, size and
+        modification time and the loading options.
+
+        Returns:
+        - str: The fingerprint.
+        """
+        stat = os.stat(self.data_path)
+        return ":".join(
+            map(str, [
+                os.path.abspath(self.data_path), stat.st_size,
+                stat.st_mtime_ns, self.start_date, self.dtype
+            ]))
+
     @property
     def features(self) -> List[str]:
         """
-        Get the list of available features in the data.
+        Get the list of available features in the data, including the
+        adjusted features that have not been computed yet.
 
         Returns:
         - list: The list of feature names.
         """
-        return list(self.data.data_vars.keys())
+        features = list(self.data.data_vars.keys())
+        if "cumadj" in features:
+            features += [
+                f"{adj_col}_adj" for adj_col in self.adj_cols
+                if adj_col in features and f"{adj_col}_adj" not in features
+            ]
+        return features
 
     def install_features(self) -> None:
         """
-        Install the features as attributes of the DataEngine object.
+        Install the loaded features as attributes of the DataEngine object.
+        Adjusted features are installed on first access.
         """
-        for feature in self.features:
+        for feature in self.data.data_vars:
             setattr(self, feature, self.data[feature])
+
+    def __getattr__(self, name: str):
+        # Only called for attributes that are not installed yet
+        data = self.__dict__.get("data")
+        if (data is not None and name.endswith("_adj")
+                and name[:-4] in self.adj_cols and name[:-4] in data
+                and "cumadj" in data):
+            data[name] = data[name[:-4]] * data["cumadj"]
+            setattr(self, name, data[name])
+            return data[name]
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'")
@@ -0,0 +1,450 @@
+import heapq
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from ..profiling import nbytes, span
+from .compute_engine import ComputeEngine
+from .data_engine import DataEngine
+from .factor_cache import FactorCache
+
+
+class Expr(object):
+    """
+    A node of an expression graph: an operator applied to child nodes and constants.
+
+    Parameters:
+    - graph (ExpressionGraph): The graph the node belongs to.
+    - index (int): The position of the node in the graph, children come first.
+    - op (str): The ComputeEngine operator name, or "field" for a data field.
+    - args (tuple): The arguments of the operator, Expr nodes or constants.
+    """
+
+    def __init__(self, graph: "ExpressionGraph", index: int, op: str,
+                 args: Tuple[Any, ...]) -> None:
+        self.graph = graph
+        self.index = index
+        self.op = op
+        self.args = args
+
+    def __repr__(self) -> str:
+        return f"Expr({self.op}, {', '.join(map(repr, self.args))})"
+
+    def __add__(self, other):
+        return self.graph.node("add", self, other)
+
+    def __radd__(self, other):
+        return self.graph.node("add", other, self)
+
+    def __sub__(self, other):
+        return self.graph.node("subtract", self, other)
+
+    def __rsub__(self, other):
+        return self.graph.node("subtract", other, self)
+
+    def __mul__(self, other):
+        return self.graph.node("multiply", self, other)
+
+    def __rmul__(self, other):
+        return self.graph.node("multiply", other, self)
+
+    def __truediv__(self, other):
+        return self.graph.node("divide", self, other)
+
+    def __rtruediv__(self, other):
+        return self.graph.node("divide", other, self)
+
+    def __pow__(self, other):
+        return self.graph.node("power", self, other)
+
+    def __neg__(self):
+        return self.graph.node("multiply", self, -1)
+
+
+class ExpressionGraph(object):
+    """
+    A DAG of lazy factor expressions with common-subexpression elimination.
+
+    Identical subtrees are deduplicated by their structural key when they are
+    built, and the whole graph is evaluated once with shared intermediates.
+    An intermediate is freed as soon as its last consumer has been computed,
+    and independent nodes can be computed concurrently (see stream).
+
+    Parameters:
+    - data_engine (DataEngine): The data engine providing the input fields.
+    - compute_engine (ComputeEngine): The compute engine running the operators.
+    """
+
+    def __init__(self, data_engine: DataEngine,
+                 compute_engine: ComputeEngine) -> None:
+        self.nodes = []
+        self.keys: Dict[Hashable, Expr] = {}
+        self.data_engine = LazyDataEngine(self, data_engine)
+        self.compute_engine = LazyComputeEngine(self, compute_engine)
+        self._data_engine = data_engine
+        self._compute_engine = compute_engine
+        self._formulas: Dict[int, str] = {}
+
+    @staticmethod
+    def key(arg: Any) -> Hashable:
+        """
+        Get the structural key of an operator argument.
+
+        Parameters:
+        - arg: An Expr node, a constant or a list/tuple of them.
+
+        Returns:
+        - Hashable: The key, equal for structurally identical arguments.
+        """
+        if isinstance(arg, Expr):
+            return ("expr", arg.index)
+        if isinstance(arg, (list, tuple)):
+            return (type(arg).__name__,
+                    tuple(ExpressionGraph.key(a) for a in arg))
+        return ("const", type(arg).__name__, arg)
+
+    def node(self, op: str, *args: Any) -> Expr:
+        """
+        Get the node applying an operator to arguments, creating it if needed.
+
+        Parameters:
+        - op (str): The ComputeEngine operator name.
+        - args: The operator arguments.
+
+        Returns:
+        - Expr: The unique node for this operator and arguments.
+        """
+        key = (op, self.key(args))
+        if key not in self.keys:
+            self.keys[key] = Expr(self, len(self.nodes), op, args)
+            self.nodes.append(self.keys[key])
+        return self.keys[key]
+
+    def field(self, name: str) -> Expr:
+        """
+        Get the leaf node of a DataEngine field.
+
+        Parameters:
+        - name (str): The feature name, e.g. "close_adj".
+
+        Returns:
+        - Expr: The field node.
+        """
+        return self.node("field", name)
+
+    def fields(self) -> List[str]:
+        """
+        Get the DataEngine fields used by the graph.
+
+        Returns:
+        - list: The sorted feature names.
+        """
+        return sorted(
+            {expr.args[0]
+             for expr in self.nodes if expr.op == "field"})
+
+    def formula(self, expr: Expr) -> str:
+        """
+        Get the canonical formula of a node, e.g. "log(field('close_adj'))".
+
+        Parameters:
+        - expr (Expr): The node.
+
+        Returns:
+        - str: The formula, equal for structurally identical nodes.
+        """
+        if expr.index not in self._formulas:
+
+            def format_arg(arg):
+                if isinstance(arg, Expr):
+                    return self.formula(arg)
+                if isinstance(arg, (list, tuple)):
+                    return "[%s]" % ", ".join(map(format_arg, arg))
+                return repr(arg)
+
+            self._formulas[expr.index] = "%s(%s)" % (expr.op, ", ".join(
+                map(format_arg, expr.args)))
+        return self._formulas[expr.index]
+
+    def fingerprint(self) -> str:
+        """
+        Get the fingerprint of the inputs of the graph: the loaded data and
+        the compute engine implementation.
+
+        Returns:
+        - str: The fingerprint.
+        """
+        return "%s:%s" % (self._data_engine.fingerprint(),
+                          self._compute_engine.fingerprint())
+
+    def evaluate(self,
+                 outputs: Dict[str, Expr],
+                 cache: Optional[FactorCache] = None,
+                 n_jobs: int = 1,
+                 memory_budget: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Evaluate the given output nodes, computing every shared node only once.
+
+        Parameters:
+        - outputs (dict): The nodes to evaluate, by output name.
+        - cache (FactorCache, optional): The cache of evaluated outputs, keyed
+        by their formula and the fingerprint of the inputs. Only the outputs
+        missing from it are computed.
+        - n_jobs (int): The number of threads computing independent nodes, None for the CPU count. Default is 1.
+        - memory_budget (int, optional): The bytes of intermediates held at once, see stream. Default is None (no limit).
+
+        Returns:
+        - dict: The evaluated xarray.DataArray of each output, by output name.
+        """
+        values = {}
+        self.stream(outputs, values.__setitem__, cache, n_jobs, memory_budget)
+        return {name: values[name] for name in outputs}
+
+    def stream(self,
+               outputs: Dict[str, Expr],
+               sink: Callable[[str, Any], None],
+               cache: Optional[FactorCache] = None,
+               n_jobs: int = 1,
+               memory_budget: Optional[int] = None) -> None:
+        """
+        Evaluate the given output nodes and hand each one to sink as soon as
+        it is computed, then free it unless another node still needs it.
+
+        Nodes whose children are computed run concurrently in a thread pool
+        (the NumPy and numba kernels release the GIL), lowest index first. A
+        node only starts if the intermediates held plus the estimated outputs
+        of the running nodes and of the node fit in memory_budget, or if
+        nothing else is running. The estimate of a node is the size of one
+        (stk_id, date) panel, times the number of windows of multi-window
+        operators. The sink is always called from the calling thread.
+
+        Parameters:
+        - outputs (dict): The nodes to evaluate, by output name.
+        - sink (callable): Called with the name and the xarray.DataArray of each output.
+        - cache (FactorCache, optional): The cache of evaluated outputs; cached outputs are read instead of computed, and computed outputs are cached.
+        - n_jobs (int): The number of threads computing independent nodes, None for the CPU count. Default is 1.
+        - memory_budget (int, optional): The bytes of intermediates held at once. Default is None (no limit).
+        """
+        if cache is None:
+            return self._schedule(outputs, sink, n_jobs, memory_budget)
+
+        fingerprint = self.fingerprint()
+        keys = {
+            name: cache.key(self.formula(expr), fingerprint)
+            for name, expr in outputs.items()
+        }
+        missing = {}
+        for name, expr in outputs.items():
+            value = cache.get(keys[name])
+            if value is None:
+                missing[name] = expr
+            else:
+                sink(name, value)
+
+        def put(name, value):
+            cache.put(keys[name], value)
+            sink(name, value)
+
+        if missing:
+            self._schedule(missing, put, n_jobs, memory_budget)
+
+    def _schedule(self, outputs, sink, n_jobs, memory_budget):
+        # Count the consumers of every node reachable from the outputs
+        consumers = {}
+        stack = [expr.index for expr in outputs.values()]
+        while stack:
+            index = stack.pop()
+            if index in consumers:
+                continue
+            consumers[index] = 0
+            stack.extend(child.index for child in self._children(
+                self.nodes[index].args))
+        parents = {index: [] for index in consumers}
+        for index in consumers:
+            for child in self._children(self.nodes[index].args):
+                consumers[child.index] += 1
+                parents[child.index].append(index)
+        waiting = {
+            index: sum(1 for _ in self._children(self.nodes[index].args))
+            for index in consumers
+        }
+
+        names = {}
+        for name, expr in outputs.items():
+            names.setdefault(expr.index, []).append(name)
+
+        ready = [index for index, count in waiting.items() if count == 0]
+        heapq.heapify(ready)
+        values, sizes = {}, {}
+        running = {}
+
+        def finish(index, value):
+            values[index] = value
+            # Fields are held by the data engine anyway
+            sizes[index] = 0 if self.nodes[index].op == "field" else nbytes(
+                value)
+            for name in names.get(index, []):
+                sink(name, value)
+            # Free the children and the node itself once nothing needs them
+            for child in self._children(self.nodes[index].args):
+                consumers[child.index] -= 1
+                if consumers[child.index] == 0:
+                    del values[child.index], sizes[child.index]
+            if consumers[index] == 0:
+                del values[index], sizes[index]
+            for parent in parents[index]:
+                waiting[parent] -= 1
+                if waiting[parent] == 0:
+                    heapq.heappush(ready, parent)
+
+        # The size of one (stk_id, date) panel of the data
+        data = self._data_engine.data
+        panel = (data.sizes[self._data_engine.instrument_col] *
+                 data.sizes[self._data_engine.date_col] *
+                 self._data_engine.dtype.itemsize)
+
+        def estimate(expr):
+            if expr.op == "field":
+                return 0
+            if expr.op == "ret_multi":
+                return panel * len(expr.args[2])
+            if expr.op.endswith("_multi"):
+                return panel * len(expr.args[-1])
+            return panel
+
+        def fits(index):
+            if memory_budget is None or not running:
+                return True
+            held = sum(sizes.values()) + sum(running.values())
+            return held + estimate(self.nodes[index]) <= memory_budget
+
+        n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+        with ThreadPoolExecutor(max(n_jobs, 1)) as executor:
+            futures = {}
+            while ready or futures:
+                while ready and len(futures) < n_jobs and fits(ready[0]):
+                    index = heapq.heappop(ready)
+                    expr = self.nodes[index]
+                    args = [self._resolve(arg, values) for arg in expr.args]
+                    name = names[index][0] if index in names else None
+                    # Fields are read in this thread, as adjusted fields are
+                    # computed and installed on first access
+                    if n_jobs == 1 or expr.op == "field":
+                        finish(index, self._compute(expr, args, name))
+                        continue
+                    future = executor.submit(self._compute, expr, args, name)
+                    futures[future] = index
+                    running[index] = estimate(expr)
+                if not futures:
+                    continue
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    del running[index]
+                    finish(index, future.result())
+
+    def warmup(self, outputs: Dict[str, Expr]) -> Tuple[int, List[int]]:
+        """
+        Get the number of past dates needed to compute the outputs on new dates
+        exactly as over the full history.
+
+        A shift needs its shift number of past dates. The streaming rolling
+        kernels sum over window-sized blocks anchored at the first date and
+        centered on the previous block (see rolling.py), so a rolling operator
+        needs two more blocks of warm-up and the first date has to be aligned
+        to a multiple of its window. Multi-window operators use blocks of
+        their longest window.
+
+        Parameters:
+        - outputs (dict): The nodes to evaluate, by output name.
+
+        Returns:
+        - tuple: The warm-up length and the sorted windows of the rolling operators.
+        """
+        warmup, windows = {}, set()
+        # Children always have a smaller index than their parents
+        for expr in self.nodes:
+            lookback = max((warmup[child.index]
+                            for child in self._children(expr.args)),
+                           default=0)
+            if expr.op in ("shift", "ret_multi"):
+                shifts = expr.args[2] if expr.op == "ret_multi" else [
+                    expr.args[2]
+                ]
+                if min(shifts) < 0:
+                    raise ValueError("Cannot warm up a shift into the future")
+                lookback += max(shifts)
+            elif expr.op.startswith("rolling_"):
+                # Multi-window kernels use blocks of their longest window
+                window = expr.args[-1]
+                window = max(window) if expr.op.endswith("_multi") else window
+                lookback += 3 * window - 2
+                windows.add(window)
+            warmup[expr.index] = lookback
+        return max(warmup[expr.index]
+                   for expr in outputs.values()), sorted(windows)
+
+    def _children(self, args):
+        for arg in args:
+            if isinstance(arg, Expr):
+                yield arg
+            elif isinstance(arg, (list, tuple)):
+                yield from self._children(arg)
+
+    def _resolve(self, arg, values):
+        if isinstance(arg, Expr):
+            return values[arg.index]
+        if isinstance(arg, (list, tuple)):
+            return type(arg)(self._resolve(a, values) for a in arg)
+        return arg
+
+    def _compute(self, expr, args, name=None):
+        # Outputs are traced by factor name, shared nodes by operator
+        with span(expr.op if name is None else name,
+                  "op" if name is None else "factor") as record:
+            if expr.op == "field":
+                value = getattr(self._data_engine, expr.args[0])
+            else:
+                value = getattr(self._compute_engine, expr.op)(*args)
+            record["nbytes"] = nbytes(value)
+        return value
+
+
+class LazyDataEngine(object):
+    """
+    A DataEngine stand-in whose features are field nodes of an ExpressionGraph.
+
+    Non-feature attributes such as date_col are passed through unchanged.
+    """
+
+    def __init__(self, graph: ExpressionGraph, data_engine: DataEngine) -> None:
+        self._graph = graph
+        self._data_engine = data_engine
+
+    def __getattr__(self, name: str) -> Any:
+        if name in self._data_engine.features:
+            return self._graph.field(name)
+        return getattr(self._data_engine, name)
+
+
+class LazyComputeEngine(object):
+    """
+    A ComputeEngine stand-in whose operators build ExpressionGraph nodes.
+
+    Composite operators written in terms of other ComputeEngine operators are
+    expanded, so that their parts (e.g. the log in ret) are shared.
+    """
+
+    composite_ops = ("ret", )
+
+    def __init__(self, graph: ExpressionGraph,
+                 compute_engine: ComputeEngine) -> None:
+        self._graph = graph
+        self._compute_engine = compute_engine
+
+    def __getattr__(self, op: str) -> Any:
+        method = getattr(self._compute_engine, op)
+        if op in self.composite_ops:
+            return partial(method.__func__, self)
+        return partial(self._graph.node, op)
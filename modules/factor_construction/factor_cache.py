@@ -0,0 +1,128 @@
+import hashlib
+import os
+from typing import Dict, Optional
+
+import joblib
+from xarray import DataArray
+
+from ..profiling import traced
+
+
+class FactorCache(object):
+    """
+    A persistent on-disk cache of computed factors with LRU eviction.
+
+    Entries are keyed by a hash of the factor formula and of the fingerprint
+    of its inputs, so a factor is only recomputed when its expression, its
+    parameters, the data file or the compute engine change. The least
+    recently used entries are evicted once the cache exceeds max_bytes.
+
+    Parameters:
+    - path (str): The cache directory.
+    - max_bytes (int): The maximum total size of the cache files. Default is 10 GiB.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024**3) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(formula: str, fingerprint: str) -> str:
+        """
+        Get the cache key of a factor.
+
+        Parameters:
+        - formula (str): The canonical formula of the factor.
+        - fingerprint (str): The fingerprint of the inputs.
+
+        Returns:
+        - str: The hex digest identifying the factor.
+        """
+        return hashlib.sha256(f"{formula}\n{fingerprint}".encode()).hexdigest()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the hit, miss and eviction counts and the size of the cache.
+
+        Returns:
+        - dict: The cache statistics.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries()),
+            "bytes": sum(size for _, size, _ in self._entries()),
+        }
+
+    def get(self, key: str) -> Optional[DataArray]:
+        """
+        Get a cached factor and mark it as recently used.
+
+        Parameters:
+        - key (str): The cache key.
+
+        Returns:
+        - xarray.DataArray: The cached factor, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            value = joblib.load(path)
+        except (FileNotFoundError, EOFError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    @traced(category="io")
+    def put(self, key: str, value: DataArray) -> None:
+        """
+        Cache a factor and evict the least recently used entries if needed.
+
+        Parameters:
+        - key (str): The cache key.
+        - value (xarray.DataArray): The factor to cache.
+        """
+        path = self._path(key)
+        # Chunked (dask) factors are computed rather than pickled as a graph
+        joblib.dump(value.compute(), path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used entries until the cache fits max_bytes.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Delete every entry of the cache.
+        """
+        for path, _, _ in self._entries():
+            os.remove(path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.joblib")
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".joblib"):
+                path = os.path.join(self.path, name)
+                stat = os.stat(path)
+                entries.append((path, stat.st_size, stat.st_mtime_ns))
+        return entries
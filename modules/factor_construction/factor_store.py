@@ -0,0 +1,349 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+from ..config import DATE_ID, INSTRUMENT_ID
+from ..profiling import traced
+
+
+class FactorStore(object):
+    """
+    A columnar on-disk store of (date, stk_id) panels, one directory per variable.
+
+    Each variable is saved as date-chunked .npy files that are memory-mapped
+    on load, and an index.json keeps the dates, instruments, chunk bounds and
+    variable dtypes. Loading a few variables, instruments or a date range only
+    reads the matching chunks, and new variables or dates are added without
+    rewriting the existing files.
+
+    Parameters:
+    - path (str): The store directory, created on first write.
+    - chunk_size (int): The number of dates per chunk file. Default is 252.
+    """
+
+    index_file = "index.json"
+
+    def __init__(self, path: str, chunk_size: int = 252) -> None:
+        self.path = path
+        self.chunk_size = chunk_size
+        self.index = self._read_index()
+
+    @property
+    def variables(self) -> List[str]:
+        """
+        Get the list of variables in the store.
+
+        Returns:
+        - list: The variable names.
+        """
+        return list(self.index["variables"])
+
+    @property
+    def dates(self) -> np.ndarray:
+        """
+        Get the dates covered by the store.
+
+        Returns:
+        - numpy.ndarray: The array of dates.
+        """
+        return np.array(self.index["dates"], dtype=self.index["date_dtype"])
+
+    @property
+    def instruments(self) -> np.ndarray:
+        """
+        Get the instruments covered by the store.
+
+        Returns:
+        - numpy.ndarray: The array of instrument names.
+        """
+        return np.array(self.index["instruments"], dtype=object)
+
+    def exists(self) -> bool:
+        """
+        Check whether the store has been written to.
+
+        Returns:
+        - bool: True if the store has an index.
+        """
+        return os.path.exists(os.path.join(self.path, self.index_file))
+
+    def clear(self) -> None:
+        """
+        Delete every variable and the index of the store.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.index = self._read_index()
+
+    def replace(self, path: str) -> None:
+        """
+        Move the store to path, replacing the store there, e.g. once a new
+        store has been fully written next to the one it replaces. The old
+        store is only deleted after the move.
+
+        Parameters:
+        - path (str): The directory of the store to replace.
+        """
+        old = path + ".old"
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(self.path, path)
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        self.path = path
+
+    @traced(category="io")
+    def write(self, dataset: xr.Dataset) -> None:
+        """
+        Add or overwrite variables over the dates of the store.
+
+        The first write sets the dates of the store. New instruments are
+        appended to the instrument list; older files are padded with NaN on load.
+        Chunked (dask) variables are computed together in a single pass, so
+        their shared inputs are computed once, and streamed into the files.
+
+        Parameters:
+        - dataset (xarray.Dataset): The (date, stk_id) variables to write.
+        """
+        dates = dataset[DATE_ID].values
+        if not self.index["dates"]:
+            self._set_dates(dates)
+            self._add_chunks(0, len(dates))
+        elif not np.array_equal(dates, self.dates):
+            raise ValueError(
+                "Dataset dates differ from the store dates; use append() for "
+                "new dates or clear() the store first")
+        self._add_instruments(dataset[INSTRUMENT_ID].values)
+
+        pending = []
+        for name in dataset.data_vars:
+            values = self._to_array(dataset[name])
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+            for i, (start, stop) in enumerate(self.index["chunks"]):
+                if isinstance(values, np.ndarray):
+                    self._save_chunk(name, i, values[start:stop])
+                else:
+                    pending.append((values[start:stop],
+                                    self._chunk_path(name, i)))
+            self.index["variables"][name] = values.dtype.str
+
+        if pending:
+            targets = [
+                np.lib.format.open_memmap(path + ".tmp",
+                                          mode="w+",
+                                          dtype=values.dtype,
+                                          shape=values.shape)
+                for values, path in pending
+            ]
+            da.store([values for values, _ in pending], targets, lock=False)
+            for target, (_, path) in zip(targets, pending):
+                target.flush()
+                os.replace(path + ".tmp", path)
+
+        self._write_index()
+
+    def reorder(self, names: Sequence[str]) -> None:
+        """
+        Set the order of the variables, e.g. after writing them one at a time
+        in completion order. Only the index is rewritten.
+
+        Parameters:
+        - names (list): The variables in their new order; the others follow in their current order.
+        """
+        order = [name for name in names if name in self.index["variables"]]
+        order += [name for name in self.variables if name not in order]
+        self.index["variables"] = {
+            name: self.index["variables"][name]
+            for name in order
+        }
+        self._write_index()
+
+    @traced(category="io")
+    def append(self, dataset: xr.Dataset) -> None:
+        """
+        Append new dates to every variable of the store.
+
+        Parameters:
+        - dataset (xarray.Dataset): The variables on dates after the last
+        stored date; it must contain every stored variable.
+        """
+        dates = dataset[DATE_ID].values
+        missing = set(self.variables) - set(dataset.data_vars)
+        if missing:
+            raise ValueError(f"Missing variables to append: {sorted(missing)}")
+        if len(self.index["dates"]) and dates.min() <= self.dates[-1]:
+            raise ValueError("Appended dates must follow the stored dates")
+        if not self.index["dates"]:
+            return self.write(dataset)
+
+        self._add_instruments(dataset[INSTRUMENT_ID].values)
+        values = {
+            name: self._to_array(dataset[name])
+            for name in self.variables
+        }
+
+        # Top up the last chunk before starting new ones
+        last = len(self.index["chunks"]) - 1
+        start, stop = self.index["chunks"][last]
+        n_merge = min(self.chunk_size - (stop - start), len(dates))
+        if n_merge > 0:
+            for name in self.variables:
+                merged = np.concatenate(
+                    [self._load_chunk(name, last), values[name][:n_merge]])
+                self._save_chunk(name, last, merged)
+            self.index["chunks"][last] = [start, stop + n_merge]
+
+        first_new = len(self.index["chunks"])
+        self.index["dates"] += self._date_strings(dates)
+        self._add_chunks(stop + n_merge, len(self.index["dates"]))
+        for i in range(first_new, len(self.index["chunks"])):
+            chunk_start, chunk_stop = self.index["chunks"][i]
+            for name in self.variables:
+                self._save_chunk(
+                    name, i,
+                    values[name][chunk_start - stop:chunk_stop - stop])
+
+        self._write_index()
+
+    @traced(category="io")
+    def load(self,
+             variables: Optional[Sequence[str]] = None,
+             instruments: Optional[Sequence] = None,
+             start=None,
+             end=None) -> xr.Dataset:
+        """
+        Load a subset of the store into memory.
+
+        Parameters:
+        - variables (list): The variables to load. Default is all of them.
+        - instruments (list): The instruments to load. Default is all of them.
+        - start: The first date to load, inclusive. Default is the first date.
+        - end: The last date to load, inclusive. Default is the last date.
+
+        Returns:
+        - xarray.Dataset: The (stk_id, date) variables.
+        """
+        variables = self.variables if variables is None else list(variables)
+        dates = self.dates
+        date_start = 0 if start is None else np.searchsorted(
+            dates, self._to_date(start, dates.dtype), "left")
+        date_stop = len(dates) if end is None else np.searchsorted(
+            dates, self._to_date(end, dates.dtype), "right")
+
+        all_instruments = self.instruments
+        if instruments is None:
+            columns = np.arange(len(all_instruments))
+        else:
+            columns = pd.Index(all_instruments).get_indexer(list(instruments))
+            if (columns < 0).any():
+                raise KeyError("Unknown instruments: %s" %
+                               list(np.asarray(instruments)[columns < 0]))
+
+        coords = {
+            DATE_ID: dates[date_start:date_stop],
+            INSTRUMENT_ID: all_instruments[columns]
+        }
+        data = {}
+        for name in variables:
+            values = np.full((date_stop - date_start, len(columns)),
+                             np.nan,
+                             dtype=self.index["variables"][name])
+            for i, (chunk_start,
+                    chunk_stop) in enumerate(self.index["chunks"]):
+                lo = max(chunk_start, date_start)
+                hi = min(chunk_stop, date_stop)
+                if lo >= hi:
+                    continue
+                chunk = np.load(self._chunk_path(name, i), mmap_mode="r")
+                # Chunks written before an instrument was added lack its column
+                known = columns < chunk.shape[1]
+                values[lo - date_start:hi - date_start, known] = chunk[
+                    lo - chunk_start:hi - chunk_start][:, columns[known]]
+            data[name] = xr.DataArray(values,
+                                      coords=coords,
+                                      dims=(DATE_ID, INSTRUMENT_ID)).transpose(
+                                          INSTRUMENT_ID, DATE_ID)
+        return xr.Dataset(data)
+
+    def _read_index(self) -> Dict:
+        if self.exists():
+            with open(os.path.join(self.path, self.index_file)) as f:
+                return json.load(f)
+        return {
+            "date_dtype": "datetime64[ns]",
+            "dates": [],
+            "instruments": [],
+            "chunks": [],
+            "variables": {}
+        }
+
+    def _write_index(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, self.index_file)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _to_date(date, dtype) -> np.datetime64:
+        return pd.Timestamp(date).to_datetime64().astype(dtype)
+
+    @staticmethod
+    def _date_strings(dates: np.ndarray) -> List[str]:
+        return [str(date) for date in np.datetime_as_string(dates)]
+
+    def _set_dates(self, dates: np.ndarray) -> None:
+        self.index["date_dtype"] = str(dates.dtype)
+        self.index["dates"] = self._date_strings(dates)
+
+    def _add_chunks(self, start: int, stop: int) -> None:
+        for chunk_start in range(start, stop, self.chunk_size):
+            self.index["chunks"].append(
+                [chunk_start, min(chunk_start + self.chunk_size, stop)])
+
+    def _add_instruments(self, instruments: np.ndarray) -> None:
+        known = set(self.index["instruments"])
+        self.index["instruments"] += [
+            instrument.item() if isinstance(instrument, np.generic) else
+            instrument for instrument in instruments if instrument not in known
+        ]
+
+    def _to_array(self, data: xr.DataArray) -> np.ndarray:
+        """
+        Align a variable to the store instruments as a (date, stk_id) array.
+        Chunked variables stay lazy dask arrays.
+        """
+        data = data.reindex({INSTRUMENT_ID: self.instruments})
+        data = data.transpose(DATE_ID, INSTRUMENT_ID).data
+        if da is not None and isinstance(data, da.Array):
+            return data
+        return np.ascontiguousarray(data)
+
+    def _chunk_path(self, name: str, i: int) -> str:
+        return os.path.join(self.path, name, "%05d.npy" % i)
+
+    def _load_chunk(self, name: str, i: int) -> np.ndarray:
+        chunk = np.load(self._chunk_path(name, i))
+        padded = np.full((chunk.shape[0], len(self.index["instruments"])),
+                         np.nan,
+                         dtype=chunk.dtype)
+        padded[:, :chunk.shape[1]] = chunk
+        return padded
+
+    def _save_chunk(self, name: str, i: int, values: np.ndarray) -> None:
+        path = self._chunk_path(name, i)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, values)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,129 @@
+from typing import Callable, Dict, List, Optional, Sequence
+
+from .compute_engine import ComputeEngine
+from .data_engine import DataEngine
+
+
+class FactorRegistry(object):
+    """
+    A registry of factor functions, each declaring the factors it builds and
+    the DataEngine fields it reads.
+
+    A factor function takes a DataEngine, a ComputeEngine and a dict, adds its
+    factors to the dict and returns it, e.g.
+
+        registry = FactorRegistry()
+
+        @registry.register(["PAST_RETURN_5"], fields=["close_adj"])
+        def factor_past_return(data_engine, compute_engine, factors):
+            factors["PAST_RETURN_5"] = ...
+            return factors
+
+    Methods:
+    - register(names, fields): Decorator registering a factor function.
+    - names: The names of every registered factor.
+    - fields(names): The fields needed by some factors.
+    - build(data_engine, compute_engine, names): Build some factors.
+    """
+
+    def __init__(self) -> None:
+        self.functions: Dict[str, dict] = {}
+
+    def register(self, names: Sequence[str],
+                 fields: Sequence[str]) -> Callable:
+        """
+        Register a factor function.
+
+        Parameters:
+        - names (list): The names of the factors the function builds.
+        - fields (list): The DataEngine fields the function reads, e.g. ["close_adj", "volume"].
+
+        Returns:
+        - callable: The decorator, which returns the function unchanged.
+        """
+
+        def decorate(func):
+            registered = set(self.names)
+            duplicates = [name for name in names if name in registered]
+            if duplicates:
+                raise ValueError("Factors %s are already registered" %
+                                 duplicates)
+            self.functions[func.__name__] = {
+                "function": func,
+                "names": list(names),
+                "fields": list(fields)
+            }
+            return func
+
+        return decorate
+
+    @property
+    def names(self) -> List[str]:
+        """
+        Get the names of every registered factor, in registration order.
+
+        Returns:
+        - list: The factor names.
+        """
+        return [
+            name for entry in self.functions.values()
+            for name in entry["names"]
+        ]
+
+    def fields(self, names: Optional[Sequence[str]] = None) -> List[str]:
+        """
+        Get the DataEngine fields needed to build some factors.
+
+        Parameters:
+        - names (list, optional): The factors. Default is all of them.
+
+        Returns:
+        - list: The field names, e.g. to load with DataEngine(columns=...).
+        """
+        fields = [
+            field for entry in self._entries(names)
+            for field in entry["fields"]
+        ]
+        return list(dict.fromkeys(fields))
+
+    def build(self,
+              data_engine: DataEngine,
+              compute_engine: ComputeEngine,
+              names: Optional[Sequence[str]] = None) -> Dict:
+        """
+        Build some factors by calling the functions that declare them.
+
+        With the lazy engines of an ExpressionGraph, the factors are nodes of
+        the graph and nothing is computed yet.
+
+        Parameters:
+        - data_engine (DataEngine): The data engine.
+        - compute_engine (ComputeEngine): The compute engine.
+        - names (list, optional): The factors to build. Default is all of them.
+
+        Returns:
+        - dict: The factors by name.
+        """
+        factors = {}
+        for entry in self._entries(names):
+            built = entry["function"](data_engine, compute_engine, {})
+            if set(built) != set(entry["names"]):
+                raise ValueError(
+                    "%s built %s instead of the registered factors %s" %
+                    (entry["function"].__name__, sorted(built),
+                     sorted(entry["names"])))
+            factors.update(built)
+        if names is not None:
+            factors = {name: factors[name] for name in names}
+        return factors
+
+    def _entries(self, names):
+        if names is None:
+            return list(self.functions.values())
+        unknown = set(names) - set(self.names)
+        if unknown:
+            raise KeyError("Unknown factors %s" % sorted(unknown))
+        return [
+            entry for entry in self.functions.values()
+            if set(entry["names"]) & set(names)
+        ]
@@ -0,0 +1,476 @@
+"""
+Streaming rolling-window kernels along the last axis of an array.
+
+Every kernel runs in time linear in the series length, independent of the
+window, and never builds a (..., window) tensor, although it allocates several
+full-size temporaries (see below). Windows follow xarray's rolling with
+min_periods equal to the window: the first window - 1 values and any window
+containing a NaN are NaN, hence every value when the window is longer than the
+series. rolling_corr and rolling_cov use the valid
+pairs of each trailing window, like xr.corr over rolling(...).construct(...).
+
+Sums, means, stds, correlations and covariances come from running sums
+(block-wise prefix and suffix sums, centered on the previous block's mean), so
+a value only depends on past values and on the position of the window-sized
+blocks, and never on dates after it. The *_multi kernels compute a family of
+windows in one pass from the block sums of the longest window. The block sums
+are combined into each window's moments by a numba kernel when numba is
+installed. Max and min use a monotonic deque compiled with numba when it is
+installed, and the van Herk/Gil-Werman block algorithm in NumPy otherwise.
+
+The kernels trade memory for speed: block sums, references and moments are
+float64 arrays of the input's shape, whatever the input dtype, so the rolling
+sum, mean and std peak at about 12 such arrays with numba (20 without), the
+rolling corr and cov at about 22 (31 without) and max and min at about 5;
+twice as many input sizes for float32 input. The *_multi kernels add about two
+such arrays per window.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Relative variance below which a window is treated as constant
+VAR_EPS = 1e-12
+
+
+def _out_dtype(x):
+    return x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+
+
+def _blocked(x, window):
+    """
+    Zero-pad the last axis to whole blocks of window values.
+    """
+    length = x.shape[-1]
+    blocks = -(-length // window)
+    padded = np.zeros(x.shape[:-1] + (blocks * window, ))
+    padded[..., :length] = x
+    return padded.reshape(x.shape[:-1] + (blocks, window))
+
+
+def _block_sums(x, block):
+    """
+    Prefix and suffix sums of x within blocks of block values anchored at the
+    start of the series. They are shared by every window up to block long.
+    """
+    length = x.shape[-1]
+    blocks = _blocked(x, block)
+    prefix = np.cumsum(blocks, axis=-1).reshape(x.shape[:-1] +
+                                                (-1, ))[..., :length]
+    # The suffix sums overwrite the padded copy, which stays contiguous
+    np.cumsum(blocks[..., ::-1], axis=-1, out=blocks[..., ::-1])
+    suffix = blocks.reshape(x.shape[:-1] + (-1, ))[..., :length]
+    return prefix, suffix
+
+
+def _segment_sums(sums, block, window):
+    """
+    Sum x over the two parts of each trailing window, from its block sums.
+
+    No window is longer than a block, so a window either starts in the block
+    of its end (tail only) or is the tail of the previous block (head) plus
+    the start of the current block up to the window end (tail). Sums restart
+    every block, so rounding errors do not accumulate over the series and a
+    value only depends on the past values of its two blocks.
+    """
+    prefix, suffix = sums
+    length = prefix.shape[-1]
+    ends = np.arange(length)
+    starts = np.maximum(ends - window + 1, 0)
+    split = starts // block < ends // block
+    inner = ~split & (starts % block != 0)
+
+    # Window starts are the ends shifted by window - 1, so slice rather than
+    # gather; no window ends in the series if it is longer than the series
+    complete = max(length - window + 1, 0)
+    head = np.zeros(prefix.shape)
+    head[..., window - 1:] = np.where(split[window - 1:],
+                                      suffix[..., :complete], 0)
+    tail = prefix.copy()
+    if inner.any():
+        tail[..., window:] -= np.where(inner[window:],
+                                       prefix[..., :max(complete - 1, 0)], 0)
+    return head, tail
+
+
+def _block_ref(x, valid, window):
+    """
+    Reference value of each position: the mean of the valid values of the
+    previous block (of the first block for itself), 0 if none.
+
+    Only past values are used, so values computed before later dates arrive
+    do not change once those dates are added.
+    """
+    length = x.shape[-1]
+    total = _blocked(np.where(valid, x, 0), window).sum(axis=-1)
+    count = _blocked(valid, window).sum(axis=-1)
+    mean = total / np.maximum(count, 1)
+    ref = np.concatenate([mean[..., :1], mean[..., :-1]], axis=-1)
+    return np.repeat(ref, window, axis=-1)[..., :length]
+
+
+def _block_moments(x, y, block):
+    """
+    References of x (and y) and the block sums of the counts and of the
+    centered values, their squares and cross products, shared by every
+    window up to block long.
+    """
+    valid = ~np.isnan(x) if y is None else ~(np.isnan(x) | np.isnan(y))
+
+    def center(z):
+        ref = _block_ref(z, valid, block)
+        zc = np.where(valid, z - ref, 0)
+        return zc, (ref, _block_sums(zc, block), _block_sums(zc**2, block))
+
+    xc, moments_x = center(x)
+    moments = {"n": _block_sums(valid, block), "x": moments_x}
+    if y is not None:
+        yc, moments["y"] = center(y)
+        moments["xy"] = _block_sums(xc * yc, block)
+    return moments
+
+
+def _combine_moments(moments, block, window):
+    """
+    Count, sums and centered second moments of one window from the block
+    sums, in NumPy.
+    """
+    n_head, n_tail = _segment_sums(moments["n"], block, window)
+    n = n_head + n_tail
+
+    def center(ref, z_sums, zz_sums):
+        complete = max(ref.shape[-1] - window + 1, 0)
+        shift = np.zeros(ref.shape)
+        shift[..., window - 1:] = ref[..., :complete] - ref[..., window - 1:]
+        z_head, z_tail = _segment_sums(z_sums, block, window)
+        zz_head, zz_tail = _segment_sums(zz_sums, block, window)
+        s = z_head + n_head * shift + z_tail
+        ss = zz_head + 2 * shift * z_head + n_head * shift**2 + zz_tail
+        with np.errstate(invalid="ignore", divide="ignore"):
+            m2 = np.maximum(ss - s**2 / n, 0)
+        # Windows whose variance is lost in rounding are constant
+        m2[m2 <= VAR_EPS * (zz_head + n_head * shift**2 + zz_tail)] = 0
+        return shift, z_head, s, m2
+
+    dx, x_head, sx, mxx = center(*moments["x"])
+    if "y" not in moments:
+        return n, moments["x"][0], sx, mxx
+
+    dy, y_head, sy, myy = center(*moments["y"])
+    xy_head, xy_tail = _segment_sums(moments["xy"], block, window)
+    sxy = (xy_head + dx * y_head + dy * x_head + n_head * dx * dy + xy_tail)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mxy = sxy - sx * sy / n
+    return n, mxx, myy, mxy
+
+
+if numba is not None:
+
+    @numba.njit(cache=True, nogil=True, error_model="numpy")
+    def _fused_moments(n_sums, x_moments, y_moments, xy_sums, block, window,
+                       paired):
+        """
+        Count, sums and centered second moments of one window from the block
+        sums, in one pass without temporaries. The same operations as
+        _combine_moments, on (row, date) arrays.
+        """
+        n_pre, n_suf = n_sums
+        rx, (x_pre, x_suf), (xx_pre, xx_suf) = x_moments
+        ry, (y_pre, y_suf), (yy_pre, yy_suf) = y_moments
+        xy_pre, xy_suf = xy_sums
+        rows, length = n_pre.shape
+        n = np.empty((rows, length))
+        sx = np.empty((rows, length))
+        mxx = np.empty((rows, length))
+        # Only filled for pairs
+        myy = np.empty((rows, length if paired else 0))
+        mxy = np.empty((rows, length if paired else 0))
+        for r in range(rows):
+            for t in range(length):
+                start = max(t - window + 1, 0)
+                split = start // block < t // block
+                inner = not split and start % block != 0
+
+                def segment(pre, suf):
+                    head = suf[r, start] if split else 0.0
+                    tail = pre[r, t] - pre[r, t - window] if inner else pre[r,
+                                                                            t]
+                    return head, tail
+
+                n_head, n_tail = segment(n_pre, n_suf)
+                nn = n_head + n_tail
+                n[r, t] = nn
+
+                dx = rx[r, start] - rx[r, t] if t >= window - 1 else 0.0
+                x_head, x_tail = segment(x_pre, x_suf)
+                xx_head, xx_tail = segment(xx_pre, xx_suf)
+                s_x = x_head + n_head * dx + x_tail
+                m2 = (xx_head + 2 * dx * x_head + n_head * (dx * dx) +
+                      xx_tail) - s_x * s_x / nn
+                if m2 < 0:
+                    m2 = 0.0
+                if m2 <= VAR_EPS * (xx_head + n_head * (dx * dx) + xx_tail):
+                    m2 = 0.0
+                sx[r, t] = s_x
+                mxx[r, t] = m2
+                if not paired:
+                    continue
+
+                dy = ry[r, start] - ry[r, t] if t >= window - 1 else 0.0
+                y_head, y_tail = segment(y_pre, y_suf)
+                yy_head, yy_tail = segment(yy_pre, yy_suf)
+                s_y = y_head + n_head * dy + y_tail
+                m2 = (yy_head + 2 * dy * y_head + n_head * (dy * dy) +
+                      yy_tail) - s_y * s_y / nn
+                if m2 < 0:
+                    m2 = 0.0
+                if m2 <= VAR_EPS * (yy_head + n_head * (dy * dy) + yy_tail):
+                    m2 = 0.0
+                myy[r, t] = m2
+
+                xy_head, xy_tail = segment(xy_pre, xy_suf)
+                sxy = (xy_head + dx * y_head + dy * x_head + n_head * dx * dy +
+                       xy_tail)
+                mxy[r, t] = sxy - s_x * s_y / nn
+        return n, sx, mxx, myy, mxy
+
+
+def _flat(moments):
+    """
+    Reshape the arrays of nested tuples to (row, date).
+    """
+    if isinstance(moments, tuple):
+        return tuple(_flat(m) for m in moments)
+    return moments.reshape(-1, moments.shape[-1])
+
+
+def _window_moments(x, y, windows):
+    """
+    Running count, sums and centered second moments of the valid pairs of
+    each window, on blocks of the longest window.
+
+    Values are centered on a block reference to avoid cancellation, and the
+    head of each window is moved onto the reference of the current block.
+    Sums are centered on the returned references; y may be None. The block
+    sums are combined into the moments of each window by a numba kernel
+    when numba is installed, and in NumPy otherwise.
+
+    x and y have a leading axis of one row per window, or a single row
+    shared by every window, whose block sums are then only computed once.
+    Windows are yielded one at a time to bound memory.
+    """
+    block = max(windows)
+    if y is not None:
+        x, y = np.broadcast_arrays(x, y)
+    moments = None
+    for k, window in enumerate(windows):
+        if moments is None or len(x) > 1:
+            moments = _block_moments(x[k if len(x) > 1 else 0],
+                                     None if y is None else
+                                     y[k if len(y) > 1 else 0], block)
+        if numba is None:
+            yield _combine_moments(moments, block, window)
+            continue
+
+        shape = moments["n"][0].shape
+        paired = "y" in moments
+        n, sx, mxx, myy, mxy = (m.reshape(shape[:-1] + (-1, ))
+                                for m in _fused_moments(
+                                    _flat(moments["n"]), _flat(moments["x"]),
+                                    _flat(moments["y" if paired else "x"]),
+                                    _flat(moments["xy" if paired else "n"]),
+                                    block, window, paired))
+        yield (n, mxx, myy, mxy) if paired else (n, moments["x"][0], sx, mxx)
+
+
+def _sum(n, ref, sx, mxx, window):
+    return sx + n * ref
+
+
+def _mean(n, ref, sx, mxx, window):
+    return sx / window + ref
+
+
+def _std(n, ref, sx, mxx, window, ddof=0):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.sqrt(mxx / (window - ddof))
+
+
+def _corr(n, mxx, myy, mxy, window):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = mxy / np.sqrt(mxx * myy)
+    out[(n < 2) | (mxx == 0) | (myy == 0)] = np.nan
+    return out
+
+
+def _cov(n, mxx, myy, mxy, window, ddof=1):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = mxy / (n - ddof)
+    out[n <= ddof] = np.nan
+    return out
+
+
+def _rolling(stat, x, y, windows, full, **kwargs):
+    """
+    Apply a window statistic to every window, on the window axis of x and y
+    (second to last), NaN on incomplete windows if full.
+    """
+    x = np.moveaxis(np.asarray(x), -2, 0)
+    y = None if y is None else np.moveaxis(np.asarray(y), -2, 0)
+    dtype = _out_dtype(x) if y is None else np.result_type(
+        _out_dtype(x), _out_dtype(y))
+
+    out = np.empty((len(windows), ) + np.broadcast_shapes(
+        x.shape[1:], x.shape[1:] if y is None else y.shape[1:]),
+                   dtype=dtype)
+    for k, (window, moments) in enumerate(
+            zip(windows, _window_moments(x, y, windows))):
+        value = stat(*moments, window, **kwargs)
+        if full:
+            value[moments[0] != window] = np.nan
+        out[k] = value
+    return np.moveaxis(out, 0, -2)
+
+
+def rolling_sum(x, window):
+    return _rolling(_sum, np.asarray(x)[..., None, :], None, [window],
+                    True)[..., 0, :]
+
+
+def rolling_mean(x, window):
+    return _rolling(_mean, np.asarray(x)[..., None, :], None, [window],
+                    True)[..., 0, :]
+
+
+def rolling_std(x, window, ddof=0):
+    return _rolling(_std,
+                    np.asarray(x)[..., None, :],
+                    None, [window],
+                    True,
+                    ddof=ddof)[..., 0, :]
+
+
+def rolling_corr(x, y, window):
+    return _rolling(_corr,
+                    np.asarray(x)[..., None, :],
+                    np.asarray(y)[..., None, :], [window], False)[..., 0, :]
+
+
+def rolling_cov(x, y, window, ddof=1):
+    return _rolling(_cov,
+                    np.asarray(x)[..., None, :],
+                    np.asarray(y)[..., None, :], [window],
+                    False,
+                    ddof=ddof)[..., 0, :]
+
+
+# Multi-window kernels compute every window of a family in one pass, sharing
+# the block sums of the longest window. Inputs and outputs have a window axis
+# before the last axis, with one row per window, or a single row for an input
+# shared by every window.
+
+
+def rolling_sum_multi(x, windows):
+    return _rolling(_sum, x, None, windows, True)
+
+
+def rolling_mean_multi(x, windows):
+    return _rolling(_mean, x, None, windows, True)
+
+
+def rolling_std_multi(x, windows, ddof=0):
+    return _rolling(_std, x, None, windows, True, ddof=ddof)
+
+
+def rolling_corr_multi(x, y, windows):
+    return _rolling(_corr, x, y, windows, False)
+
+
+def rolling_cov_multi(x, y, windows, ddof=1):
+    return _rolling(_cov, x, y, windows, False, ddof=ddof)
+
+
+def _move_max_blocks(x, window):
+    """
+    Rolling max by the van Herk/Gil-Werman algorithm, NaN treated as -inf.
+    """
+    length = x.shape[-1]
+    if window > length:
+        return np.full(x.shape, np.nan)
+    blocks = -(-length // window)
+    padded = np.full(x.shape[:-1] + (blocks * window, ), -np.inf)
+    padded[..., :length] = np.where(np.isnan(x), -np.inf, x)
+    padded = padded.reshape(x.shape[:-1] + (blocks, window))
+    prefix = np.maximum.accumulate(padded, axis=-1).reshape(x.shape[:-1] +
+                                                            (-1, ))
+    suffix = np.maximum.accumulate(padded[..., ::-1],
+                                   axis=-1)[..., ::-1].reshape(x.shape[:-1] +
+                                                               (-1, ))
+    out = np.full(x.shape, np.nan)
+    out[..., window - 1:] = np.maximum(suffix[..., :length - window + 1],
+                                       prefix[..., window - 1:length])
+    return out
+
+
+if numba is not None:
+
+    @numba.njit(cache=True, nogil=True)
+    def _move_max_deque(x, window):
+        """
+        Rolling max of each row with a monotonic deque of indices.
+        """
+        rows, length = x.shape
+        out = np.full((rows, length), np.nan)
+        deque = np.empty(length, np.int64)
+        for r in range(rows):
+            head, tail, n_nan = 0, 0, 0
+            for t in range(length):
+                value = x[r, t]
+                if np.isnan(value):
+                    n_nan += 1
+                else:
+                    while tail > head and x[r, deque[tail - 1]] <= value:
+                        tail -= 1
+                    deque[tail] = t
+                    tail += 1
+                if t >= window and np.isnan(x[r, t - window]):
+                    n_nan -= 1
+                while tail > head and deque[head] <= t - window:
+                    head += 1
+                if t >= window - 1 and n_nan == 0:
+                    out[r, t] = x[r, deque[head]]
+        return out
+
+
+def _move_max(x, window):
+    if numba is not None:
+        flat = np.ascontiguousarray(x, dtype=np.float64).reshape(
+            -1, x.shape[-1])
+        return _move_max_deque(flat, window).reshape(x.shape)
+    return _move_max_blocks(x, window)
+
+
+def _full_windows(x, window):
+    """
+    Mask of the windows that are complete and contain no NaN.
+    """
+    head, tail = _segment_sums(_block_sums(~np.isnan(x), window), window,
+                               window)
+    return head + tail == window
+
+
+def rolling_max(x, window):
+    x = np.asarray(x)
+    out = _move_max(x, window)
+    return np.where(_full_windows(x, window), out,
+                    np.nan).astype(_out_dtype(x))
+
+
+def rolling_min(x, window):
+    x = np.asarray(x)
+    out = -_move_max(-x, window)
+    return np.where(_full_windows(x, window), out,
+                    np.nan).astype(_out_dtype(x))
@@ -0,0 +1,290 @@
+import asyncio
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ..backtest.strategy import TopKStrategy
+from ..config import DATE_ID, INSTRUMENT_ID
+from ..factor_composition.utils import DesignMatrix
+from ..factor_construction.compute_engine import ComputeEngine
+from ..factor_construction.data_engine import DataEngine
+
+
+class LiveSignalEngine(object):
+    """
+    Turns each new day of bars into the target positions of the next date.
+
+    Only the bars needed to warm up the factors are kept in memory: the
+    warm-up of the expression graph, rounded to whole blocks of the rolling
+    kernels as in update_factor, so the factors are the same as over the full
+    history. Each update evaluates the factors of the next date on these bars
+    only, and the fitted regressor and the strategy turn them into positions.
+
+    Parameters:
+    - history (xarray.Dataset): The raw (stk_id, date) bars to start from, e.g. DataEngine(...).data. Its adjusted features are dropped.
+    - build_factors (callable): Builds the ExpressionGraph and its outputs from a DataEngine and a ComputeEngine, e.g. factor.build_factors.
+    - regressor (BaseRegressor): The fitted model.
+    - features (list): The factors of the model, in the order of its training features.
+    - strategy (BaseStrategy, optional): Turns the predictions into positions. Default is TopKStrategy(k=5).
+    - compute_engine (ComputeEngine, optional): The compute engine. Default is ComputeEngine().
+    """
+
+    def __init__(self,
+                 history,
+                 build_factors,
+                 regressor,
+                 features,
+                 strategy=None,
+                 compute_engine=None):
+        self.build_factors = build_factors
+        self.regressor = regressor
+        self.features = list(features)
+        self.strategy = TopKStrategy(k=5) if strategy is None else strategy
+        self.compute_engine = ComputeEngine(
+        ) if compute_engine is None else compute_engine
+
+        graph, outputs = self._build(history)
+        self.warmup, windows = graph.warmup(
+            {name: outputs[name]
+             for name in self.features})
+        self.period = int(np.lcm.reduce(windows)) if windows else 1
+
+        # Keep the raw columns only: adjusted features computed on the history
+        # (e.g. close_adj) are not in the new bars, and are rebuilt from them
+        self.data = history.drop_vars([
+            name for name in history.data_vars
+            if name.endswith("_adj") and name[:-4] in DataEngine.adj_cols
+        ])
+        self._trim()
+        self.date = None
+        self.positions = None
+
+    def update(self, bars, next_date=None):
+        """
+        Add new bars and compute the positions of the next date.
+
+        Parameters:
+        - bars (pandas.DataFrame): The bars of one or more new dates, with the date, stk_id and raw data columns.
+        - next_date (optional): The date of the positions. Default is the next business day.
+
+        Returns:
+        - xarray.DataArray: The target position of each stock.
+        """
+        bars = bars.astype({DATE_ID: self.data[DATE_ID].dtype})
+        if (bars[DATE_ID] <= self.data[DATE_ID].values[-1]).any():
+            raise ValueError("The bars must be after the last date %s" %
+                             self.data[DATE_ID].values[-1])
+        bars = bars.set_index([DATE_ID, INSTRUMENT_ID]).to_xarray()
+        bars = bars[list(self.data.data_vars)].transpose(INSTRUMENT_ID, DATE_ID)
+
+        self.data = xr.concat([self.data, bars], dim=DATE_ID, join="outer")
+        self._trim()
+        return self.predict(next_date)
+
+    def predict(self, next_date=None):
+        """
+        Compute the positions of the date after the last bars.
+
+        Parameters:
+        - next_date (optional): The date of the positions. Default is the next business day.
+
+        Returns:
+        - xarray.DataArray: The target position of each stock.
+        """
+        if next_date is None:
+            next_date = (pd.Timestamp(self.data[DATE_ID].values[-1]) +
+                         pd.offsets.BDay()).to_datetime64()
+        next_date = np.array([next_date]).astype(self.data[DATE_ID].dtype)[0]
+
+        # The factors of the next date only use the bars up to the last date
+        placeholder = xr.full_like(self.data.isel({DATE_ID: [-1]}), np.nan)
+        data = xr.concat(
+            [self.data,
+             placeholder.assign_coords({DATE_ID: [next_date]})],
+            dim=DATE_ID)
+        graph, outputs = self._build(data)
+        factors = graph.evaluate({name: outputs[name] for name in self.features})
+        factors = xr.Dataset({
+            name: value.isel({DATE_ID: [-1]})
+            for name, value in factors.items()
+        })
+
+        dataset = DesignMatrix.from_dataset(factors)
+        predictions = self.regressor.predict(dataset) if len(dataset) else []
+        signal = dataset.to_grid(predictions, "signals").isel({DATE_ID: 0})
+
+        self.date = next_date
+        self.positions = self.strategy.get_position(signal)
+        return self.positions
+
+    def weights(self):
+        """
+        Get the non-zero target weights of the last positions.
+
+        Returns:
+        - dict: The date of the positions and the weight of each stock.
+        """
+        if self.positions is None:
+            return {"date": None, "weights": {}}
+        positions = self.positions.where(self.positions != 0).dropna(
+            INSTRUMENT_ID)
+        date = self.date
+        if isinstance(date, np.datetime64):
+            date = np.datetime_as_string(date, unit="D")
+        return {
+            "date": str(date),
+            "weights": {
+                str(stk): float(weight)
+                for stk, weight in zip(positions[INSTRUMENT_ID].values,
+                                       positions.values)
+            }
+        }
+
+    def _build(self, data):
+        data_engine = DataEngine.from_dataset(data, DATE_ID, INSTRUMENT_ID)
+        return self.build_factors(data_engine, self.compute_engine)
+
+    def _trim(self):
+        # Drop whole periods, so the rolling blocks keep their alignment
+        n_drop = max(len(self.data[DATE_ID]) - self.warmup,
+                     0) // self.period * self.period
+        self.data = self.data.isel({DATE_ID: slice(n_drop, None)})
+
+
+class FileFeed(object):
+    """
+    A local stand-in for the market feed: a directory where the bars of each
+    day are dropped as a feather or csv file, read in file name order.
+
+    Parameters:
+    - path (str): The directory of the bar files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seen = set()
+
+    def poll(self):
+        """
+        Read the bar files that were not read yet.
+
+        Returns:
+        - list: The bars of each new file, as pandas.DataFrame.
+        """
+        bars = []
+        for path in sorted(glob.glob(os.path.join(self.path, "*"))):
+            if path in self.seen or not path.endswith((".feather", ".csv")):
+                continue
+            if path.endswith(".feather"):
+                bars.append(pd.read_feather(path))
+            else:
+                bars.append(pd.read_csv(path, dtype={INSTRUMENT_ID: str}))
+            self.seen.add(path)
+        return bars
+
+
+class LiveSignalService(object):
+    """
+    An asyncio service around a LiveSignalEngine.
+
+    It follows a feed, and answers line-delimited JSON requests over TCP:
+    {"op": "positions"} returns the last target weights, and
+    {"op": "update", "bars": [...], "next_date": ...} adds the bars (records
+    of date, stk_id and the raw columns) and returns the new weights. The
+    factors are computed in a worker thread, one update at a time.
+
+    Parameters:
+    - engine (LiveSignalEngine): The signal engine.
+    - feed (FileFeed, optional): The feed to follow. Default is None.
+    - interval (float): The polling interval of the feed, in seconds. Default is 1.
+    """
+
+    def __init__(self, engine, feed=None, interval=1.0):
+        self.engine = engine
+        self.feed = feed
+        self.interval = interval
+        self._lock = None
+        self._follower = None
+
+    async def update(self, bars=None, next_date=None):
+        """
+        Update the engine in a worker thread, or only compute the positions
+        when there are no bars.
+
+        Returns:
+        - dict: The new target weights.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            if bars is None:
+                await loop.run_in_executor(None, self.engine.predict,
+                                           next_date)
+            else:
+                await loop.run_in_executor(None, self.engine.update, bars,
+                                           next_date)
+            return self.engine.weights()
+
+    async def positions(self):
+        """
+        Get the last target weights, after any running update.
+
+        Returns:
+        - dict: The target weights.
+        """
+        async with self._lock:
+            return self.engine.weights()
+
+    async def follow(self):
+        """
+        Poll the feed and update the engine with every new file of bars.
+        """
+        while True:
+            for bars in self.feed.poll():
+                await self.update(bars)
+            await asyncio.sleep(self.interval)
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests of one connection.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if request.get("op") == "positions":
+                        response = await self.positions()
+                    elif request.get("op") == "update":
+                        response = await self.update(
+                            pd.DataFrame(request["bars"]),
+                            request.get("next_date"))
+                    else:
+                        raise ValueError("Unknown op %r" % request.get("op"))
+                except Exception as error:
+                    response = {"error": str(error)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        """
+        Compute the current positions, then serve requests and follow the feed.
+
+        Parameters:
+        - host (str): The address to listen on. Default is 127.0.0.1.
+        - port (int): The port to listen on. Default is 8765.
+        """
+        self._lock = asyncio.Lock()
+        await self.update()
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            if self.feed is not None:
+                self._follower = asyncio.create_task(self.follow())
+            await server.serve_forever()
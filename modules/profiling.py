@@ -0,0 +1,290 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# The active tracer, None when tracing is disabled
+_tracer = None
+
+
+class Tracer(object):
+    """
+    Records the wall time, CPU time, memory and output size of pipeline stages.
+
+    Every span records its start and duration, the CPU time of the process,
+    the resident set size at its end, how much it raised the peak resident
+    set size of the process, and the size in bytes of the arrays it returned.
+    Spans may be nested, and are kept per thread.
+
+    Methods:
+    - span(name, category, **args): A context manager recording a span.
+    - summary(): The total time and memory of each stage.
+    - to_chrome_trace(path): Export the timeline for chrome://tracing or Perfetto.
+    - to_json(path): Export the recorded spans.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category="pipeline", **args):
+        """
+        Record the span of the enclosed code.
+
+        Parameters:
+        - name (str): The stage name, e.g. "DataEngine.load_data" or a factor name.
+        - category (str): The stage category. Default is "pipeline".
+        - args: Extra values to record. The yielded dict can be updated with more, e.g. nbytes.
+        """
+        peak_rss = _peak_rss()
+        cpu = time.process_time()
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter_ns()
+            event = {
+                "name": name,
+                "category": category,
+                "start_us": (start - self._origin) / 1e3,
+                "wall_s": (end - start) / 1e9,
+                "cpu_s": time.process_time() - cpu,
+                "rss_mb": _rss(),
+                "peak_rss_growth_mb": _peak_rss() - peak_rss,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """
+        Get the total time and memory of each stage, slowest first.
+
+        The times of nested stages are also included in those of their parents.
+
+        Returns:
+        - pandas.DataFrame: The number of calls, total wall and CPU time,
+        maximum resident set size, peak growth and output size of each stage.
+        """
+        columns = [
+            "calls", "wall_s", "cpu_s", "max_rss_mb", "peak_rss_growth_mb",
+            "nbytes_mb"
+        ]
+        if not self.events:
+            return pd.DataFrame(columns=columns)
+        events = pd.DataFrame([{
+            "name": event["name"],
+            "wall_s": event["wall_s"],
+            "cpu_s": event["cpu_s"],
+            "rss_mb": event["rss_mb"],
+            "peak_rss_growth_mb": event["peak_rss_growth_mb"],
+            "nbytes_mb": event["args"].get("nbytes", 0) / 2**20,
+        } for event in self.events])
+        summary = events.groupby("name").agg(
+            calls=("wall_s", "size"),
+            wall_s=("wall_s", "sum"),
+            cpu_s=("cpu_s", "sum"),
+            max_rss_mb=("rss_mb", "max"),
+            peak_rss_growth_mb=("peak_rss_growth_mb", "sum"),
+            nbytes_mb=("nbytes_mb", "sum"))
+        return summary[columns].sort_values("wall_s", ascending=False)
+
+    def to_chrome_trace(self, path):
+        """
+        Export the spans as a Chrome trace, to open in chrome://tracing or Perfetto.
+
+        Parameters:
+        - path (str): The JSON file to write.
+        """
+        events = [{
+            "name": event["name"],
+            "cat": event["category"],
+            "ph": "X",
+            "ts": event["start_us"],
+            "dur": event["wall_s"] * 1e6,
+            "pid": event["pid"],
+            "tid": event["tid"],
+            "args": {
+                "cpu_s": event["cpu_s"],
+                "rss_mb": event["rss_mb"],
+                "peak_rss_growth_mb": event["peak_rss_growth_mb"],
+                **event["args"]
+            },
+        } for event in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f, default=str)
+
+    def to_json(self, path):
+        """
+        Export the recorded spans as a JSON list.
+
+        Parameters:
+        - path (str): The JSON file to write.
+        """
+        with open(path, "w") as f:
+            json.dump(self.events, f, default=str)
+
+
+class _NullSpan(object):
+    """
+    The span of a disabled tracer, which records nothing.
+    """
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def enable(tracer=None):
+    """
+    Start recording spans.
+
+    Parameters:
+    - tracer (Tracer, optional): The tracer to record to. Default is a new Tracer.
+
+    Returns:
+    - Tracer: The active tracer.
+    """
+    global _tracer
+    _tracer = Tracer() if tracer is None else tracer
+    return _tracer
+
+
+def disable():
+    """
+    Stop recording spans.
+
+    Returns:
+    - Tracer: The tracer that was active, or None.
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def tracing(tracer=None):
+    """
+    Record the spans of the enclosed code, e.g.
+
+        with tracing() as tracer:
+            compute_factor(data_engine, compute_engine)
+        tracer.to_chrome_trace("trace.json")
+
+    Parameters:
+    - tracer (Tracer, optional): The tracer to record to. Default is a new Tracer.
+    """
+    previous = _tracer
+    try:
+        yield enable(tracer)
+    finally:
+        enable(previous) if previous is not None else disable()
+
+
+def span(name, category="pipeline", **args):
+    """
+    Record the span of the enclosed code if tracing is enabled, e.g.
+
+        with span("fit", model="lasso") as record:
+            ...
+            record["nbytes"] = X.nbytes
+
+    Parameters:
+    - name (str): The stage name.
+    - category (str): The stage category. Default is "pipeline".
+    - args: Extra values to record.
+    """
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, category, **args)
+
+
+def traced(name=None, category="pipeline"):
+    """
+    Decorate a function to record a span of each call if tracing is enabled,
+    with the size of the arrays it returns. A disabled tracer only costs a
+    global lookup per call.
+
+    Parameters:
+    - name (str, optional): The stage name. Default is the qualified name of the function.
+    - category (str): The stage category. Default is "pipeline".
+    """
+
+    def decorate(func):
+        label = func.__qualname__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(label, category) as record:
+                result = func(*args, **kwargs)
+                record["nbytes"] = nbytes(result)
+                return result
+
+        return wrapper
+
+    return decorate
+
+
+def nbytes(value):
+    """
+    Get the size in bytes of the arrays of a value, e.g. a DataArray, a
+    Dataset, a DesignMatrix or a tuple of them. Lazy (dask) arrays count
+    their full size.
+
+    Parameters:
+    - value: The value.
+
+    Returns:
+    - int: The total size of its arrays, 0 if it has none.
+    """
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    size = getattr(value, "nbytes", None)
+    if isinstance(size, (int, float)):
+        return int(size)
+    if hasattr(value, "__dict__"):
+        return sum(
+            int(v.nbytes) for v in vars(value).values()
+            if isinstance(getattr(v, "nbytes", None), (int, float)))
+    return 0
+
+
+def _rss():
+    """
+    Get the current resident set size of the process in MiB, None if unknown.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss():
+    """
+    Get the peak resident set size of the process in MiB.
+    """
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
@@ -0,0 +1,697 @@
+"""
+Panels of xarray data shared between processes through one memory-mapped file.
+
+A shared panel holds named Datasets and DataArrays, e.g. the DataEngine data,
+the factors and the returns, in a single file. Every array is stored
+contiguously at an aligned offset, and a JSON header records the dims, coords,
+dtypes and offsets. Attaching maps the file read-only and wraps each array as
+a numpy view on the mapping, so the values are never copied or unpickled:
+every process attached to a panel shares the same physical pages. On Linux,
+panels are created in /dev/shm, which is backed by memory like POSIX shared
+memory.
+
+Each attached handle owns a reference file in the panel's .refs directory,
+named after its process. Handles are detached by close(), when they are
+garbage collected, or when the process exits; references of processes that
+died without detaching are ignored and removed. A panel created with
+persist=False is deleted, with its lock files, when its last reference is
+released. The mapping of a deleted panel stays valid until its arrays are
+freed, so detaching never invalidates the arrays of a process, but a panel
+has to stay attached for other processes to find it.
+"""
+import fcntl
+import json
+import mmap
+import os
+import tempfile
+import uuid
+import weakref
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .profiling import traced
+
+MAGIC = b"QSPANEL1"
+# The alignment in bytes of every array of a panel
+ALIGNMENT = 64
+
+
+def default_directory():
+    """
+    Get the directory of the shared panels: /dev/shm if it exists, otherwise
+    the temporary directory.
+
+    Returns:
+    - str: The directory.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def panel_path(name, directory=None):
+    """
+    Get the file of a shared panel.
+
+    Parameters:
+    - name (str): The panel name.
+    - directory (str, optional): The directory of the panels. Default is default_directory().
+
+    Returns:
+    - str: The path of the panel file.
+    """
+    return os.path.join(directory or default_directory(),
+                        f"quantsys-{name}.panel")
+
+
+class SharedPanel(object):
+    """
+    A handle on a shared panel, whose items are read-only xarray objects
+    backed by the memory-mapped panel file.
+
+    Create a panel with SharedPanel.create, attach to it from any process
+    with SharedPanel.attach, and use it as a mapping, e.g.
+
+        with SharedPanel.attach("research") as panel:
+            factors, returns = panel["factors"], panel["returns"]
+
+    SharedPanel.open attaches to a panel, or creates it first if it does not
+    exist, so that parallel jobs load the data only once.
+
+    Parameters:
+    - path (str): The path of the panel file.
+
+    Methods:
+    - create(name, items, directory, persist, overwrite, meta): Create a panel and attach to it.
+    - attach(name, directory): Attach to an existing panel.
+    - open(name, loader, directory, persist, meta): Attach to a panel, creating it with loader() if needed.
+    - exists(name, directory): Whether a panel exists.
+    - unlink(name, directory): Delete a panel even if it is still attached.
+    - keys(): The item names.
+    - check_meta(meta): Check that the panel was created with some metadata.
+    - refcount(): The number of live references to the panel.
+    - close(): Detach from the panel.
+    """
+
+    def __init__(self, path, _ref=None):
+        self.path = path
+        with _locked(path):
+            try:
+                with open(path, "rb") as f:
+                    self.header, data_start = _read_header(f)
+                    self._mmap = mmap.mmap(f.fileno(),
+                                           0,
+                                           access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                # Only remove the lock files
+                _remove(path)
+                raise
+            self._ref = _ref or _add_ref(path)
+        self._data_start = data_start
+        self._items = {}
+        self._finalizer = weakref.finalize(self, _release_ref, path,
+                                           self._ref, os.getpid())
+
+    @classmethod
+    @traced("SharedPanel.create", category="io")
+    def create(cls,
+               name,
+               items,
+               directory=None,
+               persist=False,
+               overwrite=False,
+               meta=None):
+        """
+        Write xarray objects to a new shared panel and attach to it.
+
+        The panel is written to a temporary file and renamed into place, so
+        other processes never attach to a partly written panel. The items
+        are copied one variable at a time, and lazy (dask) variables are
+        only computed when they are copied.
+
+        Parameters:
+        - name (str): The panel name.
+        - items (dict): The Datasets and DataArrays by name, e.g. {"factors": factors, "returns": returns}.
+        - directory (str, optional): The directory of the panels. Default is default_directory().
+        - persist (bool): Keep the panel after its last reference is released, until unlink() is called. Default is False.
+        - overwrite (bool): Replace an existing panel of the same name. Processes attached to it keep the old data. Default is False.
+        - meta (dict, optional): JSON-serializable metadata to record, e.g. how the items were loaded. Default is None.
+
+        Returns:
+        - SharedPanel: A handle attached to the panel.
+        """
+        path = panel_path(name, directory)
+        if not overwrite and os.path.exists(path):
+            raise FileExistsError(f"Shared panel {name} already exists")
+
+        header, sources, size = _layout(items, persist)
+        header["meta"] = _normalize(meta)
+        encoded = json.dumps(header, default=str).encode()
+        data_start = _align(len(MAGIC) + 8 + len(encoded))
+
+        tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex}"
+        try:
+            with open(tmp_path, "wb+") as f:
+                f.write(MAGIC)
+                f.write(np.uint64(len(encoded)).tobytes())
+                f.write(encoded)
+                f.truncate(max(data_start + size, 1))
+                with mmap.mmap(f.fileno(), 0) as mm:
+                    for spec, source in zip(header["arrays"], sources):
+                        target = _view(mm, data_start, spec)
+                        target[...] = source() if callable(source) else source
+                        # The view has to be released before the mapping is closed
+                        del target
+                    mm.flush()
+            with _locked(path):
+                if not overwrite and os.path.exists(path):
+                    raise FileExistsError(
+                        f"Shared panel {name} already exists")
+                # Take the first reference before the panel can be found, so
+                # it is not deleted as unreferenced by another process
+                ref = _add_ref(path)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return cls(path, ref)
+
+    @classmethod
+    def attach(cls, name, directory=None):
+        """
+        Attach to an existing shared panel.
+
+        Parameters:
+        - name (str): The panel name.
+        - directory (str, optional): The directory of the panels. Default is default_directory().
+
+        Returns:
+        - SharedPanel: A handle attached to the panel.
+        """
+        try:
+            return cls(panel_path(name, directory))
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                f"Shared panel {name} does not exist") from None
+
+    @classmethod
+    def open(cls, name, loader, directory=None, persist=False, meta=None):
+        """
+        Attach to a shared panel, creating it first if it does not exist.
+
+        Concurrent calls with the same name are serialized, so only the first
+        one calls loader and the others attach to its panel. With meta, the
+        panel found must have been created with the same metadata.
+
+        Parameters:
+        - name (str): The panel name.
+        - loader (callable): Returns the items of the panel, as in create().
+        - directory (str, optional): The directory of the panels. Default is default_directory().
+        - persist (bool): Keep the panel after its last reference is released. Default is False.
+        - meta (dict, optional): The metadata to record, or to check against the existing panel. Default is None (no check).
+
+        Returns:
+        - SharedPanel: A handle attached to the panel.
+        """
+        path = panel_path(name, directory)
+        with _locked(path, suffix=".create"):
+            try:
+                panel = cls(path)
+            except FileNotFoundError:
+                # Not created yet, or deleted by its last release meanwhile
+                try:
+                    return cls.create(name,
+                                      loader(),
+                                      directory,
+                                      persist,
+                                      meta=meta)
+                except BaseException:
+                    # The lock file is held, so it can be removed
+                    os.remove(path + ".create")
+                    raise
+        if meta is not None:
+            panel.check_meta(meta)
+        return panel
+
+    @staticmethod
+    def exists(name, directory=None):
+        """
+        Check whether a shared panel exists.
+
+        Parameters:
+        - name (str): The panel name.
+        - directory (str, optional): The directory of the panels. Default is default_directory().
+
+        Returns:
+        - bool: True if the panel exists.
+        """
+        return os.path.exists(panel_path(name, directory))
+
+    @staticmethod
+    def unlink(name, directory=None):
+        """
+        Delete a shared panel and its references, even if it is still
+        attached. Attached processes keep their arrays until they free them.
+
+        Parameters:
+        - name (str): The panel name.
+        - directory (str, optional): The directory of the panels. Default is default_directory().
+        """
+        path = panel_path(name, directory)
+        with _locked(path):
+            _remove(path)
+
+    def keys(self):
+        """
+        Get the names of the items of the panel.
+
+        Returns:
+        - list: The item names.
+        """
+        return list(self.header["items"])
+
+    @property
+    def meta(self):
+        """
+        Get the metadata the panel was created with, None if there is none.
+        """
+        return self.header.get("meta")
+
+    def check_meta(self, meta):
+        """
+        Check that the panel was created with some metadata.
+
+        Parameters:
+        - meta (dict): The expected metadata.
+
+        Raises:
+        - ValueError: If the metadata of the panel differs.
+        """
+        if _normalize(meta) != self.meta:
+            raise ValueError(
+                "Shared panel %s was created with %s, not %s" %
+                (os.path.basename(self.path)[len("quantsys-"):-len(".panel")],
+                 self.meta, _normalize(meta)))
+
+    def __contains__(self, key):
+        return key in self.header["items"]
+
+    def __getitem__(self, key):
+        """
+        Get an item of the panel as a read-only Dataset or DataArray backed
+        by the shared memory. Items are built once per handle.
+        """
+        if key not in self._items:
+            if key not in self.header["items"]:
+                raise KeyError(key)
+            self._items[key] = self._build(self.header["items"][key])
+        return self._items[key]
+
+    @property
+    def nbytes(self):
+        """
+        Get the size in bytes of the arrays of the panel.
+
+        Returns:
+        - int: The total size.
+        """
+        return sum(
+            int(np.prod(spec["shape"])) * np.dtype(spec["dtype"]).itemsize
+            for spec in self.header["arrays"])
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
+
+    def refcount(self):
+        """
+        Get the number of live references to the panel, from every process.
+
+        Returns:
+        - int: The number of references, 0 if the panel was deleted.
+        """
+        with _locked(self.path):
+            return len(_live_refs(self.path))
+
+    def close(self):
+        """
+        Detach from the panel, deleting it if this was its last reference and
+        it was not created with persist=True. The items already taken from
+        the panel stay valid.
+        """
+        self._finalizer()
+        self._items = {}
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Arrays still use the mapping, it is unmapped when they are freed
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __repr__(self):
+        return "<SharedPanel %s: %s, %.1f MiB%s>" % (
+            self.path, ", ".join(self.keys()), self.nbytes / 2**20,
+            " (closed)" if self.closed else "")
+
+    def _build(self, item):
+        """
+        Build a Dataset or DataArray from its header, with views on the mapping.
+        """
+        arrays = self.header["arrays"]
+        coords = {
+            name: (coord["dims"],
+                   _view(self._mmap, self._data_start, arrays[coord["array"]]))
+            for name, coord in item["coords"].items()
+        }
+        variables = {
+            name: xr.Variable(
+                var["dims"],
+                _view(self._mmap, self._data_start, arrays[var["array"]]),
+                attrs=var["attrs"])
+            for name, var in item["variables"].items()
+        }
+        if item["kind"] == "DataArray":
+            variable = variables[item["name"] or ""]
+            return xr.DataArray(variable,
+                                coords=coords,
+                                name=item["name"],
+                                attrs=item["attrs"])
+        return xr.Dataset(variables, coords=coords, attrs=item["attrs"])
+
+
+def panels(directory=None):
+    """
+    List the shared panels of a directory.
+
+    Parameters:
+    - directory (str, optional): The directory of the panels. Default is default_directory().
+
+    Returns:
+    - pandas.DataFrame: The items, size in MiB, live references and persist flag of each panel, indexed by name.
+    """
+    directory = directory or default_directory()
+    rows = []
+    for filename in sorted(os.listdir(directory)):
+        # Skip the lock files, reference directories and temporary files
+        if not (filename.startswith("quantsys-")
+                and filename.endswith(".panel")):
+            continue
+        path = os.path.join(directory, filename)
+        with _locked(path):
+            try:
+                with open(path, "rb") as f:
+                    header, _ = _read_header(f)
+                    size = os.fstat(f.fileno()).st_size
+            except FileNotFoundError:
+                # Deleted meanwhile; only remove the lock files
+                _remove(path)
+                continue
+            refs = len(_live_refs(path))
+        rows.append({
+            "name": filename[len("quantsys-"):-len(".panel")],
+            "items": ", ".join(header["items"]),
+            "size_mb": size / 2**20,
+            "refs": refs,
+            "persist": header["persist"],
+        })
+    return pd.DataFrame(
+        rows, columns=["name", "items", "size_mb", "refs",
+                       "persist"]).set_index("name")
+
+
+def cleanup(directory=None):
+    """
+    Delete the panels left without live references by processes that died
+    without detaching, except the persistent ones, and the lock files left
+    by panels that no longer exist.
+
+    Parameters:
+    - directory (str, optional): The directory of the panels. Default is default_directory().
+
+    Returns:
+    - list: The names of the deleted panels.
+    """
+    directory = directory or default_directory()
+    listing = panels(directory)
+    deleted = []
+    for name, row in listing.iterrows():
+        if row["persist"]:
+            continue
+        path = panel_path(name, directory)
+        with _locked(path):
+            if os.path.exists(path) and not _live_refs(path):
+                _remove(path)
+                deleted.append(name)
+
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith("quantsys-")
+                and filename.endswith((".panel.lock", ".panel.create"))):
+            continue
+        path = os.path.join(directory, filename.rsplit(".", 1)[0])
+        with _locked(path):
+            if not os.path.exists(path):
+                _remove(path)
+    return deleted
+
+
+def _normalize(meta):
+    """
+    Get metadata as it reads back from the JSON header, e.g. arrays as lists.
+    """
+
+    def default(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return str(value)
+
+    return json.loads(json.dumps(meta, default=default))
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _layout(items, persist):
+    """
+    Lay out the arrays of the items: the header of the panel, the source of
+    every array, and the size of the data section.
+    """
+    header = {"persist": persist, "items": {}, "arrays": []}
+    sources = []
+    size = 0
+
+    def add(dtype, shape, source):
+        nonlocal size
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise TypeError(
+                "Object arrays cannot be shared, convert them to a fixed dtype")
+        header["arrays"].append({
+            "offset": size,
+            "shape": list(shape),
+            "dtype": dtype.str
+        })
+        sources.append(source)
+        size = _align(size + int(np.prod(shape)) * dtype.itemsize)
+        return len(header["arrays"]) - 1
+
+    for key, obj in items.items():
+        if isinstance(obj, xr.DataArray):
+            entry = {"kind": "DataArray", "name": obj.name}
+            variables = {obj.name or "": obj.variable}
+        elif isinstance(obj, xr.Dataset):
+            entry = {"kind": "Dataset"}
+            variables = {name: obj[name].variable for name in obj.data_vars}
+        else:
+            raise TypeError(f"Item {key} is not a Dataset or a DataArray")
+
+        entry["attrs"] = dict(obj.attrs)
+        entry["coords"] = {}
+        for name, coord in obj.coords.items():
+            values = np.asarray(coord.values)
+            if values.dtype.hasobject:
+                # e.g. the stk_id strings
+                values = values.astype(str)
+            entry["coords"][name] = {
+                "dims": list(coord.dims),
+                "array": add(values.dtype, values.shape, values)
+            }
+        entry["variables"] = {}
+        for name, variable in variables.items():
+            entry["variables"][name] = {
+                "dims": list(variable.dims),
+                "attrs": dict(variable.attrs),
+                # Read the values only when they are copied into the panel
+                "array": add(variable.dtype, variable.shape,
+                             lambda variable=variable: variable.values)
+            }
+        header["items"][key] = entry
+    return header, sources, size
+
+
+def _read_header(f):
+    """
+    Read the header of a panel file, and the offset of its data section.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{f.name} is not a shared panel")
+    length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+    header = json.loads(f.read(length))
+    return header, _align(len(MAGIC) + 8 + length)
+
+
+def _view(mm, data_start, spec):
+    """
+    Get an array of a panel as a view on its mapping.
+    """
+    dtype = np.dtype(spec["dtype"])
+    shape = tuple(spec["shape"])
+    return np.frombuffer(mm,
+                         dtype=dtype,
+                         count=int(np.prod(shape)),
+                         offset=data_start + spec["offset"]).reshape(shape)
+
+
+@contextmanager
+def _locked(path, suffix=".lock"):
+    """
+    Hold an exclusive lock on a panel, shared by every process. The lock
+    file is removed with the panel, so a process that locked a removed file
+    while waiting for it locks the new one instead.
+    """
+    while True:
+        fd = os.open(path + suffix, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(path + suffix).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def _add_ref(path):
+    """
+    Add a reference to a panel for this process. Called with the lock held.
+    """
+    os.makedirs(path + ".refs", exist_ok=True)
+    ref = os.path.join(path + ".refs", f"{os.getpid()}-{uuid.uuid4().hex}")
+    open(ref, "w").close()
+    return ref
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+def _live_refs(path):
+    """
+    Get the references to a panel of live processes, removing the others.
+    Called with the lock held.
+    """
+    try:
+        refs = os.listdir(path + ".refs")
+    except FileNotFoundError:
+        return []
+    live = []
+    for ref in refs:
+        if _pid_alive(int(ref.split("-")[0])):
+            live.append(ref)
+        else:
+            try:
+                os.remove(os.path.join(path + ".refs", ref))
+            except FileNotFoundError:
+                pass
+    return live
+
+
+def _release_ref(path, ref, pid):
+    """
+    Release a reference, and delete the panel if it was the last one and
+    the panel is not persistent.
+    """
+    # Forked processes inherit the handles of their parent, but not its references
+    if os.getpid() != pid:
+        return
+    with _locked(path):
+        try:
+            os.remove(ref)
+        except FileNotFoundError:
+            # Unlinked meanwhile; only its lock files are left to remove
+            if not os.path.exists(path):
+                _remove(path)
+            return
+        if _live_refs(path):
+            return
+        try:
+            with open(path, "rb") as f:
+                header, _ = _read_header(f)
+        except FileNotFoundError:
+            _remove(path)
+            return
+        if not header["persist"]:
+            _remove(path)
+
+
+def _remove(path):
+    """
+    Delete a panel file, its references and its lock files. Called with the
+    lock held, so it is removed last.
+    """
+    for ref in (os.listdir(path + ".refs")
+                if os.path.isdir(path + ".refs") else []):
+        try:
+            os.remove(os.path.join(path + ".refs", ref))
+        except FileNotFoundError:
+            pass
+    for target in (path + ".refs", path):
+        try:
+            if os.path.isdir(target):
+                os.rmdir(target)
+            else:
+                os.remove(target)
+        except FileNotFoundError:
+            pass
+
+    # The creation lock is kept while SharedPanel.open holds it
+    try:
+        fd = os.open(path + ".create", os.O_RDWR)
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(path + ".create")
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        finally:
+            os.close(fd)
+    try:
+        os.remove(path + ".lock")
+    except FileNotFoundError:
+        pass
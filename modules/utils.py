@@ -1,12 +1,112 @@
 import joblib
 import os
+from multiprocessing import shared_memory
+
+import numpy as np
 
 from modules.config import FACTOR_PATH
+from modules.profiling import traced
+from modules.factor_construction.factor_store import FactorStore
+from modules.shared_panel import SharedPanel
+
+# The shared panels attached by load_factors, kept for the life of the process
+_shared_panels = {}
+
+
+@traced(category="io")
+def load_factors(factors=None,
+                 instruments=None,
+                 start=None,
+                 end=None,
+                 shared=None):
+    """
+    Load the factors and returns computed by factor.py.
 
+    Only the requested factors, instruments and dates are read from the
+    factor store. Factor libraries saved as factors.joblib are still loaded
+    in full.
 
-def load_factors():
-    factors = joblib.load(os.path.join(FACTOR_PATH, 'factors.joblib'))
-    returns = joblib.load(os.path.join(FACTOR_PATH, 'returns.joblib'))
+    With shared, the factors and returns are attached from the shared panel
+    of that name without copying, and the first process to ask for the panel
+    loads and creates it. Every call attached to a panel must request the
+    same factors, instruments and dates as the call that created it, and the
+    panel is deleted once every process using it has exited.
+
+    Parameters:
+    factors (list): The factors to load. Default is all of them.
+    instruments (list): The instruments to load. Default is all of them.
+    start: The first date to load. Default is the first date.
+    end: The last date to load. Default is the last date.
+    shared (str): The name of a shared panel to attach to. Default is None (load into this process).
+
+    Returns:
+    tuple: The factors Dataset, the returns and the market returns.
+    """
+    if shared is None:
+        factors, returns = _read_factors(factors, instruments, start, end)
+    else:
+        request = {
+            "factors": factors,
+            "instruments": instruments,
+            "start": start,
+            "end": end
+        }
+        if shared in _shared_panels:
+            _shared_panels[shared].check_meta(request)
+        else:
+            _shared_panels[shared] = SharedPanel.open(
+                shared,
+                lambda: dict(
+                    zip(("factors", "returns"),
+                        _read_factors(factors, instruments, start, end))),
+                meta=request)
+        factors = _shared_panels[shared]["factors"]
+        returns = _shared_panels[shared]["returns"]
     mkt_returns = returns.mean(axis=0)
     print(factors.data_vars)
     return factors, returns, mkt_returns
+
+
+def _read_factors(factors, instruments, start, end):
+    """
+    Read the factors and returns from the factor library.
+    """
+    factor_store = FactorStore(os.path.join(FACTOR_PATH, 'factors'))
+    if factor_store.exists():
+        factors = factor_store.load(factors, instruments, start, end)
+        returns = FactorStore(os.path.join(FACTOR_PATH, 'returns')).load(
+            None, instruments, start, end)['RETURN']
+    else:
+        factors = joblib.load(os.path.join(FACTOR_PATH, 'factors.joblib'))
+        returns = joblib.load(os.path.join(FACTOR_PATH, 'returns.joblib'))
+    return factors, returns
+
+
+def share_array(array):
+    """
+    Copy an array into a new shared memory block.
+
+    Parameters:
+    array (numpy.ndarray): The array to share.
+
+    Returns:
+    tuple: The shared memory block and the (name, shape, dtype) spec to attach it.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """
+    Attach to a shared memory block created by share_array without copying.
+
+    Parameters:
+    spec (tuple): The (name, shape, dtype) spec of the block.
+
+    Returns:
+    tuple: The shared memory block and the array view on it.
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
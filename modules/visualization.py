@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -63,16 +64,21 @@ def generate_heatmap(factors):
     Generate a heatmap of correlation matrix.
 
     Args:
-    factors: Factors data (pandas DataFrame)
+    factors: Factors data (xarray Dataset), or their correlation matrix
+    (pandas DataFrame), e.g. CorrelationSelector.correlation()
 
     Returns:
     None
     """
+    # A correlation matrix computed elsewhere is plotted as is
+    corr = factors if isinstance(factors,
+                                 pd.DataFrame) else factors.to_dataframe().corr()
+
     # Create a figure and set the size
     plt.figure(figsize=(15, 15))
 
     # Generate the heatmap using seaborn
-    sns.heatmap(factors.to_dataframe().corr(),
+    sns.heatmap(corr,
                 vmax=1,
                 vmin=-1,
                 center=0,